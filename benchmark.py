@@ -0,0 +1,258 @@
+#
+# Benchmark the metrics' evaluation paths on synthetic sessions and the bundled dataset.
+#
+# Every metric is timed by its scalar evaluate (the baseline) and by its batch path over a dataset.CompiledRun
+# (evaluate_run), and all the metrics are timed together by a session_metrics.MetricSuite. Each measurement runs in
+# a forked process, so that its peak memory (the maximum resident set size) is measured separately. The loaders of
+# this dataset's format and of the TREC formats are timed on the synthetic sessions written to temporary files.
+# The report is written as JSON, e.g.,
+#
+#   python benchmark.py --sessions 200 --queries 5 --depth 100 --output bench.json
+#
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+from dataset import *
+from query_metrics import *
+from session_metrics import *
+
+
+#
+# Generate synthetic sessions in the same form as load_results and load_qrels.
+#
+# numsessions   the number of sessions
+# queries       the number of queries in each session
+# depth         the number of results of each query
+# grades        the distribution of the judged documents' relevance grades, a dict mapping each grade to its weight
+# qrels_size    the number of judged documents of each session
+# seed          the seed used for generating random numbers
+#
+# Returns (sresults, sqrels).
+def synthetic_sessions(numsessions, queries, depth, grades, qrels_size, seed=0):
+    rand = random.Random(seed)
+    levels = sorted(grades.keys())
+    cumulative = np.cumsum([grades[level] for level in levels], dtype=np.float64)
+    sresults, sqrels = dict(), dict()
+    for sessid in xrange(0, numsessions):
+        # the results of the session's queries are drawn from a pool of documents, part of which is judged
+        pool = ['http://example.com/%d/%d' % (sessid, i) for i in xrange(0, max(depth * 2, qrels_size))]
+        sresults[sessid] = [rand.sample(pool, depth) for _ in xrange(0, queries)]
+        sqrels[sessid] = dict()
+        for url in rand.sample(pool, qrels_size):
+            sqrels[sessid][url] = levels[int(np.searchsorted(cumulative, rand.random() * cumulative[-1], 'right'))]
+    return sresults, sqrels
+
+
+#
+# The metrics to be benchmarked: one instance of each metric class, named by the class.
+def metric_catalog():
+    evec, gs = [0.25, 1.0, 1.0], [0, 0.4, 0.6]
+    etime, pclick, psave = [9.8, 23.0, 37.6], [0.26, 0.5, 0.55], [0, 0.2, 0.8]
+    qmetrics = [Prec(evec), GradPrec(evec, gs), DCG(evec), NDCG(evec), RBP(evec, 0.8), GRBP(evec, 0.6, gs),
+                AvgPrec(evec), GradAvgPrec(evec, gs), RR(evec), ERR(evec, 2), TBG(etime, pclick, psave, 31),
+                UMeasure(2, etime, 99)]
+    smetrics = [SDCG(2, 4, True), NSDCG(2, 4, True), SDCGQ(2, 4, True), ESNDCG(0.8, 0.7, False, method='exact')]
+    catalog = [(qmetric.__class__.__name__, SQMetric(qmetric, np.mean)) for qmetric in qmetrics]
+    return catalog + [(smetric.__class__.__name__, smetric) for smetric in smetrics]
+
+
+#
+# Run func() in a forked process repeat times. Returns the fastest run's seconds and the process's peak memory (KB).
+def measure(func, repeat):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            seconds = []
+            for _ in xrange(0, repeat):
+                ideal_cache.clear()
+                start = time.time()
+                func()
+                seconds.append(time.time() - start)
+            os.write(write, json.dumps(min(seconds)))
+        finally:
+            os._exit(0)
+    os.close(write)
+    data = ''
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    _, status, usage = os.wait4(pid, 0)
+    if not data:
+        raise RuntimeError('the benchmark process failed with status %d' % status)
+    return json.loads(data), usage.ru_maxrss
+
+
+#
+# Benchmark every metric on a dataset. Returns (rows, summary), where rows has one result for each (metric, path)
+# and summary describes the dataset.
+def benchmark(name, sresults, sqrels, k, repeat):
+    sessids = sorted(sresults.keys())
+    numlists = sum(len(sresults[sessid]) for sessid in sessids)
+    rows = []
+
+    def record(metric, path, seconds, peak_rss, baseline=None):
+        rows.append({
+            'dataset': name, 'metric': metric, 'path': path, 'seconds': seconds,
+            'lists_per_sec': numlists / seconds if seconds > 0 else None, 'peak_rss_kb': peak_rss,
+            'speedup': baseline / seconds if baseline is not None and seconds > 0 else None,
+        })
+
+    seconds, peak_rss = measure(lambda: CompiledRun(sresults, sqrels).grade_matrix(k), repeat)
+    record('CompiledRun', 'compile', seconds, peak_rss)
+    # the batch paths are timed on a compiled run whose grade matrix is built (see 'compile')
+    run = CompiledRun(sresults, sqrels)
+    run.grade_matrix(k)
+    catalog = metric_catalog()
+    scalar = 0.0
+    for metric_name, smetric in catalog:
+        seconds, peak_rss = measure(lambda: [smetric.evaluate(sqrels[s], sresults[s], k) for s in sessids], repeat)
+        record(metric_name, 'scalar', seconds, peak_rss, seconds)
+        baseline = seconds
+        scalar += seconds
+        seconds, peak_rss = measure(lambda: smetric.evaluate_run(run, k), repeat)
+        record(metric_name, 'batch', seconds, peak_rss, baseline)
+    suite = MetricSuite([smetric for _, smetric in catalog])
+    seconds, peak_rss = measure(lambda: [suite.evaluate(sqrels[s], sresults[s], k) for s in sessids], repeat)
+    record('MetricSuite', 'suite', seconds, peak_rss, scalar)
+    seconds, peak_rss = measure(lambda: suite.evaluate_run(run, k), repeat)
+    record('MetricSuite', 'suite_batch', seconds, peak_rss, scalar)
+    return rows, {'name': name, 'sessions': len(sessids), 'lists': numlists,
+                  'results': sum(len(results) for s in sessids for results in sresults[s])}
+
+
+#
+# Write sessions into a directory in this dataset's format ('results' and 'qrels') and in the TREC formats
+# ('run.trec', whose qids are 'sessid.qno', and 'qrels.trec'). Returns the number of lines of each file.
+def write_sessions(directory, sresults, sqrels):
+    numlines = dict()
+    with open(os.path.join(directory, 'results'), 'w') as f, open(os.path.join(directory, 'run.trec'), 'w') as trec:
+        f.write('SessionID\tQno\trank\tURL\ttitle\tsnippet\n')
+        for sessid in sorted(sresults.keys()):
+            for qix, results in enumerate(sresults[sessid]):
+                for rank, url in enumerate(results):
+                    f.write('%d\t%d\t%d\t%s\t\t\n' % (sessid, qix + 1, rank + 1, url))
+                    score = len(results) - rank
+                    trec.write('%d.%d Q0 %s %d %.4f synthetic\n' % (sessid, qix + 1, url, rank + 1, score))
+    f.close()
+    trec.close()
+    numlines['results'] = numlines['run.trec'] = sum(len(r) for s in sresults for r in sresults[s])
+    with open(os.path.join(directory, 'qrels'), 'w') as f, open(os.path.join(directory, 'qrels.trec'), 'w') as trec:
+        f.write('SessionID\tURL\tRelevance\n')
+        for sessid in sorted(sqrels.keys()):
+            for url, grade in sorted(sqrels[sessid].items()):
+                f.write('%d\t%s\t%d\n' % (sessid, url, grade))
+                trec.write('%d 0 %s %d\n' % (sessid, url, grade))
+    f.close()
+    trec.close()
+    numlines['qrels'] = numlines['qrels.trec'] = sum(len(sqrels[s]) for s in sqrels)
+    return numlines
+
+
+#
+# Benchmark the loaders on the files written by write_sessions: load_results and load_qrels without their binary
+# cache (the baseline) and with it, and load_trec_run and load_trec_qrels. Returns one row for each loader.
+def benchmark_loaders(name, directory, numlines, repeat):
+    loaders = [
+        ('results', 'load_results', lambda path: load_results(path, cache=False)),
+        ('results', 'load_results(cache)', load_results),
+        ('run.trec', 'load_trec_run', load_trec_run),
+        ('qrels', 'load_qrels', lambda path: load_qrels(path, cache=False)),
+        ('qrels', 'load_qrels(cache)', load_qrels),
+        ('qrels.trec', 'load_trec_qrels', load_trec_qrels),
+    ]
+    # create the binary caches, so that the cached loaders are timed on a warm cache
+    load_results(os.path.join(directory, 'results'))
+    load_qrels(os.path.join(directory, 'qrels'))
+    rows, baseline = [], None
+    for filename, loader, load in loaders:
+        path = os.path.join(directory, filename)
+        seconds, peak_rss = measure(lambda: load(path), repeat)
+        if loader in ('load_results', 'load_qrels'):
+            baseline = seconds
+        rows.append({
+            'dataset': name, 'loader': loader, 'file': filename, 'seconds': seconds,
+            'lines_per_sec': numlines[filename] / seconds if seconds > 0 else None,
+            'mb_per_sec': os.path.getsize(path) / 1048576.0 / seconds if seconds > 0 else None,
+            'peak_rss_kb': peak_rss, 'speedup': baseline / seconds if seconds > 0 else None,
+        })
+    return rows
+
+
+#
+# Parse a grade distribution such as '0:0.6,1:0.25,2:0.1,-1:0.05'.
+def parse_grades(text):
+    grades = dict()
+    for item in text.split(','):
+        grade, weight = item.split(':')
+        grades[int(grade)] = float(weight)
+    return grades
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the metrics on synthetic sessions and the bundled data.')
+    parser.add_argument('--sessions', type=int, default=200, help='the number of synthetic sessions')
+    parser.add_argument('--queries', type=int, default=5, help='the number of queries in each session')
+    parser.add_argument('--depth', type=int, default=100, help='the number of results of each query')
+    parser.add_argument('--grades', type=parse_grades, default='0:0.6,1:0.25,2:0.1,-1:0.05',
+                        help='the distribution of relevance grades, e.g., 0:0.6,1:0.25,2:0.1,-1:0.05')
+    parser.add_argument('--qrels-size', type=int, default=100, help='the number of judged documents of each session')
+    parser.add_argument('--k', type=int, default=None, help='the cutoff to be evaluated (by default, --depth)')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of runs; the fastest one is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-data', action='store_true', help='do not benchmark the bundled dataset in data/')
+    parser.add_argument('--no-loaders', action='store_true', help='do not benchmark the loaders')
+    parser.add_argument('--output', default=None, help='the JSON report file (by default, standard output)')
+    args = parser.parse_args()
+
+    k = args.k if args.k is not None else args.depth
+    rows, datasets = [], []
+    sresults, sqrels = synthetic_sessions(args.sessions, args.queries, args.depth, args.grades, args.qrels_size,
+                                          args.seed)
+    synthetic_rows, synthetic = benchmark('synthetic', sresults, sqrels, k, args.repeat)
+    rows.extend(synthetic_rows)
+    datasets.append(synthetic)
+    if not args.no_data:
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        data_rows, data = benchmark('data', load_results(os.path.join(data_dir, 'results')),
+                                    load_qrels(os.path.join(data_dir, 'qrels')), 9, args.repeat)
+        rows.extend(data_rows)
+        datasets.append(data)
+    loader_rows = []
+    if not args.no_loaders:
+        directory = tempfile.mkdtemp(prefix='benchmark')
+        try:
+            loader_rows = benchmark_loaders('synthetic', directory, write_sessions(directory, sresults, sqrels),
+                                            args.repeat)
+        finally:
+            shutil.rmtree(directory)
+
+    report = {
+        'config': dict(vars(args), k=k),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'datasets': datasets,
+        'benchmarks': rows,
+        'loaders': loader_rows,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
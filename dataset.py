@@ -11,50 +11,218 @@
 # In Proceedings of the 38th European Conference on Information Retrieval (ECIR '16), 2016
 # http://people.cs.umass.edu/~jpjiang/papers/ecir16_metrics.pdf
 
+import array
+import json
+import math
+import os
+import sys
+import tempfile
+import numpy as np
+
+from collections import OrderedDict
+from query_metrics import grade_dtype
+
 
 #
 # Load each session's search results.
-def load_results(path):
+#
+# cache     use (and create) a binary cache of the file at path + '.cache', see load_cache
+def load_results(path, cache=True):
+    arrays = load_cache(path) if cache else None
+    if arrays is None:
+        sessids, qnos, ranks, urls = [], [], [], []
+        with open(path, 'r') as f:
+            for line in f.readlines()[1:]:
+                splits = line.rstrip('\n').split('\t')
+                if len(splits) == 6:
+                    sessid, qno, rank, url, _, _ = splits
+                else:
+                    # a query without any results
+                    sessid, qno, _ = splits
+                    rank, url = 0, None
+                sessids.append(int(sessid))
+                qnos.append(int(qno))
+                ranks.append(int(rank))
+                urls.append(url)
+        f.close()
+        if cache:
+            save_cache(path, {
+                'sessid': np.array(sessids, dtype=np.int64),
+                'qno': np.array(qnos, dtype=np.int32),
+                'rank': np.array(ranks, dtype=np.int32),
+            }, urls)
+    else:
+        sessids, qnos, urls = arrays['sessid'].tolist(), arrays['qno'].tolist(), arrays['urls']
     results = dict()
-    with open(path, 'r') as f:
-        for line in f.readlines()[1:]:
-            splits = line.rstrip('\n').split('\t')
-            if len(splits) == 6:
-                sessid, qno, _, url, _, _ = splits
-                sessid, qno = int(sessid), int(qno)
-                if sessid not in results:
-                    results[sessid] = dict()
-                if qno not in results[sessid]:
-                    results[sessid][qno] = []
-                results[sessid][qno].append(url)
-            else:
-                sessid, qno, _ = splits
-                sessid, qno = int(sessid), int(qno)
-                if sessid not in results:
-                    results[sessid] = dict()
-                if qno not in results[sessid]:
-                    results[sessid][qno] = []
-    f.close()
+    for sessid, qno, url in zip(sessids, qnos, urls):
+        if sessid not in results:
+            results[sessid] = dict()
+        if qno not in results[sessid]:
+            results[sessid][qno] = []
+        if url is not None:
+            results[sessid][qno].append(url)
     for sessid in results.keys():
         results[sessid] = [results[sessid][qix + 1] for qix in xrange(0, len(results[sessid]))]
     return results
 
 
+#
+# A session's search results in two flat integer arrays rather than a list of lists of URLs: the results of the j-th
+# query are urls[docs[i]] for i in offsets[j]:offsets[j + 1], where urls is a URL table shared by sessions (see
+# compact_results). A SessionResults is a sequence of each query's results (lists of URLs), so it can be evaluated
+# by any session metric in place of a session's results as returned by load_results.
+class SessionResults(object):
+    __slots__ = ('offsets', 'docs', 'urls')
+
+    #
+    # sresults  a session's results as returned by load_results
+    # urls      the shared URL table (a list), which new URLs are appended to
+    # ids       the index of each URL in the table
+    def __init__(self, sresults, urls, ids):
+        self.offsets, self.docs, self.urls = array.array('i', [0]), array.array('i'), urls
+        for results in sresults:
+            for url in results:
+                docid = ids.get(url)
+                if docid is None:
+                    docid = ids[url] = len(urls)
+                    urls.append(url)
+                self.docs.append(docid)
+            self.offsets.append(len(self.docs))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, qix):
+        if isinstance(qix, slice):
+            return [self[i] for i in xrange(*qix.indices(len(self)))]
+        if qix < 0:
+            qix += len(self)
+        if not 0 <= qix < len(self):
+            raise IndexError('query index out of range')
+        urls = self.urls
+        return [urls[docid] for docid in self.docs[self.offsets[qix]:self.offsets[qix + 1]]]
+
+    def __iter__(self):
+        for qix in xrange(0, len(self)):
+            yield self[qix]
+
+    # the memory used by the session's arrays in bytes (not counting the shared URL table)
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.offsets) + sys.getsizeof(self.docs)
+
+
+#
+# Convert sessions' results (as returned by load_results) into SessionResults sharing one URL table, e.g., to keep a
+# large results file in memory.
+def compact_results(results):
+    urls, ids = [], dict()
+    return dict((sessid, SessionResults(results[sessid], urls, ids)) for sessid in sorted(results.keys()))
+
+
+#
+# An estimate of the memory used by sessions' results in bytes: the lists (or SessionResults), the URL strings (each
+# distinct string once), and the sessids.
+def results_nbytes(results):
+    size, strings, tables = sys.getsizeof(results), dict(), dict()
+    for sessid, sresults in results.iteritems():
+        size += sys.getsizeof(sessid)
+        if isinstance(sresults, SessionResults):
+            size += sresults.nbytes()
+            tables[id(sresults.urls)] = sresults.urls
+        else:
+            size += sys.getsizeof(sresults)
+            for query_results in sresults:
+                size += sys.getsizeof(query_results)
+                for url in query_results:
+                    strings[id(url)] = sys.getsizeof(url)
+    for urls in tables.values():
+        size += sys.getsizeof(urls) + sum(sys.getsizeof(url) for url in urls)
+    return size + sum(strings.values())
+
+
 #
 # Load each session's qrels.
-def load_qrels(path):
+#
+# cache     use (and create) a binary cache of the file at path + '.cache', see load_cache
+def load_qrels(path, cache=True):
+    arrays = load_cache(path) if cache else None
+    if arrays is None:
+        sessids, urls, relevances = [], [], []
+        with open(path, 'r') as f:
+            for line in f.readlines()[1:]:
+                sessid, url, relevance = line.rstrip('\n').split('\t')
+                sessids.append(int(sessid))
+                urls.append(url)
+                relevances.append(int(relevance))
+        f.close()
+        if cache:
+            save_cache(path, {
+                'sessid': np.array(sessids, dtype=np.int64),
+                'grade': _grade_array(relevances),
+            }, urls)
+    else:
+        sessids, urls, relevances = arrays['sessid'].tolist(), arrays['urls'], arrays['grade'].tolist()
     qrels = dict()
-    with open(path, 'r') as f:
-        for line in f.readlines()[1:]:
-            sessid, url, relevance = line.rstrip('\n').split('\t')
-            sessid, relevance = int(sessid), int(relevance)
-            if sessid not in qrels:
-                qrels[sessid] = dict()
-            qrels[sessid][url] = relevance
-    f.close()
+    for sessid, url, relevance in zip(sessids, urls, relevances):
+        if sessid not in qrels:
+            qrels[sessid] = dict()
+        qrels[sessid][url] = relevance
     return qrels
 
 
+#
+# Save the parsed columns of a dataset file into a binary cache at path + '.cache', which is keyed on the file's
+# modification time and size (not its content, which would take as long to hash as to parse: a file rewritten with the
+# same size and modification time is served from a stale cache, so use cache=False or remove the cache). URLs are
+# interned: the cache stores each row's URL id (-1 for None) and a table of the distinct URLs. Nothing is saved if the
+# cache cannot be written (e.g., a read-only directory).
+def save_cache(path, arrays, urls):
+    ids, table = dict(), []
+    docs = np.empty(len(urls), dtype=np.int32)
+    for i in xrange(0, len(urls)):
+        if urls[i] is None:
+            docs[i] = -1
+        else:
+            docid = ids.get(urls[i])
+            if docid is None:
+                docid = ids[urls[i]] = len(table)
+                table.append(urls[i])
+            docs[i] = docid
+    arrays = dict(arrays)
+    arrays['doc'] = docs
+    arrays['url_offsets'] = np.cumsum([0] + [len(url) for url in table]).astype(np.int64)
+    arrays['url_bytes'] = np.fromstring(''.join(table), dtype=np.uint8)
+    stat = os.stat(path)
+    try:
+        # write to a temporary file first, so that a partially written cache is never read
+        fd, tmp = tempfile.mkstemp(prefix='.cache', dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        os.chmod(tmp, 0o644)
+        write_arrays(tmp, arrays, {'source': [stat.st_mtime, stat.st_size]})
+        os.rename(tmp, path + '.cache')
+    except (IOError, OSError):
+        pass
+
+
+#
+# Load the binary cache of a dataset file if it exists and is fresh (the file has not been modified since), or
+# None otherwise. The cached columns are memory-mapped, and the 'urls' column is the list of each row's URL.
+def load_cache(path):
+    if not os.path.exists(path + '.cache'):
+        return None
+    stat = os.stat(path)
+    try:
+        arrays, meta = map_arrays(path + '.cache')
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if meta.get('source') != [stat.st_mtime, stat.st_size]:
+        return None
+    offsets, blob = arrays['url_offsets'].tolist(), arrays['url_bytes'].tostring()
+    table = [blob[offsets[i]:offsets[i + 1]] for i in xrange(0, len(offsets) - 1)] + [None]
+    arrays['urls'] = [table[docid] for docid in arrays['doc'].tolist()]
+    return arrays
+
+
 #
 # Load each session's user ratings.
 def load_ratings(path):
@@ -69,3 +237,643 @@ def load_ratings(path):
             ratings[sessid]['difficulty'] = difficulty
     f.close()
     return ratings
+
+
+#
+# Read the lines of a file (except the header line) one session at a time, yielding (sessid, rows) where rows are
+# the session's lines split by tab. The lines of a session must be adjacent in the file.
+#
+# validate      raise a ValueError if a session's lines are not adjacent (this keeps a set of the seen sessids)
+def _iter_sessions(path, validate):
+    seen = set()
+    with open(path, 'r') as f:
+        f.readline()
+        sessid, rows = None, []
+        for line in f:
+            splits = line.rstrip('\n').split('\t')
+            if int(splits[0]) != sessid:
+                if len(rows) > 0:
+                    yield sessid, rows
+                sessid, rows = int(splits[0]), []
+                if validate:
+                    if sessid in seen:
+                        raise ValueError('%s is not grouped by SessionID: session %d appears again' % (path, sessid))
+                    seen.add(sessid)
+            rows.append(splits)
+        if len(rows) > 0:
+            yield sessid, rows
+    f.close()
+
+
+#
+# Iterate over each session's search results without loading the whole file, yielding (sessid, results) where
+# results are in the same format as load_results' values.
+def iter_results(path, validate=False):
+    for sessid, rows in _iter_sessions(path, validate):
+        results = dict()
+        for splits in rows:
+            qno = int(splits[1])
+            if qno not in results:
+                results[qno] = []
+            if len(splits) == 6:
+                results[qno].append(splits[3])
+        yield sessid, [results[qix + 1] for qix in xrange(0, len(results))]
+
+
+#
+# Iterate over each session's qrels without loading the whole file, yielding (sessid, qrels).
+def iter_qrels(path, validate=False):
+    for sessid, rows in _iter_sessions(path, validate):
+        yield sessid, dict((url, int(relevance)) for _, url, relevance in rows)
+
+
+#
+# The next (sessid, rows) of a file's sessions, which must follow the session sessid in ascending order.
+def _next_session(sessions, sessid, path):
+    session = next(sessions, None)
+    if session is not None and session[0] <= sessid:
+        raise ValueError('%s is not in ascending SessionID order: session %d follows %d' % (path, session[0], sessid))
+    return session
+
+
+#
+# Iterate over sessions' search results and qrels together, yielding (sessid, results, qrels), so that memory is
+# bounded by the largest session rather than the whole dataset.
+# Both files must list sessions in ascending SessionID order (as in this dataset), since they are merged by order:
+# a ValueError is raised as soon as a file is seen out of order (the rest of the qrels are read to the end to check
+# them), though a qrels session out of order is seen only after the sessions before it have been yielded. Sessions
+# without qrels get empty qrels, and the qrels of sessions without results are skipped (with validate, they raise a
+# ValueError too).
+def iter_sessions(results_path, qrels_path, validate=False):
+    qrels_iter = iter_qrels(qrels_path, validate)
+    pending, previous = next(qrels_iter, None), None
+    for sessid, results in iter_results(results_path, validate):
+        if previous is not None and sessid <= previous:
+            raise ValueError('%s is not in ascending SessionID order: session %d follows %d' %
+                             (results_path, sessid, previous))
+        previous = sessid
+        while pending is not None and pending[0] < sessid:
+            if validate:
+                raise ValueError('%s has session %d, which is not in %s' % (qrels_path, pending[0], results_path))
+            pending = _next_session(qrels_iter, pending[0], qrels_path)
+        qrels = dict()
+        if pending is not None and pending[0] == sessid:
+            qrels = pending[1]
+            pending = _next_session(qrels_iter, sessid, qrels_path)
+        yield sessid, results, qrels
+    if validate and pending is not None:
+        raise ValueError('%s has session %d, which is not in %s' % (qrels_path, pending[0], results_path))
+    while pending is not None:
+        pending = _next_session(qrels_iter, pending[0], qrels_path)
+
+
+#
+# Read a whitespace-separated file in chunks of about chunk_size bytes, yielding the columns of each chunk's lines,
+# e.g., [qids, Q0s, docids, ranks, scores, tags] for a TREC run. Each chunk is split by a single str.split, and only
+# falls back to splitting line by line (to skip blank lines and report malformed ones) if its size does not add up.
+#
+# ncols     the number of columns of each line
+def _iter_columns(path, ncols, chunk_size):
+    with open(path, 'r') as f:
+        remainder, lineno = '', 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk and not remainder:
+                break
+            if chunk:
+                chunk = remainder + chunk
+                end = chunk.rfind('\n') + 1
+                if end == 0:
+                    # a line longer than chunk_size
+                    remainder = chunk
+                    continue
+                chunk, remainder = chunk[:end], chunk[end:]
+            else:
+                chunk, remainder = remainder, ''
+            tokens = chunk.split()
+            numlines = chunk.count('\n') + (0 if chunk.endswith('\n') else 1)
+            if len(tokens) != ncols * numlines:
+                tokens = []
+                for i, line in enumerate(chunk.splitlines()):
+                    splits = line.split()
+                    if len(splits) != ncols and len(splits) > 0:
+                        raise ValueError('%s:%d: expected %d columns, found %d' % (path, lineno + i + 1, ncols,
+                                                                                    len(splits)))
+                    tokens.extend(splits)
+            lineno += numlines
+            if len(tokens) > 0:
+                yield [tokens[i::ncols] for i in xrange(0, ncols)]
+    f.close()
+
+
+#
+# A TREC qid's (sessid, qno): the qid is split at the last sep into the session and the query (e.g., '12.3'), or is a
+# session of a single query if it has no sep. Numeric sessids and qnos are converted to int.
+def _trec_qid(qid, sep):
+    sessid, _, qno = qid.rpartition(sep) if sep and sep in qid else (qid, None, '1')
+    return (int(sessid) if sessid.isdigit() else sessid), (int(qno) if qno.isdigit() else qno)
+
+
+#
+# Load each session's search results from a TREC run file (qid Q0 docid rank score tag), in the same format as
+# load_results. Each query's results are ranked as trec_eval does: by score in descending order, ties broken by docid
+# in descending order (the rank column is ignored). Each session's queries are ordered by their qnos; a query without
+# any results cannot be listed in a run file, so sessions with such queries differ from those of load_results.
+#
+# sep           the separator of sessid and qno in a qid, see _trec_qid
+# chunk_size    the number of bytes parsed at once
+def load_trec_run(path, sep='.', chunk_size=1 << 24):
+    qids, codes, docs, scores = dict(), [], [], []
+    for columns in _iter_columns(path, 6, chunk_size):
+        # qids are interned to integer codes, one dict lookup for each distinct qid of a chunk
+        table, inverse = np.unique(np.array(columns[0]), return_inverse=True)
+        table = np.array([qids.setdefault(qid, len(qids)) for qid in table.tolist()], dtype=np.int64)
+        codes.append(table[inverse])
+        docs.extend(columns[2])
+        scores.append(np.array(columns[4], dtype=np.float64))
+    if len(docs) == 0:
+        return dict()
+    order = np.lexsort((-np.concatenate(scores), np.concatenate(codes)))
+    codes, scores, docs = np.concatenate(codes)[order], np.concatenate(scores)[order], np.array(docs, dtype=object)
+    docs = docs[order]
+    # ties are rare, so they are broken by sorting only the runs of tied results (rather than sorting by docid strings)
+    ties = np.flatnonzero((codes[1:] == codes[:-1]) & (scores[1:] == scores[:-1]))
+    if len(ties) > 0:
+        breaks = np.flatnonzero(ties[1:] != ties[:-1] + 1)
+        starts = ties[np.concatenate([[0], breaks + 1])].tolist()
+        ends = (ties[np.concatenate([breaks, [len(ties) - 1]])] + 2).tolist()
+        for start, end in zip(starts, ends):
+            docs[start:end] = sorted(docs[start:end], reverse=True)
+    docs = docs.tolist()
+    bounds = [0] + (np.flatnonzero(codes[1:] != codes[:-1]) + 1).tolist() + [len(docs)]
+    names = sorted(qids, key=qids.get)
+    results = dict()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sessid, qno = _trec_qid(names[codes[start]], sep)
+        if sessid not in results:
+            results[sessid] = dict()
+        results[sessid][qno] = docs[start:end]
+    for sessid in results.keys():
+        results[sessid] = [results[sessid][qno] for qno in sorted(results[sessid].keys())]
+    return results
+
+
+#
+# Load each session's qrels from a TREC qrels file (qid iteration docid relevance), in the same format as load_qrels.
+# The qrels of a session's qids are merged, and a later line overrides an earlier one of the same document.
+#
+# sep           the separator of sessid and qno in a qid, see _trec_qid
+# chunk_size    the number of bytes parsed at once
+def load_trec_qrels(path, sep='.', chunk_size=1 << 24):
+    qrels = dict()
+    for columns in _iter_columns(path, 4, chunk_size):
+        qids, docs, grades = columns[0], columns[2], np.array(columns[3], dtype=np.int64).tolist()
+        # the lines of a qid are usually adjacent, so each run of them is added by one dict update
+        bounds = [0] + [i for i in xrange(1, len(qids)) if qids[i] != qids[i - 1]] + [len(qids)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            sessid = _trec_qid(qids[start], sep)[0]
+            if sessid not in qrels:
+                qrels[sessid] = dict()
+            qrels[sessid].update(zip(docs[start:end], grades[start:end]))
+    return qrels
+
+
+#
+# Sessions' search results and qrels compiled into integer arrays (CSR-style).
+# URLs are interned to integer ids and each document's relevance grade is resolved once, so that metrics can consume
+# the grades directly (evaluate_batch and evaluate_run) instead of looking up qrels by URL strings.
+#
+# sessids           the compiled sessions' sessids, in sorted order
+# session_offsets   the queries of the i-th session are session_offsets[i]:session_offsets[i+1]
+# query_offsets     the results of the j-th query are query_offsets[j]:query_offsets[j+1]
+# docs, grades      each result's document id and relevance grade
+# qrels_offsets     the judged documents of the i-th session are qrels_offsets[i]:qrels_offsets[i+1]
+# qrels_docs        the judged documents' ids, sorted by relevance grade in descending order within each session
+# qrels_grades      the judged documents' relevance grades
+# urls              the URL of each document id
+class CompiledRun:
+    # the names of the arrays that make up a compiled run
+    arrays = ('session_offsets', 'query_offsets', 'qrels_offsets', 'docs', 'grades', 'qrels_docs', 'qrels_grades')
+
+    #
+    # results   sessions' search results, as returned by load_results
+    # qrels     sessions' qrels, as returned by load_qrels (or a QrelsIndex)
+    # shared    a compiled run of the same sessions and qrels (e.g., another system's), whose URL ids and compiled
+    #           qrels are shared rather than compiled again
+    def __init__(self, results, qrels, shared=None):
+        self.urls = [] if shared is None else shared.urls
+        self.ids = dict() if shared is None else shared.ids
+        sessids = sorted(results.keys())
+        if shared is not None and sessids != shared.sessids:
+            raise ValueError('the results are not of the same sessions as the shared run: %s' %
+                             sorted(set(sessids) ^ set(shared.sessids))[:10])
+        session_offsets, query_offsets, qrels_offsets = [0], [0], [0]
+        docs, grades, qrels_docs, qrels_grades = [], [], [], []
+        for sessid in sessids:
+            sqrels = qrels.get(sessid, {})
+            for results_query in results[sessid]:
+                for url in results_query:
+                    docs.append(self.intern(url))
+                    grades.append(sqrels.get(url, 0))
+                query_offsets.append(len(docs))
+            session_offsets.append(len(query_offsets) - 1)
+            if shared is None:
+                for url in sorted(sqrels, key=lambda key: sqrels[key], reverse=True):
+                    qrels_docs.append(self.intern(url))
+                    qrels_grades.append(sqrels[url])
+                qrels_offsets.append(len(qrels_docs))
+        if shared is None:
+            qrels_offsets = np.array(qrels_offsets, dtype=np.int64)
+            qrels_docs = np.array(qrels_docs, dtype=np.int32)
+            qrels_grades = _grade_array(qrels_grades)
+        else:
+            qrels_offsets, qrels_docs, qrels_grades = shared.qrels_offsets, shared.qrels_docs, shared.qrels_grades
+        self.load(sessids, {
+            'session_offsets': np.array(session_offsets, dtype=np.int64),
+            'query_offsets': np.array(query_offsets, dtype=np.int64),
+            'qrels_offsets': qrels_offsets,
+            'docs': np.array(docs, dtype=np.int32),
+            'grades': _grade_array(grades),
+            'qrels_docs': qrels_docs,
+            'qrels_grades': qrels_grades,
+        })
+        if shared is not None:
+            self.judged = shared.judged_matrix()
+            self.qrels_dicts = shared.qrels_dicts
+
+    #
+    # Set the compiled arrays (e.g., ones attached from shared memory) and index the sessions and queries.
+    def load(self, sessids, arrays):
+        self.sessids = list(sessids)
+        for name in CompiledRun.arrays:
+            setattr(self, name, arrays[name])
+        self.index = dict((sessid, i) for i, sessid in enumerate(self.sessids))
+        # the index of the session each query belongs to, and the query's position (from 0) in the session
+        self.query_session = np.repeat(np.arange(len(self.sessids)), np.diff(self.session_offsets))
+        self.query_position = np.arange(len(self.query_offsets) - 1) - self.session_offsets[self.query_session]
+        self.matrices = dict()
+        self.judged = None
+        # the sessions' qrels dicts built by session, kept so that metrics' ideal caches (keyed by the dict) hit
+        self.qrels_dicts = dict()
+
+    #
+    # get the integer id of a URL
+    def intern(self, url):
+        docid = self.ids.get(url)
+        if docid is None:
+            docid = len(self.urls)
+            self.ids[url] = docid
+            self.urls.append(url)
+        return docid
+
+    #
+    # the number of sessions and queries
+    def num_sessions(self):
+        return len(self.sessids)
+
+    def num_queries(self):
+        return len(self.query_offsets) - 1
+
+    #
+    # a session's relevance grades, one array per query
+    def session_grades(self, sessid):
+        i = self.index[sessid]
+        offsets = self.query_offsets[self.session_offsets[i]:self.session_offsets[i + 1] + 1]
+        return [self.grades[offsets[j]:offsets[j + 1]] for j in xrange(0, len(offsets) - 1)]
+
+    #
+    # a session's qrels and search results in terms of integer document ids, which can be evaluated by any metric;
+    # the qrels dict is built once and must not be modified
+    def session(self, sessid):
+        i = self.index[sessid]
+        sqrels = self.qrels_dicts.get(i)
+        if sqrels is None:
+            qstart, qend = self.qrels_offsets[i], self.qrels_offsets[i + 1]
+            sqrels = dict(zip(self.qrels_docs[qstart:qend].tolist(), self.qrels_grades[qstart:qend].tolist()))
+            self.qrels_dicts[i] = sqrels
+        offsets = self.query_offsets[self.session_offsets[i]:self.session_offsets[i + 1] + 1]
+        sresults = [self.docs[offsets[j]:offsets[j + 1]].tolist() for j in xrange(0, len(offsets) - 1)]
+        return sqrels, sresults
+
+    #
+    # Build the padded grade matrices of all queries, in the same format as query_metrics.grade_matrix.
+    # qgrades[j] holds the judged grades of the session that the j-th query belongs to.
+    # The matrices are built once for each k and shared by all metrics, so they must not be modified.
+    def grade_matrix(self, k):
+        if k not in self.matrices:
+            lengths = np.minimum(np.diff(self.query_offsets), k)
+            grades = _gather(self.grades, self.query_offsets[:-1], lengths)
+            sqgrades, slengths = self.judged_matrix()
+            self.matrices[k] = grades, lengths, sqgrades[self.query_session], slengths[self.query_session]
+        return self.matrices[k]
+
+    #
+    # the padded matrix of each session's judged grades (in descending order), and the number of judged documents
+    def judged_matrix(self):
+        if self.judged is None:
+            slengths = np.diff(self.qrels_offsets)
+            self.judged = _gather(self.qrels_grades, self.qrels_offsets[:-1], slengths), slengths
+        return self.judged
+
+
+#
+# Compile several systems' search results of the same sessions against the same qrels, which are compiled only once
+# and shared by the compiled runs (see CompiledRun).
+#
+# runs      a list of search results, each as returned by load_results
+# qrels     the sessions' qrels, as returned by load_qrels
+def compile_runs(runs, qrels):
+    compiled = []
+    for results in runs:
+        compiled.append(CompiledRun(results, qrels, compiled[0] if len(compiled) > 0 else None))
+    return compiled
+
+
+#
+# Mix the positions of sessions and the hashes of URLs into well-distributed 64-bit keys (splitmix64's finalizer).
+def _mix_keys(sessions, hashes):
+    keys = hashes.astype(np.int64).view(np.uint64) ^ (np.asarray(sessions, dtype=np.uint64) *
+                                                       np.uint64(0x9E3779B97F4A7C15))
+    keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return keys ^ (keys >> np.uint64(31))
+
+
+#
+# A compact index of sessions' qrels, for collections whose qrels do not fit in dicts (a memory optimization only,
+# which does not speed up lookups; see below). Each judged document takes a 64-bit key (of its session and its URL's
+# hash), its grade, and its URL in a shared string, rather than a dict entry and a string object. Grades are looked up
+# in bulk (lookup): a Bloom filter of the keys rejects most unjudged documents, and the rest are found by binary
+# search and checked against the stored URLs, so that hash collisions never change a grade. The keys use Python's str
+# hash, so an index is only valid in the process it was built in.
+#
+# The index saves memory, not time: hashing each URL and verifying the candidates costs more than probing a dict
+# (about 1.7 to 2.5 times as long per document, even if 95% of the documents are unjudged), so CompiledRun and the
+# metrics read the index through per-session dicts. index[sessid] and index.get(sessid) build a session's qrels
+# dict, and the most recently built ones are kept, so that metrics' ideal caches still hit.
+#
+# sessids           the sessions' sessids, in sorted order
+# offsets           the judged documents of the i-th session are offsets[i]:offsets[i+1]
+# grades            the judged documents' grades, in descending order within each session
+# url_offsets       the URL of the j-th judged document is urls[url_offsets[j]:url_offsets[j+1]]
+# keys, entries     the judged documents' keys in sorted order, and the document of each key
+# bloom             the Bloom filter's bits, numbits in total, set by numhashes hash functions of the keys
+class QrelsIndex:
+    #
+    # qrels             sessions' qrels, as returned by load_qrels
+    # bits_per_key      the size of the Bloom filter per judged document (10 bits give about 1% false positives)
+    # cache_size        the number of sessions' qrels dicts kept by get
+    def __init__(self, qrels, bits_per_key=10, cache_size=64):
+        self.sessids = sorted(qrels.keys())
+        self.index = dict((sessid, i) for i, sessid in enumerate(self.sessids))
+        urls, grades, offsets = [], [], [0]
+        for sessid in self.sessids:
+            sqrels = qrels[sessid]
+            for url in sorted(sqrels, key=lambda key: sqrels[key], reverse=True):
+                urls.append(url)
+                grades.append(sqrels[url])
+            offsets.append(len(urls))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.grades = _grade_array(grades)
+        self.url_offsets = np.cumsum([0] + [len(url) for url in urls]).astype(np.int64)
+        self.urls = ''.join(urls)
+        sessions = np.repeat(np.arange(0, len(self.sessids)), np.diff(self.offsets))
+        keys = _mix_keys(sessions, np.fromiter(map(hash, urls), dtype=np.int64, count=len(urls)))
+        self.entries = np.argsort(keys, kind='mergesort').astype(np.int32)
+        self.keys = keys[self.entries]
+        self.numbits = max(64, int(bits_per_key * len(urls)))
+        self.numhashes = max(1, int(round(bits_per_key * math.log(2))))
+        bits = np.zeros(self.numbits, dtype=bool)
+        for positions in self.bloom_positions(keys):
+            bits[positions] = True
+        self.bloom = np.packbits(bits)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    #
+    # the Bloom filter's bit positions of keys by each hash function (double hashing of the key's two halves)
+    def bloom_positions(self, keys):
+        step = (keys >> np.uint64(32)) | np.uint64(1)
+        for i in xrange(0, self.numhashes):
+            yield ((keys + np.uint64(i) * step) % np.uint64(self.numbits)).astype(np.int64)
+
+    #
+    # whether each key may be in the index (False only if it is certainly not)
+    def may_contain(self, keys):
+        maybe = np.arange(0, len(keys))
+        step = (keys >> np.uint64(32)) | np.uint64(1)
+        for i in xrange(0, self.numhashes):
+            # only the keys that have passed the previous hash functions are checked
+            positions = ((keys[maybe] + np.uint64(i) * step[maybe]) % np.uint64(self.numbits)).astype(np.int64)
+            maybe = maybe[(self.bloom[positions >> 3] >> (7 - (positions & 7)).astype(np.uint8)) & 1 == 1]
+        contains = np.zeros(len(keys), dtype=bool)
+        contains[maybe] = True
+        return contains
+
+    #
+    # Look up the grades of documents (0 for unjudged ones) in bulk.
+    #
+    # sessions      the position (in sessids, see self.index) of each document's session
+    # urls          the documents' URLs
+    def lookup(self, sessions, urls):
+        sessions = np.asarray(sessions, dtype=np.int64)
+        grades = np.zeros(len(urls), dtype=self.grades.dtype)
+        if len(urls) == 0 or len(self.keys) == 0:
+            return grades
+        keys = _mix_keys(sessions, np.fromiter(map(hash, urls), dtype=np.int64, count=len(urls)))
+        candidates = np.flatnonzero(self.may_contain(keys))
+        positions = np.minimum(np.searchsorted(self.keys, keys[candidates]), len(self.keys) - 1)
+        found = self.keys[positions] == keys[candidates]
+        candidates, positions = candidates[found], positions[found]
+        entries = self.entries[positions]
+        starts, ends = self.url_offsets[entries].tolist(), self.url_offsets[entries + 1].tolist()
+        matched = ((entries >= self.offsets[sessions[candidates]]) & (entries < self.offsets[sessions[candidates] + 1]))
+        matched = [matched[i] and self.urls[starts[i]:ends[i]] == urls[c] for i, c in enumerate(candidates.tolist())]
+        matched = np.array(matched, dtype=bool)
+        grades[candidates[matched]] = self.grades[entries[matched]]
+        # the keys of different documents are equal only by a (rare) collision, so the other equal keys are checked
+        for c, position in zip(candidates[~matched].tolist(), positions[~matched].tolist()):
+            position += 1
+            while position < len(self.keys) and self.keys[position] == keys[c]:
+                entry = self.entries[position]
+                if (self.offsets[sessions[c]] <= entry < self.offsets[sessions[c] + 1] and
+                        self.urls[self.url_offsets[entry]:self.url_offsets[entry + 1]] == urls[c]):
+                    grades[c] = self.grades[entry]
+                    break
+                position += 1
+        return grades
+
+    #
+    # the grades of documents in a session (0 for unjudged ones)
+    def session_grades(self, sessid, urls):
+        if sessid not in self.index:
+            return np.zeros(len(urls), dtype=self.grades.dtype)
+        return self.lookup(np.repeat(self.index[sessid], len(urls)), urls)
+
+    #
+    # a session's judged URLs and their grades, in descending order of grades
+    def judged(self, sessid):
+        i = self.index.get(sessid)
+        if i is None:
+            return [], []
+        start, end = self.offsets[i], self.offsets[i + 1]
+        url_offsets = self.url_offsets[start:end + 1].tolist()
+        urls = [self.urls[url_offsets[j]:url_offsets[j + 1]] for j in xrange(0, end - start)]
+        return urls, self.grades[start:end].tolist()
+
+    #
+    # a session's qrels as a dict, or default if the session has no qrels
+    def get(self, sessid, default=None):
+        sqrels = self.cache.pop(sessid, None)
+        if sqrels is None:
+            if sessid not in self.index:
+                return default
+            sqrels = dict(zip(*self.judged(sessid)))
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[sessid] = sqrels
+        return sqrels
+
+    def __getitem__(self, sessid):
+        if sessid not in self.index:
+            raise KeyError(sessid)
+        return self.get(sessid)
+
+    def __contains__(self, sessid):
+        return sessid in self.index
+
+    def __len__(self):
+        return len(self.sessids)
+
+    def __iter__(self):
+        return iter(self.sessids)
+
+    def keys(self):
+        return list(self.sessids)
+
+    #
+    # the memory used by the index in bytes, in total and by each part (the session index dict is an estimate)
+    def nbytes(self):
+        sizes = {
+            'grades': self.grades.nbytes, 'offsets': self.offsets.nbytes + self.url_offsets.nbytes,
+            'urls': sys.getsizeof(self.urls), 'keys': self.keys.nbytes + self.entries.nbytes,
+            'bloom': self.bloom.nbytes, 'sessions': sys.getsizeof(self.index) + sys.getsizeof(self.sessids),
+        }
+        sizes['total'] = sum(sizes.values())
+        return sizes
+
+
+#
+# An estimate of the memory used by sessions' qrels dicts (as returned by load_qrels) in bytes: the dicts, the URL
+# strings, and the sessids (grades are small ints, which are shared).
+def qrels_nbytes(qrels):
+    size = sys.getsizeof(qrels)
+    for sessid, sqrels in qrels.iteritems():
+        size += sys.getsizeof(sessid) + sys.getsizeof(sqrels) + sum(sys.getsizeof(url) for url in sqrels)
+    return size
+
+
+#
+# Write a few named 1-d arrays into a binary file that can be memory-mapped by map_arrays.
+#
+# The file holds the 8-byte length of a JSON header, the header (each array's dtype, size, and offset, and a meta
+# dict), and the arrays at 64-byte aligned offsets.
+def write_arrays(path, arrays, meta=None):
+    layout, offset = dict(), 0
+    for name in sorted(arrays.keys()):
+        layout[name] = [arrays[name].dtype.str, len(arrays[name]), offset]
+        offset += (arrays[name].nbytes + 63) // 64 * 64
+    header = json.dumps({'arrays': layout, 'meta': meta or dict()})
+    start = (8 + len(header) + 63) // 64 * 64
+    with open(path, 'wb') as f:
+        f.write(np.array([len(header)], dtype='<i8').tostring())
+        f.write(header)
+        for name in sorted(arrays.keys()):
+            f.seek(start + layout[name][2])
+            f.write(np.ascontiguousarray(arrays[name]).tostring())
+    f.close()
+
+
+#
+# Memory-map (read-only) the arrays written by write_arrays. Returns (arrays, meta).
+def map_arrays(path):
+    with open(path, 'rb') as f:
+        length = int(np.fromstring(f.read(8), dtype='<i8')[0])
+        header = json.loads(f.read(length))
+    f.close()
+    start = (8 + length + 63) // 64 * 64
+    arrays = dict()
+    for name, (dtype, size, offset) in header['arrays'].items():
+        if size == 0:
+            arrays[str(name)] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[str(name)] = np.memmap(path, dtype=dtype, mode='r', offset=start + offset, shape=(size,))
+    return arrays, header['meta']
+
+
+#
+# A compiled run (and optionally the sessions' user ratings) exported to a shared memory block, so that worker
+# processes can attach to it by name without copying or unpickling the dataset.
+#
+# The block is a file on a memory-backed file system (/dev/shm when available), which holds a JSON header that
+# describes each array, followed by the arrays themselves. attach_shared memory-maps the arrays read-only.
+class SharedRun:
+    #
+    # run       a CompiledRun
+    # ratings   sessions' user ratings, as returned by load_ratings (optional)
+    # path      the path of the block; a new file is created in /dev/shm (or the temporary directory) by default
+    def __init__(self, run, ratings=None, path=None):
+        arrays = dict((name, getattr(run, name)) for name in CompiledRun.arrays)
+        arrays['sessids'] = np.array(run.sessids, dtype=np.int64)
+        if ratings is not None:
+            for umetric in sorted(ratings[run.sessids[0]].keys()) if run.sessids else []:
+                arrays['rating_' + umetric] = np.array([ratings[sessid][umetric] for sessid in run.sessids])
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='ir_metrics_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            os.close(fd)
+        self.path = path
+        write_arrays(path, arrays)
+
+    #
+    # remove the shared memory block; processes that have attached to it can still use their mapping
+    def unlink(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+#
+# Attach to a SharedRun by its path without copying the arrays.
+#
+# Returns (run, ratings), where run is a CompiledRun (without the URL table) and ratings are the sessions' user
+# ratings in the format of load_ratings (an empty dict if no ratings were exported).
+def attach_shared(path):
+    arrays, _ = map_arrays(path)
+    sessids = arrays['sessids'].tolist()
+    run = CompiledRun(dict(), dict())
+    run.load(sessids, arrays)
+    ratings = dict()
+    for name in arrays.keys():
+        if name.startswith('rating_'):
+            for i in xrange(0, len(sessids)):
+                ratings.setdefault(sessids[i], dict())[name[len('rating_'):]] = arrays[name][i].item()
+    return run, ratings
+
+
+#
+# Store relevance grades as int8, or a wider dtype if any of them does not fit (see query_metrics.grade_dtype).
+def _grade_array(grades):
+    grades = np.array(grades, dtype=np.int64)
+    if len(grades) == 0:
+        return grades.astype(np.int8)
+    return grades.astype(grade_dtype(grades.min(), grades.max()))
+
+
+#
+# Gather the CSR segments values[starts[i]:starts[i]+lengths[i]] into a zero padded matrix.
+def _gather(values, starts, lengths):
+    width = max(lengths.max() if len(lengths) > 0 else 0, 1)
+    cols = np.arange(width)
+    mask = cols[np.newaxis, :] < lengths[:, np.newaxis]
+    matrix = np.zeros((len(lengths), width), dtype=values.dtype)
+    matrix[mask] = values[(starts[:, np.newaxis] + cols[np.newaxis, :])[mask]]
+    return matrix
@@ -15,6 +15,11 @@ from utils import *
 from dataset import *
 from query_metrics import *
 from session_metrics import *
+from result_store import use_store_from_environ
+import profiling
+
+# set IR_METRICS_PROFILE=1 (or a .pstats file name) to report where the time goes
+profiling.enable_from_environ()
 
 # turn this on to print the latex table
 latex = False
@@ -24,6 +29,9 @@ session_ratings = load_ratings('data/session')
 session_results = load_results('data/results')
 session_qrels = load_qrels('data/qrels')
 
+# set IR_METRICS_STORE to a directory (e.g., data/results.store) to reuse the session scores of previous runs
+use_store_from_environ()
+
 # evaluate the top 9 results for each query (because the dataset only provides 9 results per SERP)
 k = 9
 
@@ -14,12 +14,20 @@ from utils import *
 from dataset import *
 from query_metrics import *
 from session_metrics import *
+from result_store import use_store_from_environ
+import profiling
+
+# set IR_METRICS_PROFILE=1 (or a .pstats file name) to report where the time goes
+profiling.enable_from_environ()
 
 # load the dataset
 session_ratings = load_ratings('data/session')
 session_results = load_results('data/results')
 session_qrels = load_qrels('data/qrels')
 
+# set IR_METRICS_STORE to a directory (e.g., data/results.store) to reuse the session scores of previous runs
+use_store_from_environ()
+
 # three different effort vectors
 evec_static = [1.0, 1.0, 1.0]
 evec_param = [1.0 / 4, 1.0, 1.0]
@@ -236,6 +244,12 @@ print(
     )
 )
 
+# the best metric's errors, which single variant metrics are compared with
+nrmse_best = regress(
+        session_ratings, session_results, session_qrels,
+        umetric, best, k, 4.0, numfolds, numsamples
+)
+
 for [name, mets] in metrics:
     if len(mets) == 1:
 
@@ -244,10 +258,6 @@ for [name, mets] in metrics:
                 session_ratings, session_results, session_qrels,
                 umetric, mets[0], k, 4.0, numfolds, numsamples
         )
-        nrmse_best = regress(
-                session_ratings, session_results, session_qrels,
-                umetric, best, k, 4.0, numfolds, numsamples
-        )
 
         print(
             '%-20s  %16.3f %-3s  %16s %-3s  %16s %-3s  %16.3f %-3s (p=%.3f)'
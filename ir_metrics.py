@@ -0,0 +1,263 @@
+#
+# Command line tool for evaluating search sessions, e.g.,
+#
+#   python -m ir_metrics eval data/results data/qrels -k 9 -m ndcg:evec=1,1,1 -m grbp:pdown=0.6,gs=0,0.4,0.6,evec=0.25,1,1
+#
+# The results and qrels files are in this dataset's format (see data/results and data/qrels) and are read one
+# session at a time, so they must list sessions in ascending SessionID order; or, with --input trec, they
+# are a TREC run and qrels file (see dataset.load_trec_run and load_trec_qrels), which are loaded at once. Scores are
+# written as they are computed: one row for each query (query metrics only), one row for each session (query 'all'),
+# and finally the mean over all sessions (session 'all').
+#
+# A metric spec is a metric name followed by its parameters, where a parameter's values continue until the next
+# name=value, e.g., 'grbp:pdown=0.6,gs=0,0.4,0.6,evec=0.25,1,1'. Parameters that are not given take the values used
+# in the experiment scripts. Query metrics accept agg=mean|sum|max|min|first|last for the session score.
+#
+
+import argparse
+import inspect
+import json
+import multiprocessing
+import sys
+import numpy as np
+
+from dataset import iter_sessions, load_trec_qrels, load_trec_run
+from query_metrics import *
+from session_metrics import *
+from utils import first, last
+
+# the metric of each name in a metric spec
+METRICS = {
+    'p': Prec, 'gp': GradPrec, 'dcg': DCG, 'ndcg': NDCG, 'rbp': RBP, 'grbp': GRBP, 'ap': AvgPrec, 'gap': GradAvgPrec,
+    'rr': RR, 'err': ERR, 'tbg': TBG, 'u': UMeasure,
+    'sdcg': SDCG, 'nsdcg': NSDCG, 'sdcgq': SDCGQ, 'esndcg': ESNDCG,
+}
+
+# the parameters' default values
+DEFAULTS = {
+    'evec': [1.0, 1.0, 1.0], 'gs': [0, 0.4, 0.6], 'pdown': 0.8, 'rmax': 2, 'time': [9.8, 23.0, 37.6],
+    'pclick': [0.26, 0.50, 0.55], 'psave': [0, 0.2, 0.8], 'h': 31, 'T': 99, 'b': 2, 'bq': 4, 'discountq': True,
+    'pref': 0.8, 'path_discount': False, 'method': 'exact',
+}
+
+# the parameters whose values are vectors, which are indexed by relevance grade and so take at least as many values
+# as their defaults (one per grade of the dataset)
+VECTORS = set(['evec', 'gs', 'time', 'pclick', 'psave'])
+
+# the parameters that only the metrics' scalar evaluate reads, which the batch paths that evaluate specs would ignore
+SCALAR_ONLY = set(['tolerance'])
+
+# the values of the parameters that take a name
+CHOICES = {'method': ['exact', 'sample', 'vectorized']}
+
+# the aggregation functions of query metrics' scores
+AGGFUNCS = {'mean': np.mean, 'sum': np.sum, 'max': np.max, 'min': np.min, 'first': first, 'last': last}
+
+
+def _parse_value(text):
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    for parse in (int, float):
+        try:
+            return parse(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+#
+# Check the values of a metric's parameter, so that a bad spec is reported before any session is evaluated.
+def _check_param(name, key, values):
+    if key in VECTORS:
+        if not all(_is_number(value) for value in values):
+            raise ValueError('parameter %s of %s takes numbers: %s' % (key, name, ','.join(map(str, values))))
+        if len(values) < len(DEFAULTS[key]):
+            raise ValueError('parameter %s of %s takes at least %d values (one per relevance grade): %s' %
+                             (key, name, len(DEFAULTS[key]), ','.join(map(str, values))))
+    elif key in CHOICES:
+        if values[0] not in CHOICES[key]:
+            raise ValueError('parameter %s of %s is one of %s: %s' % (key, name, ', '.join(CHOICES[key]), values[0]))
+    elif isinstance(DEFAULTS.get(key), bool):
+        if not isinstance(values[0], bool):
+            raise ValueError('parameter %s of %s is true or false: %s' % (key, name, values[0]))
+    elif not _is_number(values[0]):
+        raise ValueError('parameter %s of %s takes a number: %s' % (key, name, values[0]))
+
+
+#
+# Parse a metric spec into a session metric: query metrics are aggregated by SQMetric.
+def parse_metric(spec):
+    name, _, text = spec.partition(':')
+    if name.lower() not in METRICS:
+        raise ValueError('unknown metric %s in %s (one of %s)' % (name, spec, ', '.join(sorted(METRICS))))
+    params, key = dict(), None
+    for token in text.split(',') if text else []:
+        if '=' in token:
+            key, token = token.split('=', 1)
+            params[key] = []
+        elif key is None:
+            raise ValueError('a parameter name is expected in %s' % spec)
+        params[key].append(_parse_value(token))
+    cls = METRICS[name.lower()]
+    argnames = inspect.getargspec(cls.__init__).args[1:]
+    aggfunc = params.pop('agg', ['mean'])[0]
+    kwargs = dict((arg, DEFAULTS[arg]) for arg in argnames if arg in DEFAULTS)
+    for key, values in params.items():
+        if key not in argnames:
+            raise ValueError('unknown parameter %s of %s (one of %s)' %
+                             (key, name, ', '.join(arg for arg in argnames if arg not in SCALAR_ONLY)))
+        if key in SCALAR_ONLY:
+            raise ValueError('parameter %s of %s is not supported in specs: only the scalar evaluate reads it' %
+                             (key, name))
+        if key not in VECTORS and len(values) != 1:
+            raise ValueError('parameter %s of %s takes a single value' % (key, name))
+        _check_param(name, key, values)
+        kwargs[key] = values if key in VECTORS else values[0]
+    metric = cls(**kwargs)
+    if hasattr(metric, 'evaluate_context'):
+        if aggfunc not in AGGFUNCS:
+            raise ValueError('unknown aggregation %s (one of %s)' % (aggfunc, ', '.join(sorted(AGGFUNCS))))
+        metric = SQMetric(metric, AGGFUNCS[aggfunc])
+    return metric
+
+
+#
+# Evaluate a session by each (spec, metric). Returns rows of (sessid, query, spec, score), where query is the query
+# number from 1, or 'all' for the session's score.
+def evaluate_session(metrics, k, session):
+    sessid, sresults, sqrels = session
+    context = batch_context([sqrels] * len(sresults), sresults, k)
+    rows = []
+    for spec, metric in metrics:
+        if isinstance(metric, SQMetric):
+            qscores = metric.qmetric.evaluate_context(context)[:, k - 1].tolist()
+            rows.extend((sessid, qix + 1, spec, qscores[qix]) for qix in xrange(0, len(qscores)))
+            rows.append((sessid, 'all', spec, metric.aggfunc(qscores)))
+        else:
+            rows.append((sessid, 'all', spec, metric.evaluate(sqrels, sresults, k)))
+    return rows
+
+
+# the metrics and k evaluated by a worker process
+_worker = None
+
+
+def _init_worker(specs, k):
+    global _worker
+    _worker = [(spec, parse_metric(spec)) for spec in specs], k
+
+
+def _evaluate_worker(session):
+    metrics, k = _worker
+    return evaluate_session(metrics, k, session)
+
+
+#
+# Write rows of (session, query, metric, score) in TSV or JSON lines.
+class Writer:
+    def __init__(self, stream, format):
+        self.stream = stream
+        self.format = format
+        if format == 'tsv':
+            stream.write('session\tquery\tmetric\tscore\n')
+
+    def write(self, sessid, query, spec, score):
+        if self.format == 'tsv':
+            self.stream.write('%s\t%s\t%s\t%.6f\n' % (sessid, query, spec, score))
+        else:
+            self.stream.write(json.dumps({'session': sessid, 'query': query, 'metric': spec, 'score': score}) + '\n')
+
+
+def command_eval(args):
+    metrics = [(spec, parse_metric(spec)) for spec in args.metric]
+    if args.input == 'trec':
+        results, qrels = load_trec_run(args.results, args.qid_sep), load_trec_qrels(args.qrels, args.qid_sep)
+        sessions = ((sessid, results[sessid], qrels.get(sessid, dict())) for sessid in sorted(results.keys()))
+    else:
+        sessions = iter_sessions(args.results, args.qrels, args.validate)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, _init_worker, (args.metric, args.k))
+        session_rows = pool.imap(_evaluate_worker, sessions, chunksize=args.chunksize)
+    else:
+        pool = None
+        session_rows = (evaluate_session(metrics, args.k, session) for session in sessions)
+    writer = Writer(sys.stdout, args.format)
+    sums, counts = dict((spec, 0.0) for spec, _ in metrics), 0
+    try:
+        for rows in session_rows:
+            for sessid, query, spec, score in rows:
+                if query == 'all':
+                    sums[spec] += score
+                if query == 'all' or not args.sessions_only:
+                    writer.write(sessid, query, spec, score)
+            counts += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    for spec, _ in metrics:
+        writer.write('all', 'all', spec, sums[spec] / counts if counts > 0 else float('nan'))
+
+
+def command_serve(args):
+    # server imports this module for parse_metric
+    import server
+    batcher = server.MicroBatcher(args.metric, args.k, args.max_batch, args.max_delay / 1000.0)
+    httpd = server.make_server(batcher, args.host, args.port, args.unix)
+    sys.stderr.write('serving on %s\n' % (args.unix or '%s:%d' % (args.host, args.port)))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        batcher.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ir_metrics', description='Evaluate search sessions.')
+    commands = parser.add_subparsers()
+    evaluate = commands.add_parser('eval', help='evaluate a results file by a few metrics')
+    evaluate.add_argument('results', help='the search results file')
+    evaluate.add_argument('qrels', help='the qrels file')
+    evaluate.add_argument('-m', '--metric', action='append', required=True,
+                          help='a metric spec, e.g., grbp:pdown=0.6,gs=0,0.4,0.6,evec=0.25,1,1 (repeatable)')
+    evaluate.add_argument('-k', type=int, default=10, help='the top k results of each query to be evaluated')
+    evaluate.add_argument('--input', choices=['tsv', 'trec'], default='tsv',
+                          help="this dataset's format or TREC run and qrels files")
+    evaluate.add_argument('--qid-sep', default='.', help='the separator of the session and query in a TREC qid')
+    evaluate.add_argument('--format', choices=['tsv', 'json'], default='tsv', help='TSV or JSON lines')
+    evaluate.add_argument('--sessions-only', action='store_true', help='do not write the scores of each query')
+    evaluate.add_argument('-j', '--jobs', type=int, default=1, help='the number of worker processes')
+    evaluate.add_argument('--chunksize', type=int, default=16, help='the number of sessions sent to a worker at once')
+    evaluate.add_argument('--validate', action='store_true',
+                          help='also reject qrels of sessions that are not in the results file')
+    evaluate.set_defaults(command=command_eval)
+    serve = commands.add_parser('serve', help='serve query metrics over HTTP, see server.py')
+    serve.add_argument('-m', '--metric', action='append', required=True,
+                       help='a query metric spec evaluated by default (repeatable)')
+    serve.add_argument('-k', type=int, default=10, help='the default cutoff')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--unix', default=None, help='serve on a Unix socket at this path instead')
+    serve.add_argument('--max-batch', type=int, default=256, help='the maximum number of requests in a batch')
+    serve.add_argument('--max-delay', type=float, default=5.0,
+                       help='the default maximum time (ms) a request waits to be batched')
+    serve.set_defaults(command=command_serve)
+    args = parser.parse_args(argv)
+    if getattr(args, 'k', 1) < 1:
+        parser.error('k must be at least 1')
+    try:
+        for spec in getattr(args, 'metric', []):
+            parse_metric(spec)
+    except (ValueError, TypeError) as e:
+        parser.error(str(e))
+    args.command(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,24 +14,18 @@ session_qrels = load_qrels('data/qrels')
 evec_static = [1.0, 1.0, 1.0]
 umetric = 'performance'
 
+# esnDCG is computed exactly (the expected value over all scan paths) for all sessions at once
+run = CompiledRun(session_results, session_qrels)
+ratings = [session_ratings[sessid][umetric] for sessid in run.sessids]
+
 for pref in [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]:
     for pdown in [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]:
-        smetric = ESNDCG(pref, pdown, True)
-        ratings = []
-        sevals = []
-        for sessid in sorted(session_results.keys()):
-            rating, qrels = session_ratings[sessid][umetric], session_qrels[sessid]
-            sevals.append(smetric.evaluate(qrels, session_results[sessid], 9))
-            ratings.append(rating)
+        smetric = ESNDCG(pref, pdown, True, method='exact')
+        sevals = smetric.evaluate_run(run, 9)
         print 'esNDCG %.1f %.1f        %.3f' % (pref, pdown, stats.pearsonr(ratings, sevals)[0])
 
 for pref in [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]:
     for pdown in [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]:
-        smetric = ESNDCG(pref, pdown, False)
-        ratings = []
-        sevals = []
-        for sessid in sorted(session_results.keys()):
-            rating, qrels = session_ratings[sessid][umetric], session_qrels[sessid]
-            sevals.append(smetric.evaluate(qrels, session_results[sessid], 9))
-            ratings.append(rating)
+        smetric = ESNDCG(pref, pdown, False, method='exact')
+        sevals = smetric.evaluate_run(run, 9)
         print 'esNCG %.1f %.1f        %.3f' % (pref, pdown, stats.pearsonr(ratings, sevals)[0])
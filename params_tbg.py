@@ -3,11 +3,10 @@
 #
 
 import numpy as np
-import scipy.stats as stats
 
 from dataset import *
 from query_metrics import *
-from session_metrics import *
+from sweep import *
 
 session_ratings = load_ratings('data/session')
 session_results = load_results('data/results')
@@ -16,20 +15,15 @@ session_qrels = load_qrels('data/qrels')
 examine_time = [9.8, 23.0, 37.6]
 pclick = [0.26, 0.50, 0.55]
 
-best_r = 0.0
+run = CompiledRun(session_results, session_qrels)
 
-for ps1 in xrange(0, 10):
-    for ps2 in xrange(1, 10):
-        psave = [0, ps1 / 10.0, ps2 / 10.0]
-        for h in xrange(1, 500, 1):
-            metric = SQMetric(TBG(examine_time, pclick, psave, h), np.mean)
-            ratings = []
-            sevals = []
-            for sessid in sorted(session_results.keys()):
-                rating, qrels = session_ratings[sessid]['performance'], session_qrels[sessid]
-                sevals.append(metric.evaluate(qrels, session_results[sessid], 9))
-                ratings.append(rating)
-            r = stats.pearsonr(ratings, sevals)[0]
-            if r >= best_r:
-                best_r = r
-                print '%.1f  %.1f  %d  %.4f' % (ps1 / 10.0, ps2 / 10.0, h, stats.pearsonr(ratings, sevals)[0])
+grid = {
+    'time': [examine_time],
+    'pclick': [pclick],
+    'psave': [[0, ps1 / 10.0, ps2 / 10.0] for ps1 in xrange(0, 10) for ps2 in xrange(1, 10)],
+    'h': range(1, 500, 1),
+}
+
+# print the 20 configurations with the highest Pearson's r
+for config, r, _, _, _ in sweep(TBG, grid, run, session_ratings, 'performance', 9, aggfunc=np.mean)[:20]:
+    print '%.1f  %.1f  %d  %.4f' % (config['psave'][1], config['psave'][2], config['h'], r)
@@ -0,0 +1,176 @@
+#
+# Opt-in instrumentation: call counts, cumulative wall time, and the number of documents evaluated by each metric
+# class and each stage of an evaluation (loading, compiling, ideal rankings, sampling, and statistics).
+#
+# enable() replaces the instrumented functions and methods with timed wrappers, and disable() restores them, so the
+# instrumentation has no overhead when it is disabled. Times are inclusive, e.g., NDCG.evaluate includes the time
+# of DCG.evaluate. For example,
+#
+#   profiling.enable('eval.pstats')     # also record a cProfile dump
+#   ...
+#   profiling.report()
+#
+# The experiment scripts call enable_from_environ(), so setting IR_METRICS_PROFILE=1 (or a .pstats file name)
+# reports where their time goes when they exit.
+#
+
+import atexit
+import cProfile
+import inspect
+import os
+import sys
+import time
+
+import scipy.stats
+
+import dataset
+import query_metrics
+import session_metrics
+import utils
+
+# the counters of each instrumented name: [calls, seconds, documents]
+counters = dict()
+
+# the replaced functions and methods: (owner, attribute name, original)
+_patched = []
+
+# the cProfile profiler and the file its statistics are dumped to
+_profiler = None
+_profile_path = None
+
+
+#
+# The number of documents evaluated by a metric method called with args (self, qrels, results or sresults, k),
+# (self, c) for evaluate_context, or (self, run, k) for evaluate_run.
+def _documents(args):
+    if len(args) == 2:
+        # evaluate_context(c)
+        return int(args[1].mask.sum())
+    if hasattr(args[1], 'query_offsets'):
+        # evaluate_run(run, k)
+        run, k = args[1], max(args[2], 1)
+        return int(sum(min(n, k) for n in (run.query_offsets[1:] - run.query_offsets[:-1]).tolist()))
+    results, k = args[2], args[3]
+    if len(results) > 0 and isinstance(results[0], list):
+        return sum(min(len(r), max(k, 1)) for r in results)
+    return min(len(results), max(k, 1))
+
+
+def _timed(name, func, count=None):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counter = counters.get(name)
+            if counter is None:
+                counter = counters[name] = [0, 0.0, 0]
+            counter[0] += 1
+            counter[1] += time.time() - start
+            if count is not None:
+                counter[2] += count(args)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+#
+# Replace a module's function, including the names it has been imported as by other modules.
+def _patch_function(module, attr, name):
+    original = getattr(module, attr)
+    wrapper = _timed(name, original)
+    for other in list(sys.modules.values()):
+        for key, value in list(getattr(other, '__dict__', {}).items()):
+            if value is original:
+                setattr(other, key, wrapper)
+                _patched.append((other, key, original))
+
+
+def _patch_method(cls, attr, name, count=None):
+    if attr in cls.__dict__:
+        original = cls.__dict__[attr]
+        setattr(cls, attr, _timed(name, original, count))
+        _patched.append((cls, attr, original))
+
+
+#
+# The metric classes of query_metrics and session_metrics.
+def _metric_classes():
+    classes = []
+    for module in (query_metrics, session_metrics):
+        for value in vars(module).values():
+            if inspect.isclass(value) and value.__module__ == module.__name__ and hasattr(value, 'evaluate'):
+                classes.append(value)
+    return classes
+
+
+#
+# Start recording the counters (and a cProfile profile if profile_path is set, which is dumped by report).
+def enable(profile_path=None):
+    global _profiler, _profile_path
+    if _patched:
+        return
+    for attr in ('load_results', 'load_qrels', 'load_ratings'):
+        _patch_function(dataset, attr, 'load.' + attr)
+    _patch_function(query_metrics, 'grade_matrix', 'compile.grade_matrix')
+    _patch_method(dataset.CompiledRun, '__init__', 'compile.CompiledRun')
+    _patch_method(dataset.CompiledRun, 'grade_matrix', 'compile.CompiledRun.grade_matrix')
+    _patch_method(query_metrics.IdealCache, 'get', 'ideal.IdealCache.get')
+    for cls in (query_metrics.NDCG, session_metrics.NSDCG, session_metrics.ESNDCG):
+        _patch_method(cls, 'ideal_prefix', 'ideal.%s.ideal_prefix' % cls.__name__)
+    _patch_method(session_metrics.ESNDCG, 'sample', 'sampling.ESNDCG.sample')
+    for attr in ('pearsonr', 'spearmanr', 'linregress', 'ttest_rel'):
+        _patch_function(scipy.stats, attr, 'stats.scipy.' + attr)
+    for attr in ('correlation', 'bootstrap_correlation', 'regress', 'regress_fold'):
+        _patch_function(utils, attr, 'stats.' + attr)
+    for cls in _metric_classes():
+        for attr in ('evaluate', 'evaluate_residual', 'evaluate_context', 'evaluate_run'):
+            _patch_method(cls, attr, 'metric.%s.%s' % (cls.__name__, attr), _documents)
+    if profile_path is not None:
+        _profiler, _profile_path = cProfile.Profile(), profile_path
+        _profiler.enable()
+
+
+#
+# Stop recording and restore the original functions and methods. The counters are kept until reset().
+def disable():
+    global _profiler
+    while _patched:
+        owner, attr, original = _patched.pop()
+        setattr(owner, attr, original)
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        _profiler = None
+
+
+def reset():
+    counters.clear()
+
+
+#
+# The counters as a dict mapping each instrumented name to {'calls', 'seconds', 'documents'}.
+def summary():
+    return dict((name, {'calls': calls, 'seconds': seconds, 'documents': documents})
+                for name, (calls, seconds, documents) in counters.items())
+
+
+#
+# Stop recording and print the counters, sorted by the cumulative time.
+def report(stream=None):
+    disable()
+    stream = stream or sys.stderr
+    stream.write('%-50s %10s %12s %12s\n' % ('name', 'calls', 'seconds', 'documents'))
+    for name, (calls, seconds, documents) in sorted(counters.items(), key=lambda item: -item[1][1]):
+        stream.write('%-50s %10d %12.4f %12d\n' % (name, calls, seconds, documents))
+
+
+#
+# Enable the instrumentation if the environment variable IR_METRICS_PROFILE is set, and report at exit.
+# IR_METRICS_PROFILE is either 1 or the file the cProfile statistics are dumped to.
+def enable_from_environ():
+    value = os.environ.get('IR_METRICS_PROFILE')
+    if not value or value == '0':
+        return
+    enable(None if value == '1' else value)
+    atexit.register(report)
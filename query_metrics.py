@@ -9,15 +9,471 @@
 #
 
 import math
+import numpy as np
+
+from collections import OrderedDict
+
+
+#
+# Lookup tables shared by all metric instances with the same parameters, keyed by (table name, parameters).
+_tables = dict()
+
+
+#
+# Get the shared per-rank table [build(0), build(1), ...] with at least n entries.
+# The table grows by doubling when a longer ranked list is evaluated.
+def _rank_table(name, params, n, build):
+    table = _tables.get((name, params))
+    if table is None or len(table) < n:
+        size = 16 if table is None else len(table)
+        while size < n:
+            size *= 2
+        table = [build(i) for i in xrange(0, size)]
+        _tables[(name, params)] = table
+    return table
+
+
+#
+# The DCG rank discount log(2, rank + 1), indexed by rank - 1.
+def dcg_discounts(n):
+    return _rank_table('dcg', None, n, lambda i: math.log(2, i + 2))
+
+
+#
+# The graded relevance gain sum(gs[r] for r in range(0, rel + 1)) used by GP, GAP, and GRBP, indexed by rel + 1.
+def graded_gains(gs):
+    key = ('graded_gain', tuple(gs))
+    if key not in _tables:
+        _tables[key] = [sum(gs[r] for r in range(0, i)) for i in xrange(0, len(gs) + 1)]
+    return _tables[key]
+
+
+#
+# A bounded LRU cache of values derived from a qrels' ideal ranking (e.g., the ideal DCG at every cutoff).
+# Entries are keyed by the qrels object's identity and the metric configuration, so qrels must not be modified
+# after they have been evaluated.
+class IdealCache:
+    #
+    # capacity      the maximum number of cached entries; the least recently used entry is evicted first
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    #
+    # get the cached value of build(grades), where grades are the qrels' relevance grades in descending order
+    def get(self, qrels, config, build):
+        key = (id(qrels), config)
+        entry = self.entries.pop(key, None)
+        # the id of a garbage collected qrels may be reused by another one
+        if entry is None or entry[0] is not qrels:
+            entry = (qrels, build(sorted(qrels.itervalues(), reverse=True)))
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry[1]
+
+    def clear(self):
+        self.entries.clear()
+
+
+ideal_cache = IdealCache()
+
+
+#
+# The number of the ideal ranking's results evaluated at cutoff k, where at least one result is evaluated
+# as in the evaluate loops.
+def ideal_cutoff(k, qrels):
+    return min(max(k, 1), len(qrels))
+
+
+#
+# Prefix sums of gain(rel) * discount and effort(rel) * discount over a ranked list of relevance grades,
+# where prefix[i] is the sum over the top i results.
+def discounted_prefix(grades, gain, effort, discounts):
+    sum_gain, sum_effort = [0.0], [0.0]
+    for rank in xrange(0, len(grades)):
+        rel = grades[rank]
+        sum_gain.append(sum_gain[-1] + gain(rel) * discounts[rank])
+        sum_effort.append(sum_effort[-1] + effort(rel) * discounts[rank])
+    return sum_gain, sum_effort
+
+
+#
+# The dtype of stored relevance grades: int8, or int64 if a grade in low..high does not fit (grades never wrap).
+def grade_dtype(low, high):
+    return np.int8 if -128 <= low and high <= 127 else np.int64
+
+
+#
+# Build a padded relevance grade matrix from a few ranked lists, which can be evaluated by evaluate_batch.
+#
+# qrels_list        each ranked list's qrels
+# results_list      a list of ranked lists
+# k                 the top k results of each ranked list to be kept
+#
+# Returns (grades, lengths, qgrades, qlengths), where grades[i, :lengths[i]] are the relevance grades of the i-th
+# ranked list's top k results and qgrades[i, :qlengths[i]] are the i-th list's judged grades in descending order.
+def grade_matrix(qrels_list, results_list, k):
+    n = len(results_list)
+    lengths = np.array([min(len(results), k) for results in results_list], dtype=np.int64)
+    qlengths = np.array([len(qrels) for qrels in qrels_list], dtype=np.int64)
+    grades = np.zeros((n, max(lengths.max() if n > 0 else 0, 1)), dtype=np.int64)
+    qgrades = np.zeros((n, max(qlengths.max() if n > 0 else 0, 1)), dtype=np.int64)
+    for i in xrange(0, n):
+        qrels = qrels_list[i]
+        grades[i, :lengths[i]] = [qrels.get(doc, 0) for doc in results_list[i][:lengths[i]]]
+        # the queries of a session share the same qrels, which only need to be sorted once
+        if i > 0 and qrels is qrels_list[i - 1]:
+            qgrades[i] = qgrades[i - 1]
+        else:
+            qgrades[i, :qlengths[i]] = sorted(qrels.itervalues(), reverse=True)
+    # the results' grades are either judged or 0
+    dtype = grade_dtype(min(qgrades.min(), 0), max(qgrades.max(), 0)) if n > 0 else np.int8
+    return grades.astype(dtype), lengths, qgrades.astype(dtype), qlengths
+
+
+#
+# Truncate a grade matrix to the top k columns and mask out the padding.
+def _truncate(grades, lengths, k):
+    grades = np.asarray(grades)[:, :k]
+    mask = np.arange(grades.shape[1])[np.newaxis, :] < np.minimum(lengths, k)[:, np.newaxis]
+    return grades, mask
+
+
+#
+# Look up per-grade values (e.g., the effort vector) for a grade matrix.
+# Negative grades index from the end, the same as indexing a python list.
+def _lookup(values, grades):
+    return np.asarray(values, dtype=np.float64)[grades]
+
+
+#
+# The per-grade gain used by GP, GAP, and GRBP for a grade matrix.
+def _graded_gain(gs, grades):
+    return np.array(graded_gains(gs))[grades + 1]
+
+
+#
+# Running sums along each row, accumulated in the same order as the scalar evaluate loops.
+def _prefix(values):
+    return np.cumsum(values, axis=1)
+
+
+#
+# Row sums accumulated in the same order as the scalar evaluate loops.
+def _total(values):
+    if values.shape[1] == 0:
+        return np.zeros(values.shape[0])
+    return _prefix(values)[:, -1]
+
+
+#
+# num / den, or 0 where num is 0.
+def _ratio(num, den):
+    scores = np.zeros(np.broadcast(num, den).shape)
+    return np.divide(num, den, out=scores, where=np.asarray(num) != 0)
+
+
+#
+# Extend (or truncate) a matrix of scores at cutoffs 1, 2, ... to kmax columns, where the scores at cutoffs beyond
+# the end of the ranked lists are the same as the last column. Scores may have a trailing axis, e.g., of effort vectors.
+def _cutoffs(scores, kmax):
+    if scores.shape[1] >= kmax:
+        return scores[:, :kmax]
+    if scores.shape[1] == 0:
+        return np.zeros((scores.shape[0], kmax) + scores.shape[2:])
+    return np.concatenate((scores, np.repeat(scores[:, -1:], kmax - scores.shape[1], axis=1)), axis=1)
+
+
+#
+# Running sums (see _prefix) at cutoff k, i.e., the column k - 1 or the last column if the rows are shorter, or at
+# every cutoff if k is None.
+def _at_cutoff(prefix, k):
+    if k is None:
+        return prefix
+    if prefix.shape[1] == 0:
+        return np.zeros((prefix.shape[0],) + prefix.shape[2:])
+    return prefix[:, min(k, prefix.shape[1]) - 1]
+
+
+#
+# Scores at every cutoff extended to kmax columns (see _cutoffs), or the scores at cutoff k as they are.
+def _cutoff_scores(scores, kmax, k):
+    return _cutoffs(scores, kmax) if k is None else scores
+
+
+#
+# Running sums along each row excluding the current column, derived from the (inclusive) running sums.
+def _exclusive(prefix):
+    return np.concatenate((np.zeros((prefix.shape[0], 1)), prefix[:, :-1]), axis=1)
+
+
+#
+# Running products along each row, excluding the current column.
+def _exclusive_product(values):
+    return np.cumprod(np.concatenate((np.ones((values.shape[0], 1)), values[:, :-1]), axis=1), axis=1)
+
+
+#
+# The examination probability pdown ** (rank - 1) for ranks 1 to n.
+def _geometric(pdown, n):
+    return np.cumprod(np.concatenate(([1.0], np.repeat(float(pdown), max(n - 1, 0)))))[:n]
+
+
+#
+# The number of judged relevant documents (r > 0) for each row of a judged grade matrix.
+def _numrel(qgrades, qlengths):
+    qgrades, qmask = _truncate(qgrades, qlengths, np.shape(qgrades)[1])
+    return np.sum(qmask & (qgrades > 0), axis=1)
+
+
+#
+# The DCG rank discount log(2, rank + 1) for ranks 1 to n.
+def _log_discount(n):
+    return np.array(dcg_discounts(n)[:n])
+
+
+#
+# The intermediate results of evaluating a padded grade matrix (see grade_matrix), e.g., the running number of
+# relevant results, the running effort of each effort vector, and the examination probabilities of each pdown.
+# Each intermediate result is computed once and shared by all the metrics evaluated on the same context
+# (see session_metrics.MetricSuite).
+class BatchContext:
+    #
+    # grades, lengths       the padded grade matrix
+    # kmax                  the maximum cutoff to be evaluated
+    # qgrades, qlengths     each ranked list's judged grades in descending order (used by NDCG, AP, and GAP)
+    def __init__(self, grades, lengths, kmax, qgrades=None, qlengths=None):
+        self.grades, self.mask = _truncate(grades, lengths, kmax)
+        self.kmax = kmax
+        self.qgrades = qgrades
+        self.qlengths = qlengths
+        self.cache = dict()
+
+    #
+    # get the intermediate result named key, which is computed by build() the first time it is requested
+    def get(self, key, build):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache[key] = build()
+        return value
+
+    #
+    # each result's value (0 for the padding), where key is one of
+    #   'relevant'              rel > 0
+    #   'exp_gain'              2 ** rel - 1
+    #   ('graded', gs)          the graded gain used by GP, GAP, and GRBP
+    #   (name, vector)          a per-grade vector, e.g., ('evec', evec)
+    def values(self, key):
+        def build():
+            if key == 'relevant':
+                values = self.grades > 0
+            elif key == 'exp_gain':
+                values = np.power(2.0, self.grades) - 1.0
+            elif key[0] == 'graded':
+                values = _graded_gain(key[1], self.grades)
+            else:
+                values = _lookup(key[1], self.grades)
+            return np.where(self.mask, values, 0.0)
+        return self.get(('values', key), build)
+
+    #
+    # the rank discount: 'dcg' for log(2, rank + 1) or ('pexam', pdown) for pdown ** (rank - 1)
+    def discount(self, key):
+        def build():
+            if key == 'dcg':
+                return _log_discount(self.grades.shape[1])
+            return _geometric(key[1], self.grades.shape[1])
+        return self.get(('discount', key), build)
+
+    #
+    # the running sum of each result's value (see values), optionally discounted by rank (see discount)
+    def running(self, key, discount=None):
+        def build():
+            if discount is None:
+                return _prefix(self.values(key))
+            return _prefix(self.values(key) * self.discount(discount))
+        return self.get(('running', key, discount), build)
+
+    #
+    # the running number of results of each grade, optionally discounted by rank (see discount), where grade r is
+    # counted in column r % size, the same element as evec[r] of an effort vector of size grades. The running effort of
+    # an effort vector evec is then np.dot(counts, evec).
+    def grade_counts(self, size, discount=None):
+        def build():
+            grades = np.where(self.mask, self.grades, 0)
+            if grades.size > 0 and not -size <= grades.min() <= grades.max() < size:
+                raise IndexError('grades %d to %d do not index effort vectors of size %d' %
+                                 (grades.min(), grades.max(), size))
+            counts = np.where(self.mask[:, :, np.newaxis], (grades % size)[:, :, np.newaxis] == np.arange(size), 0.0)
+            if discount is not None:
+                counts *= self.discount(discount)[np.newaxis, :, np.newaxis]
+            return _prefix(counts)
+        return self.get(('grade_counts', size, discount), build)
+
+    #
+    # the running effort of each effort vector (a row of the matrix evecs), optionally discounted by rank, where
+    # efforts[i, j, e] is the i-th ranked list's effort of its top j + 1 results by the e-th effort vector, or
+    # efforts[i, e] the effort of its top k results if k is set
+    def efforts(self, evecs, discount=None, k=None):
+        evecs = _evec_matrix(evecs)
+        return np.dot(_at_cutoff(self.grade_counts(evecs.shape[1], discount), k), evecs.T)
+
+    #
+    # the context of the judged grades, i.e., each ranked list's ideal ranking
+    def ideal(self):
+        return self.get(('ideal',), lambda: BatchContext(self.qgrades, self.qlengths, self.kmax))
+
+    #
+    # the number of judged relevant documents of each ranked list
+    def numrel(self):
+        return self.get(('numrel',), lambda: _numrel(self.qgrades, self.qlengths))
+
+    #
+    # the sum of the graded gains (see graded_gains) of the judged documents of each ranked list
+    def enumrel(self, gs):
+        def build():
+            qgrades, qmask = _truncate(self.qgrades, self.qlengths, np.shape(self.qgrades)[1])
+            return _total(np.where(qmask, _graded_gain(gs, qgrades), 0.0))
+        return self.get(('enumrel', gs), build)
+
+
+#
+# The total weight pexam * (1 + decay + ... + decay ** (m - 1)) of the next m results, where pexam is the next
+# result's weight and each following result's weight is at most decay times the previous one's.
+def _geometric_tail(pexam, decay, m):
+    if decay == 1:
+        return pexam * m
+    return pexam * (1 - decay ** m) / (1 - decay)
+
+
+#
+# The maximum change of the score sum_gain / sum_effort (0 if sum_gain is 0) after adding results of total weight w,
+# where each result's gain is between 0 and gmax and its effort is between emin and emax.
+def _ratio_residual(sum_gain, sum_effort, w, gmax, emin, emax):
+    if w == 0:
+        return 0.0
+    if sum_effort + emin * w == 0:
+        return float('inf')
+    score = 0.0 if sum_gain == 0 else sum_gain / sum_effort
+    upper = (sum_gain + gmax * w) / (sum_effort + emin * w)
+    lower = sum_gain / (sum_effort + emax * w)
+    return max(upper - score, score - lower)
+
+
+#
+# A matrix of effort vectors (one per row), e.g., a list of evecs.
+def _evec_matrix(evecs):
+    evecs = np.asarray(evecs, dtype=np.float64)
+    if evecs.ndim != 2 or evecs.size == 0:
+        raise ValueError('effort vectors must be a non-empty matrix with one effort vector per row')
+    return evecs
+
+
+#
+# A JSON-serializable form of a metric parameter.
+def _config_value(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return np.asarray(value, dtype=np.float64).tolist()
+    return value
+
+
+#
+# Build the batch context of a few ranked lists' top kmax results (see grade_matrix).
+def batch_context(qrels_list, results_list, kmax):
+    grades, lengths, qgrades, qlengths = grade_matrix(qrels_list, results_list, kmax)
+    return BatchContext(grades, lengths, kmax, qgrades, qlengths)
+
+
+#
+# A configuration (see the metrics' config methods) as a hashable value, with lists converted into tuples.
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+#
+# The base of all metrics. A metric's attributes are listed in its __slots__, and its parameters do not change after
+# it is constructed (vector parameters are tuples), so metrics are compared and hashed by their configurations, e.g.,
+# to key caches by metric. Metrics without a configuration (e.g., sampled ones) are compared by identity.
+class Metric(object):
+    __slots__ = ()
+
+    #
+    # the metric's configuration, a stable key of the metric's scores (see result_store.py), or None
+    def config(self):
+        return None
+
+    def __eq__(self, other):
+        config = self.config()
+        if config is None or not isinstance(other, Metric):
+            return self is other
+        return _hashable(config) == _hashable(other.config())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        config = self.config()
+        return object.__hash__(self) if config is None else hash(_hashable(config))
+
+    #
+    # slotted objects are pickled by their slots (e.g., when metrics are sent to worker processes)
+    def __getstate__(self):
+        state = dict()
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+#
+# The base of the query metrics: evaluate_cutoffs_batch, evaluate_batch, and evaluate_all_cutoffs are derived from
+# evaluate_context.
+class QueryMetric(Metric):
+    __slots__ = ()
+    # the names of the constructor arguments, which are set as attributes of the same names
+    params = ()
+
+    #
+    # the metric's configuration, i.e., the class name and the constructor arguments, which is a stable key of the
+    # metric's scores (see result_store.py)
+    def config(self):
+        return [self.__class__.__name__] + [_config_value(getattr(self, name)) for name in self.params]
+
+    #
+    # evaluate a padded grade matrix (see grade_matrix) at every cutoff k = 1, 2, ..., kmax at once
+    def evaluate_cutoffs_batch(self, grades, lengths, kmax, qgrades=None, qlengths=None):
+        return self.evaluate_context(BatchContext(grades, lengths, kmax, qgrades, qlengths))
+
+    #
+    # evaluate a padded grade matrix (see grade_matrix) at once; k < 1 evaluates the top result, as evaluate does
+    def evaluate_batch(self, grades, lengths, k, qgrades=None, qlengths=None):
+        k = max(k, 1)
+        return self.evaluate_cutoffs_batch(grades, lengths, k, qgrades, qlengths)[:, k - 1]
+
+    #
+    # evaluate a ranked list at every cutoff k = 1, 2, ..., kmax in one pass; the (k-1)-th score is the metric@k
+    def evaluate_all_cutoffs(self, qrels, results, kmax):
+        return self.evaluate_context(batch_context([qrels], [results], kmax))[0]
 
 
 #
 # P@k.
-class Prec:
+class Prec(QueryMetric):
+    params = ('evec',)
+    __slots__ = ('evec',)
+
     #
     # evec      the effort vector
     def __init__(self, evec):
-        self.evec = evec
+        self.evec = tuple(evec)
 
     def evaluate(self, qrels, results, k):
         sum_gain, sum_effort, rank = 0.0, 0.0, 1
@@ -34,10 +490,26 @@ class Prec:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        return _cutoffs(_ratio(c.running('relevant'), c.running(('evec', self.evec))), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = _at_cutoff(c.running('relevant'), k)[..., np.newaxis]
+        return _cutoff_scores(_ratio(sum_gain, c.efforts(evecs, None, k)), c.kmax, k)
+
 
 #
 # Graded relevance P@k, where grade relevance is handled as the same as in graded average precision (GAP).
-class GradPrec:
+class GradPrec(QueryMetric):
+    params = ('evec', 'gs')
+    __slots__ = ('evec', 'gs', 'ggains')
+
     #
     # evec      the effort vector
     # gs        the probability that users will consider results with each relevance grade as relevant.
@@ -46,14 +518,15 @@ class GradPrec:
     #               0.4 probability to consider r>=1 as relevant
     #               0.6 probability to consider r>=2 as relevant
     def __init__(self, evec, gs):
-        self.evec = evec
-        self.gs = gs
+        self.evec = tuple(evec)
+        self.gs = tuple(gs)
+        self.ggains = tuple(graded_gains(gs))
 
     def evaluate(self, qrels, results, k):
         sum_gain, sum_effort, rank = 0.0, 0.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
-            gain = sum(self.gs[r] for r in range(0, rel + 1))
+            gain = self.ggains[rel + 1]
             effort = self.evec[rel]
             sum_gain += gain
             sum_effort += effort
@@ -64,6 +537,20 @@ class GradPrec:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running(('graded', self.gs))
+        return _cutoffs(_ratio(sum_gain, c.running(('evec', self.evec))), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = _at_cutoff(c.running(('graded', self.gs)), k)[..., np.newaxis]
+        return _cutoff_scores(_ratio(sum_gain, c.efforts(evecs, None, k)), c.kmax, k)
+
 
 #
 # DCG@k (the exponential gain version).
@@ -72,19 +559,25 @@ class GradPrec:
 # Kalervo Jarvelin and Jaana Kekalainen. 2000. IR evaluation methods for retrieving highly relevant documents.
 # In Proceedings of the 23rd annual international ACM SIGIR conference on Research and development in
 # information retrieval (SIGIR '00). ACM, New York, NY, USA, 41-48. DOI=http://dx.doi.org/10.1145/345508.345545
-class DCG:
+class DCG(QueryMetric):
+    params = ('evec',)
+    __slots__ = ('evec', 'discounts')
+
     #
     # evac      the effort vector
     def __init__(self, evec):
-        self.evec = evec
+        self.evec = tuple(evec)
+        self.discounts = dcg_discounts(0)
 
     def evaluate(self, qrels, results, k):
+        if len(self.discounts) < min(len(results), k):
+            self.discounts = dcg_discounts(min(len(results), k))
         sum_gain, sum_effort, rank = 0.0, 0.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
             gain = 2 ** rel - 1.0
             effort = self.evec[rel]
-            discount = math.log(2, rank + 1)
+            discount = self.discounts[rank - 1]
             sum_gain += gain * discount
             sum_effort += effort * discount
             rank += 1
@@ -94,6 +587,21 @@ class DCG:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running('exp_gain', 'dcg')
+        sum_effort = c.running(('evec', self.evec), 'dcg')
+        return _cutoffs(_ratio(sum_gain, sum_effort), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = _at_cutoff(c.running('exp_gain', 'dcg'), k)[..., np.newaxis]
+        return _cutoff_scores(_ratio(sum_gain, c.efforts(evecs, 'dcg', k)), c.kmax, k)
+
 
 #
 # nDCG@k (the exponential gain version).
@@ -101,21 +609,43 @@ class DCG:
 # [reference]
 # Kalervo Jarvelin and Jaana Kekalainen. 2002. Cumulated gain-based evaluation of IR techniques.
 # ACM Trans. Inf. Syst. 20, 4 (October 2002), 422-446. DOI=http://dx.doi.org/10.1145/582415.582418
-class NDCG:
+class NDCG(QueryMetric):
+    params = ('evec',)
+    __slots__ = ('evec', 'dcg')
+
     #
     # evac      the effort vector
     def __init__(self, evec):
-        self.evec = evec
+        self.evec = tuple(evec)
+        self.dcg = DCG(evec)
 
     def evaluate(self, qrels, results, k):
-        dcg = DCG(self.evec)
-        ideal_list = sorted(qrels, key=lambda key: qrels[key], reverse=True)
-        dcg_results = dcg.evaluate(qrels, results, k)
-        dcg_ideal = dcg.evaluate(qrels, ideal_list, k)
+        dcg_results = self.dcg.evaluate(qrels, results, k)
         if dcg_results == 0:
             return 0
+        sum_gain, sum_effort = ideal_cache.get(qrels, ('DCG', self.evec), self.ideal_prefix)
+        n = ideal_cutoff(k, qrels)
+        dcg_ideal = 0 if sum_gain[n] == 0 else sum_gain[n] / sum_effort[n]
         return dcg_results / dcg_ideal
 
+    #
+    # the ideal ranking's DCG gain and effort at every cutoff
+    def ideal_prefix(self, grades):
+        return discounted_prefix(grades, lambda rel: 2 ** rel - 1.0, lambda rel: self.evec[rel],
+                                 dcg_discounts(len(grades)))
+
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        return _ratio(self.dcg.evaluate_context(c), self.dcg.evaluate_context(c.ideal()))
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        return _ratio(self.dcg.evaluate_evecs(c, evecs, k), self.dcg.evaluate_evecs(c.ideal(), evecs, k))
+
 
 #
 # RBP.
@@ -123,15 +653,23 @@ class NDCG:
 # [reference]
 # Alistair Moffat and Justin Zobel. 2008. Rank-biased precision for measurement of retrieval effectiveness.
 # ACM Trans. Inf. Syst. 27, 1, Article 2 (December 2008), 27 pages. DOI=http://dx.doi.org/10.1145/1416950.1416952
-class RBP:
+class RBP(QueryMetric):
+    params = ('evec', 'pdown', 'tolerance')
+    __slots__ = ('evec', 'pdown', 'tolerance')
+
     #
     # evac      the effort vector
     # pdown     the probability to examine the next result
-    def __init__(self, evec, pdown):
-        self.evec = evec
+    # tolerance stop evaluating once the score can change by at most tolerance (see evaluate_residual), or None to
+    #           evaluate all the top k results; only evaluate reads it, the batch paths evaluate all the top k results
+    def __init__(self, evec, pdown, tolerance=None):
+        self.evec = tuple(evec)
         self.pdown = pdown
+        self.tolerance = tolerance
 
     def evaluate(self, qrels, results, k):
+        if self.tolerance is not None:
+            return self.evaluate_residual(qrels, results, k)[0]
         sum_gain, sum_effort, rank, pexam = 0.0, 0.0, 1, 1.0
         for doc in results:
             rel = qrels.get(doc, 0)
@@ -147,10 +685,47 @@ class RBP:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running('relevant', ('pexam', self.pdown))
+        sum_effort = c.running(('evec', self.evec), ('pexam', self.pdown))
+        return _cutoffs(_ratio(sum_gain, sum_effort), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = _at_cutoff(c.running('relevant', ('pexam', self.pdown)), k)[..., np.newaxis]
+        return _cutoff_scores(_ratio(sum_gain, c.efforts(evecs, ('pexam', self.pdown), k)), c.kmax, k)
+
+    #
+    # evaluate a ranked list, stopping once the score of the top k results can differ from the score of the results
+    # evaluated so far by at most tolerance. Returns (score, residual), where residual is the maximum difference.
+    def evaluate_residual(self, qrels, results, k):
+        n = min(len(results), max(k, 1))
+        sum_gain, sum_effort, pexam, residual = 0.0, 0.0, 1.0, 0.0
+        emin, emax = min(self.evec), max(self.evec)
+        for rank in xrange(0, n):
+            rel = qrels.get(results[rank], 0)
+            sum_gain += (rel > 0) * pexam
+            sum_effort += self.evec[rel] * pexam
+            pexam *= self.pdown
+            if self.tolerance is not None:
+                w = _geometric_tail(pexam, self.pdown, n - rank - 1)
+                residual = _ratio_residual(sum_gain, sum_effort, w, 1.0, emin, emax)
+                if residual <= self.tolerance:
+                    break
+        return (0 if sum_gain == 0 else sum_gain / sum_effort), residual
+
 
 #
 # A graded relevance variant for RBP. Graded relevance is handled in the same way as in graded average precision (GAP).
-class GRBP:
+class GRBP(QueryMetric):
+    params = ('evec', 'pdown', 'gs', 'tolerance')
+    __slots__ = ('evec', 'pdown', 'gs', 'tolerance', 'ggains')
+
     #
     # evac      the effort vector
     # pdown     the probability to examine the next result
@@ -159,16 +734,22 @@ class GRBP:
     #               0 probability to consider r>=0 as relevant
     #               0.4 probability to consider r>=1 as relevant
     #               0.6 probability to consider r>=2 as relevant
-    def __init__(self, evec, pdown, gs):
-        self.evec = evec
+    # tolerance stop evaluating once the score can change by at most tolerance (see evaluate_residual), or None to
+    #           evaluate all the top k results; only evaluate reads it, the batch paths evaluate all the top k results
+    def __init__(self, evec, pdown, gs, tolerance=None):
+        self.evec = tuple(evec)
         self.pdown = pdown
-        self.gs = gs
+        self.gs = tuple(gs)
+        self.ggains = tuple(graded_gains(gs))
+        self.tolerance = tolerance
 
     def evaluate(self, qrels, results, k):
+        if self.tolerance is not None:
+            return self.evaluate_residual(qrels, results, k)[0]
         sum_gain, sum_effort, rank, pexam = 0.0, 0.0, 1, 1.0
         for doc in results:
             rel = qrels.get(doc, 0)
-            gain = sum(self.gs[r] for r in range(0, rel + 1))
+            gain = self.ggains[rel + 1]
             effort = self.evec[rel]
             sum_gain += gain * pexam
             sum_effort += effort * pexam
@@ -180,14 +761,51 @@ class GRBP:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running(('graded', self.gs), ('pexam', self.pdown))
+        sum_effort = c.running(('evec', self.evec), ('pexam', self.pdown))
+        return _cutoffs(_ratio(sum_gain, sum_effort), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = _at_cutoff(c.running(('graded', self.gs), ('pexam', self.pdown)), k)[..., np.newaxis]
+        return _cutoff_scores(_ratio(sum_gain, c.efforts(evecs, ('pexam', self.pdown), k)), c.kmax, k)
+
+    #
+    # evaluate a ranked list, stopping once the score of the top k results can differ from the score of the results
+    # evaluated so far by at most tolerance. Returns (score, residual), where residual is the maximum difference.
+    def evaluate_residual(self, qrels, results, k):
+        n = min(len(results), max(k, 1))
+        sum_gain, sum_effort, pexam, residual = 0.0, 0.0, 1.0, 0.0
+        gmax, emin, emax = max(self.ggains), min(self.evec), max(self.evec)
+        for rank in xrange(0, n):
+            rel = qrels.get(results[rank], 0)
+            sum_gain += self.ggains[rel + 1] * pexam
+            sum_effort += self.evec[rel] * pexam
+            pexam *= self.pdown
+            if self.tolerance is not None:
+                w = _geometric_tail(pexam, self.pdown, n - rank - 1)
+                residual = _ratio_residual(sum_gain, sum_effort, w, gmax, emin, emax)
+                if residual <= self.tolerance:
+                    break
+        return (0 if sum_gain == 0 else sum_gain / sum_effort), residual
+
 
 #
 # Average precision.
-class AvgPrec:
+class AvgPrec(QueryMetric):
+    params = ('evec',)
+    __slots__ = ('evec',)
+
     #
     # evac      the effort vector
     def __init__(self, evec):
-        self.evec = evec
+        self.evec = tuple(evec)
 
     def evaluate(self, qrels, results, k):
         sum_prec, sum_gain, sum_effort, rank = 0.0, 0.0, 0.0, 1
@@ -207,6 +825,27 @@ class AvgPrec:
         numrel = sum(rel > 0 for rel in qrels.itervalues())
         return sum_prec / numrel
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running('relevant')
+        sum_effort = c.running(('evec', self.evec))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_prec = _prefix(np.where(c.values('relevant') > 0, sum_gain / sum_effort, 0.0))
+        return _cutoffs(_ratio(sum_prec, c.numrel()[:, np.newaxis]), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = c.running('relevant')[:, :, np.newaxis]
+        relevant = c.values('relevant')[:, :, np.newaxis] > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_prec = _prefix(np.where(relevant, sum_gain / c.efforts(evecs), 0.0))
+        scores = _cutoffs(_ratio(sum_prec, c.numrel()[:, np.newaxis, np.newaxis]), c.kmax)
+        return scores if k is None else scores[:, k - 1]
+
 
 #
 # Graded average precision.
@@ -216,7 +855,10 @@ class AvgPrec:
 # Extending average precision to graded relevance judgments.
 # In Proceedings of the 33rd international ACM SIGIR conference on Research and development in
 # information retrieval (SIGIR '10). ACM, New York, NY, USA, 603-610. DOI=http://dx.doi.org/10.1145/1835449.1835550
-class GradAvgPrec:
+class GradAvgPrec(QueryMetric):
+    params = ('evec', 'gs')
+    __slots__ = ('evec', 'gs', 'ggains')
+
     #
     # evac      the effort vector
     # gs        relevance threshold probability
@@ -225,14 +867,15 @@ class GradAvgPrec:
     #               0.4 probability to consider r>=1 as relevant
     #               0.6 probability to consider r>=2 as relevant
     def __init__(self, evec, gs):
-        self.evec = evec
-        self.gs = gs
+        self.evec = tuple(evec)
+        self.gs = tuple(gs)
+        self.ggains = tuple(graded_gains(gs))
 
     def evaluate(self, qrels, results, k):
         sum_prec, sum_gain, sum_effort, rank = 0.0, 0.0, 0.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
-            gain = sum(self.gs[r] for r in range(0, rel + 1))
+            gain = self.ggains[rel + 1]
             effort = self.evec[rel]
             sum_gain += gain
             sum_effort += effort
@@ -243,23 +886,41 @@ class GradAvgPrec:
                 break
         if sum_prec == 0:
             return 0
-        enumrel = 0.0
-        for rel in qrels.values():
-            erel = 0.0
-            for r in range(0, rel + 1):
-                erel += self.gs[r]
-            enumrel += erel
-        enumrel = sum(sum(self.gs[r] for r in range(0, rel + 1)) for rel in qrels.itervalues())
+        enumrel = sum(self.ggains[rel + 1] for rel in qrels.itervalues())
         return sum_prec / enumrel
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        sum_gain = c.running(('graded', self.gs))
+        sum_effort = c.running(('evec', self.evec))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_prec = _prefix(np.where(c.values('relevant') > 0, sum_gain / sum_effort, 0.0))
+        return _cutoffs(_ratio(sum_prec, c.enumrel(self.gs)[:, np.newaxis]), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        sum_gain = c.running(('graded', self.gs))[:, :, np.newaxis]
+        relevant = c.values('relevant')[:, :, np.newaxis] > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_prec = _prefix(np.where(relevant, sum_gain / c.efforts(evecs), 0.0))
+        scores = _cutoffs(_ratio(sum_prec, c.enumrel(self.gs)[:, np.newaxis, np.newaxis]), c.kmax)
+        return scores if k is None else scores[:, k - 1]
+
 
 #
 # Reciprocal rank.
-class RR:
+class RR(QueryMetric):
+    params = ('evec',)
+    __slots__ = ('evec',)
+
     #
     # evac      the effort vector
     def __init__(self, evec):
-        self.evec = evec
+        self.evec = tuple(evec)
 
     def evaluate(self, qrels, results, k):
         sum_gain, sum_effort, rank = 0.0, 0.0, 1
@@ -278,6 +939,35 @@ class RR:
             return 0
         return sum_gain / sum_effort
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        relevant = c.values('relevant') > 0
+        found = relevant.any(axis=1)
+        first = np.argmax(relevant, axis=1)
+        sum_effort = c.running(('evec', self.evec))
+        rr = np.zeros(relevant.shape[0])
+        rr[found] = 1.0 / sum_effort[found, first[found]]
+        # the reciprocal rank is counted from the first relevant result's rank on
+        ranks = np.arange(0, c.kmax)[np.newaxis, :]
+        return np.where(found[:, np.newaxis] & (ranks >= first[:, np.newaxis]), rr[:, np.newaxis], 0.0)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        relevant = c.values('relevant') > 0
+        found = relevant.any(axis=1)
+        first = np.argmax(relevant, axis=1)
+        sum_effort = c.efforts(evecs)
+        rr = np.zeros((relevant.shape[0], sum_effort.shape[2]))
+        rr[found] = 1.0 / sum_effort[found, first[found]]
+        ranks = np.arange(0, c.kmax)[np.newaxis, :]
+        counted = found[:, np.newaxis] & (ranks >= first[:, np.newaxis])
+        scores = np.where(counted[:, :, np.newaxis], rr[:, np.newaxis, :], 0.0)
+        return scores if k is None else scores[:, k - 1]
+
 
 #
 # ERR.
@@ -287,15 +977,23 @@ class RR:
 # 2009. Expected reciprocal rank for graded relevance.
 # In Proceedings of the 18th ACM conference on Information and knowledge management (CIKM '09).
 # ACM, New York, NY, USA, 621-630. DOI=http://dx.doi.org/10.1145/1645953.1646033
-class ERR:
+class ERR(QueryMetric):
+    params = ('evec', 'rmax', 'tolerance')
+    __slots__ = ('evec', 'rmax', 'tolerance')
+
     #
     # evac      the effort vector
     # rmax      the maximum possible relevance grade
-    def __init__(self, evec, rmax):
-        self.evec = evec
+    # tolerance stop evaluating once the score can change by at most tolerance (see evaluate_residual), or None to
+    #           evaluate all the top k results; only evaluate reads it, the batch paths evaluate all the top k results
+    def __init__(self, evec, rmax, tolerance=None):
+        self.evec = tuple(evec)
         self.rmax = rmax
+        self.tolerance = tolerance
 
     def evaluate(self, qrels, results, k):
+        if self.tolerance is not None:
+            return self.evaluate_residual(qrels, results, k)[0]
         sum_utility, sum_effort, pexamine, rank = 0.0, 0.0, 1.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
@@ -310,6 +1008,59 @@ class ERR:
                 break
         return sum_utility
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        pstop = c.values('exp_gain') / (2 ** self.rmax)
+        sum_effort = c.running(('evec', self.evec))
+        pexamine = _exclusive_product(1 - pstop)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            utility = pexamine * pstop * 1.0 / sum_effort
+        return _cutoffs(_prefix(np.where(pstop > 0, utility, 0.0)), c.kmax)
+
+    #
+    # evaluate a batch context by each effort vector (a row of evecs) in place of evec at once, where scores[i, j, e]
+    # is the i-th ranked list's score at cutoff j + 1 by the e-th effort vector, or scores[i, e] its score at cutoff
+    # k (at most c.kmax) if k is set
+    def evaluate_evecs(self, c, evecs, k=None):
+        pstop = c.values('exp_gain') / (2 ** self.rmax)
+        pexamine = _exclusive_product(1 - pstop)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            utility = (pexamine * pstop)[:, :, np.newaxis] * 1.0 / c.efforts(evecs)
+        scores = _cutoffs(_prefix(np.where(pstop[:, :, np.newaxis] > 0, utility, 0.0)), c.kmax)
+        return scores if k is None else scores[:, k - 1]
+
+    #
+    # evaluate a ranked list, stopping once the score of the top k results can differ from the score of the results
+    # evaluated so far by at most tolerance. Returns (score, residual), where residual is the maximum difference.
+    def evaluate_residual(self, qrels, results, k):
+        n = min(len(results), max(k, 1))
+        sum_utility, sum_effort, pexamine, residual = 0.0, 0.0, 1.0, 0.0
+        # the remaining results' utility is at most the probability to stop at any of them over the least total effort,
+        # where negative grades (pstop < 0) increase the examination probability by up to a factor of growth
+        pmax, emin = (2 ** self.rmax - 1.0) / (2 ** self.rmax), min(self.evec)
+        growth = 1 - (2 ** min(min(qrels.itervalues()) if qrels else 0, 0) - 1.0) / (2 ** self.rmax)
+        for rank in xrange(0, n):
+            rel = qrels.get(results[rank], 0)
+            pstop = (2 ** rel - 1.0) / (2 ** self.rmax)
+            sum_effort += self.evec[rel]
+            if pstop > 0:
+                sum_utility += pexamine * pstop * 1.0 / sum_effort
+            pexamine *= 1 - pstop
+            if self.tolerance is not None:
+                m = n - rank - 1
+                if m == 0 or pexamine == 0:
+                    residual = 0.0
+                elif sum_effort + emin == 0:
+                    residual = float('inf')
+                elif growth > 1:
+                    residual = pmax * _geometric_tail(pexamine, growth, m) / (sum_effort + emin)
+                else:
+                    residual = pexamine * (1 - (1 - pmax) ** m) / (sum_effort + emin)
+                if residual <= self.tolerance:
+                    break
+        return sum_utility, residual
+
 
 #
 # A variant of time-biased gain using result relevance (instead of length) to estimate time.
@@ -318,31 +1069,65 @@ class ERR:
 # Mark D. Smucker and Charles L.A. Clarke. 2012. Time-based calibration of effectiveness measures.
 # In Proceedings of the 35th international ACM SIGIR conference on Research and development in
 # information retrieval (SIGIR '12). ACM, New York, NY, USA, 95-104. DOI=http://dx.doi.org/10.1145/2348283.2348300
-class TBG:
+class TBG(QueryMetric):
+    params = ('time', 'pclick', 'psave', 'h', 'tolerance')
+    __slots__ = ('time', 'pclick', 'psave', 'h', 'tolerance', 'decay')
+
     #
     # time      the expected time spent on results with each relevance grade
     # pclick    the probability to click on results with each relevance grade
     # psave     the probability to save results with each relevance grade after clicking
     # h         the parameter h
-    def __init__(self, time, pclick, psave, h):
-        self.time = time
-        self.pclick = pclick
-        self.psave = psave
+    # tolerance stop evaluating once the score can change by at most tolerance (see evaluate_residual), or None to
+    #           evaluate all the top k results; only evaluate reads it, the batch paths evaluate all the top k results
+    def __init__(self, time, pclick, psave, h, tolerance=None):
+        self.time = tuple(time)
+        self.pclick = tuple(pclick)
+        self.psave = tuple(psave)
         self.h = h
+        self.tolerance = tolerance
+        # discount = exp(-arrive_time * log(2) / h) is updated by multiplying the decay of each examined result
+        self.decay = tuple(math.exp(-t * math.log(2, math.e) / h) for t in time)
 
     def evaluate(self, qrels, results, k):
-        tbg, arrive_time, rank = 0.0, 0.0, 1
+        if self.tolerance is not None:
+            return self.evaluate_residual(qrels, results, k)[0]
+        tbg, discount, rank = 0.0, 1.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
             gain = self.pclick[rel] * self.psave[rel]
-            discount = math.exp(-arrive_time * math.log(2, math.e) / self.h)
             tbg += gain * discount
-            arrive_time += self.time[rel]
+            discount *= self.decay[rel]
             rank += 1
             if rank > k:
                 break
         return tbg
 
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        gain = c.values(('pclick', self.pclick)) * c.values(('psave', self.psave))
+        arrive_time = _exclusive(c.running(('time', self.time)))
+        discount = np.exp(-arrive_time * math.log(2, math.e) / self.h)
+        return _cutoffs(_prefix(gain * discount), c.kmax)
+
+    #
+    # evaluate a ranked list, stopping once the score of the top k results can differ from the score of the results
+    # evaluated so far by at most tolerance. Returns (score, residual), where residual is the maximum difference.
+    def evaluate_residual(self, qrels, results, k):
+        n = min(len(results), max(k, 1))
+        tbg, discount, residual = 0.0, 1.0, 0.0
+        gmax = max(self.pclick[rel] * self.psave[rel] for rel in xrange(0, len(self.time)))
+        for rank in xrange(0, n):
+            rel = qrels.get(results[rank], 0)
+            tbg += self.pclick[rel] * self.psave[rel] * discount
+            discount *= self.decay[rel]
+            if self.tolerance is not None:
+                residual = gmax * _geometric_tail(discount, max(self.decay), n - rank - 1)
+                if residual <= self.tolerance:
+                    break
+        return tbg, residual
+
 
 #
 # A variant of U-measure based on time spent (instead of the number of examined characters).
@@ -352,14 +1137,17 @@ class TBG:
 # a unified framework for information access evaluation. In Proceedings of the 36th international ACM
 # SIGIR conference on Research and development in information retrieval (SIGIR '13).
 # ACM, New York, NY, USA, 473-482. DOI=http://dx.doi.org/10.1145/2484028.2484031
-class UMeasure:
+class UMeasure(QueryMetric):
+    params = ('rmax', 'time', 'T')
+    __slots__ = ('rmax', 'time', 'T')
+
     #
     # time      the expected time spent on results with each relevance grade
     # gain      the gain value for results with each relevance grade
     # T
     def __init__(self, rmax, time, T):
         self.rmax = rmax
-        self.time = time
+        self.time = tuple(time)
         self.T = T
 
     def evaluate(self, qrels, results, k):
@@ -376,3 +1164,11 @@ class UMeasure:
             if rank > k:
                 break
         return sum_gain
+
+    #
+    # evaluate a batch context (see BatchContext) at every cutoff k = 1, 2, ..., c.kmax at once
+    def evaluate_context(self, c):
+        gain = c.values('exp_gain') / 2 ** self.rmax
+        arrive_time = c.running(('time', self.time))
+        discount = np.maximum(1 - arrive_time / self.T, 0)
+        return _cutoffs(_prefix(gain * discount), c.kmax)
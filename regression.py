@@ -0,0 +1,497 @@
+#
+# Regression checks of the parts that are hard to get right by inspection alone, each against a naive reference
+# implementation (or the metrics' scalar evaluate) on small synthetic inputs, e.g.,
+#
+#   python regression.py
+#   python regression.py trec_run trec_qrels
+#
+# Each check raises an AssertionError (with the first mismatch) if it fails, and fails as well if it raises any other
+# error; the script exits with status 1 if any check fails.
+#
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+import numpy as np
+
+import dataset
+import profiling
+import result_store
+import sweep
+import utils
+from dataset import *
+from ir_metrics import parse_metric
+from query_metrics import *
+from server import MicroBatcher
+from session_metrics import *
+
+
+#
+# Write synthetic TREC lines with ties, blank lines, and mixed whitespace, and without a final newline.
+#
+# numqids       the number of qids, each a session's query ('12.3') or a session of a single query ('12')
+# numlines      the number of lines of each qid
+# columns       build the columns of a line from its qid and random
+def write_trec(path, numqids, numlines, columns, seed):
+    rnd = random.Random(seed)
+    qids = ['%d.%d' % (rnd.randint(1, 9), rnd.randint(1, 4)) for _ in xrange(0, numqids - 1)] + ['77']
+    lines = [columns(qid, rnd) for qid in qids for _ in xrange(0, numlines)]
+    rnd.shuffle(lines)
+    with open(path, 'w') as f:
+        for i, line in enumerate(lines):
+            f.write((' ' if i % 5 == 0 else '\t').join(line))
+            if i < len(lines) - 1:
+                f.write('\n' if i % 7 != 3 else '\n\n  \n')
+    f.close()
+
+
+def _run_columns(qid, rnd):
+    # scores from a few values, so that many results are tied
+    return [qid, 'Q0', 'doc%d' % rnd.randint(0, 40), '0', '%.1f' % rnd.randint(0, 3), 'tag']
+
+
+def _qrels_columns(qid, rnd):
+    return [qid, '0', 'doc%d' % rnd.randint(0, 40), str(rnd.randint(-1, 3))]
+
+
+#
+# The naive parsers: line by line, sorted by (score, docid) in descending order as trec_eval does.
+def naive_trec_run(path):
+    queries = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            splits = line.split()
+            if len(splits) > 0:
+                queries.setdefault(splits[0], []).append((float(splits[4]), splits[2]))
+    f.close()
+    results = dict()
+    for qid, scored in queries.items():
+        sessid, qno = qid.split('.') if '.' in qid else (qid, '1')
+        results.setdefault(int(sessid), dict())[int(qno)] = [doc for _, doc in sorted(scored, reverse=True)]
+    return dict((sessid, [queries[qno] for qno in sorted(queries)]) for sessid, queries in results.items())
+
+
+def naive_trec_qrels(path):
+    qrels = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            splits = line.split()
+            if len(splits) > 0:
+                sessid = int(splits[0].split('.')[0])
+                qrels.setdefault(sessid, dict())[splits[2]] = int(splits[3])
+    f.close()
+    return qrels
+
+
+# the chunk sizes checked: chunks that end mid-line, lines longer than a chunk, and the whole file at once
+CHUNK_SIZES = [1, 7, 50, 333, 4096, 1 << 24]
+
+
+def check_trec_run(directory):
+    path = os.path.join(directory, 'run')
+    for seed in xrange(0, 5):
+        write_trec(path, 12, 30, _run_columns, seed)
+        expected = naive_trec_run(path)
+        for chunk_size in CHUNK_SIZES:
+            results = load_trec_run(path, chunk_size=chunk_size)
+            assert results == expected, 'load_trec_run (seed %d, chunk_size %d) differs from the naive parser' % (
+                seed, chunk_size)
+
+
+def check_trec_qrels(directory):
+    path = os.path.join(directory, 'qrels')
+    for seed in xrange(0, 5):
+        write_trec(path, 12, 30, _qrels_columns, seed)
+        expected = naive_trec_qrels(path)
+        for chunk_size in CHUNK_SIZES:
+            qrels = load_trec_qrels(path, chunk_size=chunk_size)
+            assert qrels == expected, 'load_trec_qrels (seed %d, chunk_size %d) differs from the naive parser' % (
+                seed, chunk_size)
+
+
+def check_trec_malformed(directory):
+    path = os.path.join(directory, 'run')
+    with open(path, 'w') as f:
+        f.write('1.1 Q0 a 1 2.0 tag\n\n1.1 Q0 b 2 1.0 tag\n1.2 Q0 c 1 1.0\n1.2 Q0 d 2 0.5 tag\n')
+    f.close()
+    for chunk_size in CHUNK_SIZES:
+        try:
+            load_trec_run(path, chunk_size=chunk_size)
+        except ValueError as e:
+            assert str(e) == '%s:4: expected 6 columns, found 5' % path, 'chunk_size %d: %s' % (chunk_size, e)
+        else:
+            raise AssertionError('chunk_size %d: a malformed line is not reported' % chunk_size)
+
+
+#
+# Synthetic qrels of a few sessions, and documents to look up (judged in their own session, judged in another
+# session only, or unjudged).
+def synthetic_qrels(seed):
+    rnd = random.Random(seed)
+    qrels = dict()
+    for sessid in xrange(1, 8):
+        qrels[sessid] = dict(('u%d' % rnd.randint(0, 60), rnd.randint(-1, 3)) for _ in xrange(0, rnd.randint(1, 20)))
+    qrels[9] = dict()
+    lookups = [(sessid, 'u%d' % rnd.randint(0, 70)) for _ in xrange(0, 500) for sessid in [rnd.randint(0, 10)]]
+    return qrels, lookups
+
+
+#
+# QrelsIndex's lookups against the qrels dicts, with the keys forced to collide: mix(sessions, hashes) replaces
+# dataset._mix_keys during the check.
+def check_qrels_index_with(mix):
+    original = dataset._mix_keys
+    dataset._mix_keys = mix
+    try:
+        for seed in xrange(0, 5):
+            qrels, lookups = synthetic_qrels(seed)
+            index = QrelsIndex(qrels)
+            sessions = [index.index.get(sessid, 0) for sessid, _ in lookups]
+            urls = [url for _, url in lookups]
+            grades = index.lookup(sessions, urls).tolist()
+            expected = [qrels[index.sessids[i]].get(url, 0) for i, url in zip(sessions, urls)]
+            assert grades == expected, 'lookup (seed %d) differs from the qrels dicts' % seed
+            for sessid in xrange(0, 11):
+                surls = [url for s, url in lookups if s == sessid]
+                assert index.session_grades(sessid, surls).tolist() == [qrels.get(sessid, {}).get(url, 0)
+                                                                         for url in surls], (seed, sessid)
+                assert index.get(sessid) == qrels.get(sessid), (seed, sessid)
+                assert (sessid in index) == (sessid in qrels), (seed, sessid)
+    finally:
+        dataset._mix_keys = original
+
+
+def check_qrels_index(directory):
+    check_qrels_index_with(dataset._mix_keys)
+
+
+def check_qrels_index_collisions(directory):
+    # every key collides
+    check_qrels_index_with(lambda sessions, hashes: np.zeros(len(hashes), dtype=np.uint64))
+    # the keys of different sessions and URLs collide in a few groups
+    check_qrels_index_with(lambda sessions, hashes: (hashes.astype(np.int64) % 3).astype(np.uint64))
+
+
+#
+# Synthetic sessions of a few queries each (some without results) and their qrels.
+def synthetic_sessions(seed):
+    rnd = random.Random(seed)
+    sresults, sqrels = dict(), dict()
+    for sessid in xrange(1, 7):
+        sqrels[sessid] = dict(('u%d' % rnd.randint(0, 30), rnd.randint(-1, 2)) for _ in xrange(0, rnd.randint(1, 12)))
+        sresults[sessid] = [['u%d' % rnd.randint(0, 40) for _ in xrange(0, rnd.choice([0, 3, 8, 15]))]
+                            for _ in xrange(0, rnd.randint(1, 4))]
+    return sresults, sqrels
+
+
+#
+# esnDCG's exact method against sampling: evaluate_vectorized with a large N, and the original sampling (python's
+# random module) with a smaller one; and evaluate_run_exact against evaluate_exact.
+def check_esndcg_exact(directory):
+    sresults, sqrels = synthetic_sessions(0)
+    run = CompiledRun(sresults, sqrels)
+    for pref, pdown, path_discount in [(0.8, 0.7, True), (0.5, 0.9, False), (1.0, 0.3, True), (0.3, 1.0, True)]:
+        for k in (1, 5, 10):
+            exact = ESNDCG(pref, pdown, path_discount, method='exact')
+            vectorized = ESNDCG(pref, pdown, path_discount, N=200000, method='vectorized', seed=k)
+            sample = ESNDCG(pref, pdown, path_discount, N=20000, method='sample')
+            random.seed(k)
+            config = (pref, pdown, path_discount, k)
+            scores = exact.evaluate_run(run, k).tolist()
+            for i, sessid in enumerate(run.sessids):
+                score = exact.evaluate(sqrels[sessid], sresults[sessid], k)
+                assert abs(scores[i] - score) < 1e-12, ('evaluate_run_exact', config, sessid, scores[i], score)
+                # the scores are in [0, 1]: the standard errors are at most 0.0012 and 0.0036
+                estimate = vectorized.evaluate(sqrels[sessid], sresults[sessid], k)
+                assert abs(estimate - score) < 0.01, ('vectorized', config, sessid, estimate, score)
+                estimate = sample.evaluate(sqrels[sessid], sresults[sessid], k)
+                assert abs(estimate - score) < 0.03, ('sample', config, sessid, estimate, score)
+
+
+#
+# The session metrics of the checks below: query metrics aggregated by SQMetric, and session metrics.
+def session_metrics(aggfunc=np.mean):
+    evec = [0.25, 1, 1]
+    qmetrics = [Prec(evec), DCG(evec), NDCG(evec), RBP(evec, 0.8), GRBP(evec, 0.6, [0, 0.4, 0.6]), AvgPrec(evec),
+                RR(evec), ERR(evec, 2), TBG([9.8, 23.0, 37.6], [0.26, 0.5, 0.55], [0, 0.2, 0.8], 31)]
+    return [SQMetric(qmetric, aggfunc) for qmetric in qmetrics] + [
+        SDCG(2, 4, True), NSDCG(2, 4, False), SDCGQ(2, 4, True), ESNDCG(0.8, 0.7, True, method='exact')]
+
+
+#
+# The scalar scores of each metric (a row) for each session of a compiled run (a column).
+def scalar_scores(metrics, sresults, sqrels, run, k):
+    return np.array([[metric.evaluate(sqrels[sessid], sresults[sessid], k) for sessid in run.sessids]
+                     for metric in metrics])
+
+
+def _close(scores, expected):
+    return np.allclose(scores, expected, rtol=0, atol=1e-12, equal_nan=True)
+
+
+#
+# The batch paths (evaluate_run, MetricSuite) with profiling enabled, against the scalar path without it; and the
+# documents counted for evaluate_run.
+def check_profiling(directory):
+    sresults, sqrels = synthetic_sessions(1)
+    run, metrics, k = CompiledRun(sresults, sqrels), session_metrics(), 5
+    expected = scalar_scores(metrics, sresults, sqrels, run, k)
+    profiling.reset()
+    profiling.enable()
+    try:
+        scores = np.array([metric.evaluate_run(run, k) for metric in metrics])
+        suite = np.array(MetricSuite(metrics).evaluate_run(run, k))
+        profiled = scalar_scores(metrics, sresults, sqrels, run, k)
+        counters = dict(profiling.counters)
+    finally:
+        profiling.disable()
+        profiling.reset()
+    assert _close(scores, expected), 'evaluate_run with profiling differs from evaluate'
+    assert _close(suite, expected), 'MetricSuite.evaluate_run with profiling differs from evaluate'
+    assert _close(profiled, expected), 'evaluate with profiling differs from evaluate without it'
+    documents = sum(min(len(results), k) for sessid in run.sessids for results in sresults[sessid])
+    calls, _, counted = counters['metric.SDCG.evaluate_run']
+    assert counted == calls * documents, ('documents of SDCG.evaluate_run', counted, calls, documents)
+
+
+#
+# Write synthetic sessions in the format of load_results and load_qrels; a query without results is a line of three
+# columns.
+def write_dataset(directory, sresults, sqrels):
+    results_path, qrels_path = os.path.join(directory, 'results'), os.path.join(directory, 'qrels')
+    with open(results_path, 'w') as f:
+        f.write('SessionID\tQueryID\tRank\tURL\tTitle\tSnippet\n')
+        for sessid in sorted(sresults):
+            for qix, results in enumerate(sresults[sessid]):
+                if len(results) == 0:
+                    f.write('%d\t%d\tx\n' % (sessid, qix + 1))
+                for rank, url in enumerate(results):
+                    f.write('%d\t%d\t%d\t%s\t-\t-\n' % (sessid, qix + 1, rank + 1, url))
+    f.close()
+    with open(qrels_path, 'w') as f:
+        f.write('SessionID\tURL\tRelevance\n')
+        for sessid in sorted(sqrels):
+            for url, grade in sorted(sqrels[sessid].items()):
+                f.write('%d\t%s\t%d\n' % (sessid, url, grade))
+    f.close()
+    return results_path, qrels_path
+
+
+#
+# The eval command, serially and with --jobs, against the specs' scalar evaluate (the output is rounded to 6 digits).
+def check_cli(directory):
+    sresults, sqrels = synthetic_sessions(2)
+    results_path, qrels_path = write_dataset(directory, sresults, sqrels)
+    specs = ['p', 'ndcg', 'rbp:pdown=0.6', 'err:agg=max', 'tbg', 'sdcg:b=2,bq=4', 'esndcg:pref=0.7,pdown=0.8']
+    k = 5
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ir_metrics.py'), 'eval',
+               results_path, qrels_path, '-k', str(k)] + [arg for spec in specs for arg in ('-m', spec)]
+    serial = subprocess.check_output(command)
+    parallel = subprocess.check_output(command + ['--jobs', '2', '--chunksize', '1'])
+    assert parallel == serial, 'eval --jobs 2 differs from the serial output'
+    rows = [line.split('\t') for line in serial.splitlines()[1:]]
+    # a query metric's rows are its queries' and sessions' scores, a session metric's only its sessions' scores
+    numqueries = sum(len(queries) for queries in sresults.values())
+    assert len(rows) == sum(1 + len(sresults) + (numqueries if isinstance(parse_metric(spec), SQMetric) else 0)
+                            for spec in specs), len(rows)
+    for sessid, query, spec, score in rows:
+        metric = parse_metric(spec)
+        if sessid == 'all':
+            expected = np.mean([metric.evaluate(sqrels[s], sresults[s], k) for s in sresults])
+        elif query == 'all':
+            expected = metric.evaluate(sqrels[int(sessid)], sresults[int(sessid)], k)
+        else:
+            expected = metric.qmetric.evaluate(sqrels[int(sessid)], sresults[int(sessid)][int(query) - 1], k)
+        assert abs(float(score) - expected) <= 5e-7, (sessid, query, spec, score, expected)
+
+
+#
+# The server's micro-batches (of requests with different k, including a k far beyond any list) against the query
+# metrics' scalar evaluate.
+def check_server(directory):
+    sresults, sqrels = synthetic_sessions(3)
+    specs = ['p', 'ndcg', 'rbp:pdown=0.6', 'grbp', 'ap', 'rr', 'err', 'tbg']
+    batcher = MicroBatcher(specs, k=5, max_batch=8, max_delay=0.01)
+    try:
+        requests = [{'qrels': sqrels[sessid], 'results': results, 'k': k}
+                    for sessid in sorted(sresults) for results in sresults[sessid] for k in (1, 4, 10 ** 7)]
+        requests.append({'qrels': sqrels[1], 'results': sresults[1][0]})
+        replies = batcher.evaluate(requests)
+        for request, scores in zip(requests, replies):
+            for spec in specs:
+                expected = batcher.metric(spec).evaluate(request['qrels'], request['results'], request.get('k', 5))
+                assert abs(scores[spec] - expected) < 1e-12, (spec, request, scores[spec], expected)
+        for request in [{'qrels': {'u1': 5}, 'results': ['u1']}, {'results': ['u1'], 'k': 0}]:
+            try:
+                batcher.submit(request)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('an invalid request is accepted: %r' % (request,))
+    finally:
+        batcher.close()
+
+
+#
+# Scores served by the result store (in memory, then from its files) against the scores evaluated without it; and a
+# change of the code's fingerprint invalidates them.
+def check_result_store(directory):
+    sresults, sqrels = synthetic_sessions(4)
+    # the scores of SQMetric are stored
+    metrics, k = [m for m in session_metrics() if isinstance(m, SQMetric)], 5
+    sessids = sorted(sresults)
+    expected = np.array([[m.evaluate(sqrels[s], sresults[s], k) for s in sessids] for m in metrics])
+    path = os.path.join(directory, 'store')
+    hashes = dict(result_store._module_hashes)
+    try:
+        for _ in xrange(0, 2):
+            result_store.use_store(path)
+            for _ in xrange(0, 2):
+                scores = np.array([[m.evaluate(sqrels[s], sresults[s], k) for s in sessids] for m in metrics])
+                assert _close(scores, expected), 'the stored scores differ from the evaluated ones'
+            result_store.store.flush()
+        store = result_store.use_store(path)
+        for metric in metrics:
+            config = result_store.metric_config(metric)
+            for s in sessids:
+                assert store.get(config, store.session(sqrels[s], sresults[s]), k) is not None, (config, s)
+        result_store._module_hashes['query_metrics'] = 'changed'
+        config = result_store.metric_config(metrics[0])
+        assert store.get(config, store.session(sqrels[1], sresults[1]), k) is None, 'a stale score is served'
+    finally:
+        result_store._module_hashes.clear()
+        result_store._module_hashes.update(hashes)
+        result_store.store = None
+
+
+#
+# A parameter sweep, in this process and in worker processes, against the correlations of the scalar scores.
+def check_sweep(directory):
+    sresults, sqrels = synthetic_sessions(5)
+    run, k = CompiledRun(sresults, sqrels), 5
+    rnd = random.Random(5)
+    sratings = dict((sessid, {'performance': rnd.randint(1, 5)}) for sessid in run.sessids)
+    grid = {'evec': [(0.25, 1, 1), (1, 1, 1)], 'pdown': [0.3, 0.6, 0.9]}
+    serial = sweep.sweep(RBP, grid, run, sratings, 'performance', k, aggfunc=np.mean, processes=1)
+    parallel = sweep.sweep(RBP, grid, run, sratings, 'performance', k, aggfunc=np.mean, processes=2)
+    assert serial == parallel, 'sweep in worker processes differs from the serial sweep'
+    assert len(serial) == 6, len(serial)
+    ratings = [sratings[sessid]['performance'] for sessid in run.sessids]
+    for row in serial:
+        metric = SQMetric(RBP(**row[0]), np.mean)
+        sevals = [metric.evaluate(sqrels[sessid], sresults[sessid], k) for sessid in run.sessids]
+        assert abs(row[1] - np.corrcoef(ratings, sevals)[0, 1]) < 1e-9, row
+    assert [row[1] for row in serial] == sorted([row[1] for row in serial], reverse=True), 'not ranked by pearson'
+
+
+#
+# evaluate_parallel on a shared run (and a run attached to it in this process) against the scalar scores.
+def check_parallel(directory):
+    sresults, sqrels = synthetic_sessions(10)
+    run, metrics, k = CompiledRun(sresults, sqrels), session_metrics(), 5
+    expected = scalar_scores(metrics, sresults, sqrels, run, k)
+    shared = SharedRun(run, path=os.path.join(directory, 'shared'))
+    try:
+        scores = np.array(utils.evaluate_parallel(metrics, shared, k, processes=2))
+        assert _close(scores, expected), 'evaluate_parallel differs from evaluate'
+        attached, _ = attach_shared(shared.path)
+        assert attached.sessids == run.sessids, 'the attached run has other sessions'
+        scores = np.array([metric.evaluate_run(attached, k) for metric in metrics])
+        assert _close(scores, expected), 'evaluate_run on an attached run differs from evaluate'
+    finally:
+        shared.unlink()
+
+
+#
+# The incremental API (start, update, value) after each query against evaluate on the queries so far; sampled esnDCG
+# with the same random numbers as evaluate, and against the exact method.
+def check_incremental(directory):
+    sresults, sqrels = synthetic_sessions(7)
+    for aggfunc in (np.mean, np.max, np.median):
+        metrics = session_metrics(aggfunc)
+        suite = MetricSuite(metrics)
+        for k in (0, 1, 5):
+            for sessid in sorted(sresults):
+                states, suite_states = [m.start(sqrels[sessid], k) for m in metrics], suite.start(sqrels[sessid], k)
+                for j, results in enumerate(sresults[sessid]):
+                    for metric, state in zip(metrics, states):
+                        metric.update(state, results)
+                    suite.update(suite_states, results)
+                    expected = [m.evaluate(sqrels[sessid], sresults[sessid][:j + 1], k) for m in metrics]
+                    assert _close([m.value(s) for m, s in zip(metrics, states)], expected), (aggfunc, k, sessid, j)
+                    assert _close(suite.value(suite_states), expected), ('MetricSuite', aggfunc, k, sessid, j)
+    for k in (0, 3, 10):
+        vectorized = [ESNDCG(0.8, 0.7, True, N=2000, method='vectorized', seed=k) for _ in xrange(0, 2)]
+        exact, sample = ESNDCG(0.8, 0.7, True, method='exact'), ESNDCG(0.8, 0.7, True, N=20000, method='sample')
+        random.seed(k)
+        for sessid in sorted(sresults):
+            state, sampled = vectorized[1].start(sqrels[sessid], k), sample.start(sqrels[sessid], k)
+            for results in sresults[sessid]:
+                vectorized[1].update(state, results)
+                sample.update(sampled, results)
+            expected = vectorized[0].evaluate(sqrels[sessid], sresults[sessid], k)
+            assert abs(vectorized[1].value(state) - expected) < 1e-12, ('vectorized', k, sessid)
+            # evaluate draws one more sample of pref after the session's last query
+            vectorized[1].random.random_sample(vectorized[1].N)
+            score = exact.evaluate(sqrels[sessid], sresults[sessid], k)
+            assert abs(sample.value(sampled) - score) < 0.03, ('sample', k, sessid, sample.value(sampled), score)
+
+
+#
+# evaluate_run_evecs against the scalar path of the query metric with each effort vector in place of its own.
+def check_evecs(directory):
+    sresults, sqrels = synthetic_sessions(8)
+    run, k = CompiledRun(sresults, sqrels), 5
+    evecs = utils.evec_grid([[0.1, 0.5, 1], [0.5, 1], [1]])
+    for metric in session_metrics()[:9]:
+        if not hasattr(metric.qmetric, 'evaluate_evecs'):
+            continue
+        scores = metric.evaluate_run_evecs(run, k, evecs)
+        qmetric = metric.qmetric
+        for e, evec in enumerate(evecs.tolist()):
+            params = dict((name, getattr(qmetric, name)) for name in qmetric.params)
+            params['evec'] = evec
+            expected = SQMetric(type(qmetric)(**params), np.mean)
+            assert _close(scores[:, e], [expected.evaluate(sqrels[sessid], sresults[sessid], k)
+                                         for sessid in run.sessids]), (type(qmetric).__name__, evec)
+
+
+CHECKS = [
+    ('trec_run', check_trec_run),
+    ('trec_qrels', check_trec_qrels),
+    ('trec_malformed', check_trec_malformed),
+    ('qrels_index', check_qrels_index),
+    ('qrels_index_collisions', check_qrels_index_collisions),
+    ('esndcg_exact', check_esndcg_exact),
+    ('profiling', check_profiling),
+    ('cli', check_cli),
+    ('server', check_server),
+    ('result_store', check_result_store),
+    ('sweep', check_sweep),
+    ('parallel', check_parallel),
+    ('incremental', check_incremental),
+    ('evecs', check_evecs),
+]
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name for name, _ in CHECKS]
+    failed = 0
+    for name, check in CHECKS:
+        if name not in names:
+            continue
+        directory = tempfile.mkdtemp(prefix='ir_metrics_')
+        try:
+            check(directory)
+            print 'ok      %s' % name
+        except Exception:
+            failed += 1
+            print 'FAILED  %s' % name
+            traceback.print_exc()
+        finally:
+            shutil.rmtree(directory)
+    sys.exit(1 if failed > 0 else 0)
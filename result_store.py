@@ -0,0 +1,211 @@
+#
+# A persistent store of metric scores, so that re-running an experiment only evaluates the metrics (and sessions)
+# that have changed since the previous run.
+#
+# Scores are keyed by the metric's configuration (see the metrics' config methods) and a fingerprint of the metrics'
+# code (see code_fingerprint), a hash of the session's data (its qrels and search results), and the cutoff k. The
+# store is a directory holding one JSON file for each metric configuration; when the files exceed the store's
+# capacity, the least recently used ones are removed.
+#
+# The store is opt-in: the experiment scripts call use_store_from_environ(), so setting IR_METRICS_STORE to a
+# directory (e.g., data/results.store) reuses the scores of their previous runs.
+#
+
+import atexit
+import hashlib
+import inspect
+import json
+import os
+import sys
+import tempfile
+
+from collections import OrderedDict
+
+
+class ResultStore:
+    #
+    # path          the store's directory, which is created if it does not exist
+    # capacity      the maximum total size of the store's files in bytes
+    # sessions      the maximum number of sessions whose hashes are kept; the least recently used one is evicted first
+    def __init__(self, path, capacity=64 * 1024 * 1024, sessions=4096):
+        self.path = path
+        self.capacity = capacity
+        # the loaded configurations' scores, and the configurations with unsaved scores
+        self.configs = dict()
+        self.dirty = set()
+        # the hashes of the recently evaluated sessions, keyed by the identity of their qrels and results
+        self.sessions = OrderedDict()
+        self.session_capacity = sessions
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        atexit.register(self.flush)
+
+    #
+    # the file storing a configuration's scores
+    def file(self, config):
+        return os.path.join(self.path, hashlib.sha1(config).hexdigest() + '.json')
+
+    #
+    # the scores of a configuration, a dict mapping 'session hash/k' to the score
+    def scores(self, config):
+        scores = self.configs.get(config)
+        if scores is None:
+            scores = dict()
+            try:
+                with open(self.file(config), 'r') as f:
+                    entry = json.load(f)
+                f.close()
+                if entry['config'] == config:
+                    scores = entry['scores']
+                # mark the file as recently used
+                os.utime(self.file(config), None)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+            self.configs[config] = scores
+        return scores
+
+    #
+    # the hash of a session's qrels and search results
+    def session(self, qrels, sresults):
+        key = (id(qrels), id(sresults))
+        entry = self.sessions.pop(key, None)
+        # the ids of garbage collected objects may be reused by other ones
+        if entry is None or entry[0] is not qrels or entry[1] is not sresults:
+            # sresults may be a SessionResults (see dataset.py), which is hashed as a list of each query's results
+            data = json.dumps([sorted(qrels.items()), list(sresults)], separators=(',', ':'))
+            entry = (qrels, sresults, hashlib.sha1(data).hexdigest())
+        self.sessions[key] = entry
+        if len(self.sessions) > self.session_capacity:
+            self.sessions.popitem(last=False)
+        return entry[2]
+
+    #
+    # get the stored score of a configuration on a session at cutoff k, or None if it has not been stored
+    def get(self, config, session, k):
+        return self.scores(config).get('%s/%d' % (session, k))
+
+    def put(self, config, session, k, score):
+        self.scores(config)['%s/%d' % (session, k)] = score
+        self.dirty.add(config)
+
+    #
+    # write the unsaved scores to disk and remove the least recently used files beyond the store's capacity
+    def flush(self):
+        for config in self.dirty:
+            try:
+                # write to a temporary file first, so that a partially written file is never read
+                fd, tmp = tempfile.mkstemp(prefix='.store', dir=self.path)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'config': config, 'scores': self.configs[config]}, f)
+                f.close()
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, self.file(config))
+            except (IOError, OSError):
+                pass
+        written = set(self.file(config) for config in self.dirty)
+        self.dirty.clear()
+        self.evict(written)
+
+    #
+    # remove the least recently used files until the store fits its capacity, keeping the files in keep if possible
+    def evict(self, keep=()):
+        files = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            # the directory has been removed (e.g., a temporary store before the process exits)
+            return
+        for name in names:
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((os.path.join(self.path, name) in keep, stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, _, size, _ in files)
+        for _, _, size, name in sorted(files):
+            if total <= self.capacity:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    #
+    # remove all stored scores
+    def clear(self):
+        self.configs.clear()
+        self.dirty.clear()
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.path, name))
+
+
+# the store consulted by SQMetric, correlation, and regress, or None if scores are not stored
+store = None
+
+
+#
+# Store metric scores in a directory (see ResultStore) from now on.
+def use_store(path, capacity=64 * 1024 * 1024):
+    global store
+    store = ResultStore(path, capacity)
+    return store
+
+
+#
+# Store metric scores in the directory named by the environment variable IR_METRICS_STORE, if it is set.
+def use_store_from_environ():
+    path = os.environ.get('IR_METRICS_STORE')
+    if not path or path == '0':
+        return None
+    return use_store(path)
+
+
+# the hash of each module's source file
+_module_hashes = dict()
+
+
+def _module_hash(name):
+    if name not in _module_hashes:
+        module, digest = sys.modules.get(name), None
+        try:
+            with open(inspect.getsourcefile(module), 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            f.close()
+        except (IOError, TypeError):
+            pass
+        _module_hashes[name] = digest
+    return _module_hashes[name]
+
+
+#
+# A fingerprint of the code that computes a metric's scores: a hash of the source of query_metrics, session_metrics,
+# and the modules of the metric's class (and its query metric's, e.g., of an SQMetric), so that the scores stored by
+# a previous version of the code are not reused after it is changed.
+def code_fingerprint(metric):
+    names = set(['query_metrics', 'session_metrics'])
+    for obj in (metric, getattr(metric, 'qmetric', None)):
+        if obj is not None:
+            names.update(cls.__module__ for cls in type(obj).__mro__ if cls is not object)
+    digest = hashlib.sha1()
+    for name in sorted(names):
+        digest.update('%s:%s\n' % (name, _module_hash(name)))
+    return digest.hexdigest()
+
+
+#
+# The stable key of a metric's scores, i.e., its configuration and code fingerprint, or None if the metric's scores
+# cannot be stored (e.g., a sampled metric).
+def metric_config(metric):
+    config = metric.config() if hasattr(metric, 'config') else None
+    return None if config is None else json.dumps([config, code_fingerprint(metric)], sort_keys=True)
+
+
+#
+# Get a session's score from the store, or evaluate it by evaluate(qrels, sresults, k) and store it.
+def stored(metric, qrels, sresults, k, evaluate):
+    config = None if store is None else metric_config(metric)
+    if config is None:
+        return evaluate(qrels, sresults, k)
+    session = store.session(qrels, sresults)
+    score = store.get(config, session, k)
+    if score is None:
+        score = evaluate(qrels, sresults, k)
+        store.put(config, session, k, score)
+    return score
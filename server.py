@@ -0,0 +1,311 @@
+#
+# A local evaluation service that scores search result lists (SERPs) as they are served, e.g.,
+#
+#   python -m ir_metrics serve --port 8000 -m ndcg -m grbp:pdown=0.6,gs=0,0.4,0.6,evec=0.25,1,1
+#   curl -d '{"qrels": {"d1": 2, "d3": 1}, "results": ["d1", "d2", "d3"], "k": 10}' localhost:8000/evaluate
+#
+# Requests are coalesced into micro-batches: a batch is evaluated by the query metrics' vectorized path (see
+# query_metrics.BatchContext) once it has max_batch requests or its earliest request has waited for its maximum delay.
+#
+# POST /evaluate    a request {"qrels": {doc: grade}, "results": [doc, ...], "k": 10, "metrics": [spec, ...],
+#                   "max_delay": seconds} or a list of them; "k", "metrics", and "max_delay" are optional. The reply
+#                   is {"scores": {spec: score}} (or a list of them), or {"error": message} with status 400 (or 500
+#                   if the evaluation fails).
+# GET /stats        the number of requests and batches, the throughput, and the latency percentiles
+#
+# The server is threaded: each connection is handled by a thread that waits for its batch, and one thread evaluates
+# the batches, so the metrics (and their caches) are only used by that thread.
+#
+
+import BaseHTTPServer
+import collections
+import json
+import os
+import socket
+import SocketServer
+import threading
+import time
+import numpy as np
+
+from ir_metrics import parse_metric
+from query_metrics import batch_context
+from session_metrics import SQMetric
+
+
+#
+# The relevance grades a query metric can evaluate: its vector parameters (e.g., evec and gs) are indexed by grade,
+# from -len(vector) to len(vector) - 1, and within int8 (see query_metrics.grade_dtype), so no request widens a batch.
+def grade_range(metric):
+    low, high = -128, 127
+    for name in metric.params:
+        value = getattr(metric, name)
+        if isinstance(value, tuple):
+            low, high = max(low, -len(value)), min(high, len(value) - 1)
+    return low, high
+
+
+#
+# A request waiting in a micro-batch.
+class PendingRequest:
+    def __init__(self, qrels, results, k, specs, deadline):
+        self.qrels = qrels
+        self.results = results
+        self.k = k
+        self.specs = specs
+        self.deadline = deadline
+        self.submitted = time.time()
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    #
+    # specs         the metric specs evaluated by default (see ir_metrics.parse_metric); only query metrics
+    # k             the default cutoff
+    # max_batch     the maximum number of requests evaluated together
+    # max_delay     the default maximum time (in seconds) a request waits for other requests to be batched with
+    # history       the number of recent requests whose latencies are kept for the percentiles
+    def __init__(self, specs, k=10, max_batch=256, max_delay=0.005, history=10000):
+        self.specs = list(specs)
+        self.k = k
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.metrics = dict()
+        self.queue = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.started = time.time()
+        self.counts = {'requests': 0, 'batches': 0, 'errors': 0}
+        self.latencies = collections.deque(maxlen=history)
+        for spec in self.specs:
+            self.metric(spec)
+        self.thread = threading.Thread(target=self.run, name='MicroBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    #
+    # the query metric of a spec; a ValueError is raised for an invalid spec or a session metric
+    def metric(self, spec):
+        with self.condition:
+            metric = self.metrics.get(spec)
+            if metric is None:
+                metric = parse_metric(spec)
+                if not isinstance(metric, SQMetric):
+                    raise ValueError('%s is a session metric; only query metrics can be served' % spec)
+                metric = self.metrics[spec] = metric.qmetric
+            return metric
+
+    #
+    # Check a request (a dict decoded from JSON) and queue it. Returns the PendingRequest.
+    def submit(self, request):
+        if not isinstance(request, dict) or not isinstance(request.get('results'), list):
+            raise ValueError('a request must be an object with a list of results')
+        qrels = request.get('qrels', dict())
+        k = request.get('k', self.k)
+        specs = request.get('metrics', self.specs)
+        max_delay = request.get('max_delay', self.max_delay)
+        if not isinstance(qrels, dict) or not isinstance(specs, list) or len(specs) == 0:
+            raise ValueError('qrels must be an object and metrics a non-empty list')
+        if not isinstance(k, int) or k < 1:
+            raise ValueError('k must be a positive integer')
+        # a bad grade would fail the whole batch, so it is rejected before the request is queued
+        for grade in qrels.itervalues():
+            if not isinstance(grade, (int, long)) or isinstance(grade, bool):
+                raise ValueError('grades must be integers: %r' % (grade,))
+        for spec in specs:
+            low, high = grade_range(self.metric(spec))
+            if qrels and not low <= min(qrels.itervalues()) <= max(qrels.itervalues()) <= high:
+                raise ValueError('grades of %s must be between %d and %d' % (spec, low, high))
+        pending = PendingRequest(qrels, request['results'], k, specs, time.time() + float(max_delay))
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('the server is closed')
+            self.queue.append(pending)
+            self.condition.notify()
+        return pending
+
+    #
+    # Evaluate requests (a request or a list of them), waiting for their batches. Returns the scores of each request
+    # as a dict mapping each metric spec to the score.
+    def evaluate(self, requests):
+        pendings = [self.submit(request) for request in requests]
+        for pending in pendings:
+            pending.done.wait()
+            if pending.error is not None:
+                raise RuntimeError(pending.error)
+        return [pending.scores for pending in pendings]
+
+    #
+    # the batching thread: wait until the queue has max_batch requests or its earliest deadline, then evaluate
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                while 0 < len(self.queue) < self.max_batch and not self.closed:
+                    remaining = min(pending.deadline for pending in self.queue) - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if self.closed:
+                    return
+                batch, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+            self.evaluate_batch(batch)
+
+    def evaluate_batch(self, batch):
+        try:
+            self.score(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = '%s: %s' % (e.__class__.__name__, e)
+            else:
+                # a bad request must not fail the requests batched with it, so they are evaluated one at a time
+                for pending in batch:
+                    try:
+                        self.score([pending])
+                    except Exception as e:
+                        pending.error = '%s: %s' % (e.__class__.__name__, e)
+        now = time.time()
+        with self.condition:
+            self.counts['requests'] += len(batch)
+            self.counts['batches'] += 1
+            for pending in batch:
+                self.latencies.append(now - pending.submitted)
+                if pending.error is not None:
+                    self.counts['errors'] += 1
+        for pending in batch:
+            pending.done.set()
+
+    #
+    # evaluate a batch of requests together, setting each request's scores
+    def score(self, batch):
+        # scores do not change past a list's results and judged documents, so a cutoff beyond the longest of them
+        # is evaluated there rather than allocating a matrix of k columns
+        longest = max(max(len(pending.results), len(pending.qrels)) for pending in batch)
+        kmax = max(min(max(pending.k for pending in batch), longest), 1)
+        context = batch_context([pending.qrels for pending in batch], [pending.results for pending in batch], kmax)
+        rows, cutoffs = np.arange(0, len(batch)), np.array([min(pending.k, kmax) - 1 for pending in batch])
+        scores = dict()
+        for spec in set(spec for pending in batch for spec in pending.specs):
+            scores[spec] = self.metrics[spec].evaluate_context(context)[rows, cutoffs].tolist()
+        for i, pending in enumerate(batch):
+            pending.scores = dict((spec, scores[spec][i]) for spec in pending.specs)
+
+    #
+    # the number of requests and batches, the throughput (requests per second since the start), and the latency
+    # percentiles (in milliseconds) of the recent requests
+    def stats(self):
+        with self.condition:
+            counts, latencies = dict(self.counts), np.array(self.latencies) * 1000.0
+        elapsed = time.time() - self.started
+        counts['throughput'] = counts['requests'] / elapsed if elapsed > 0 else 0.0
+        counts['mean_batch_size'] = float(counts['requests']) / counts['batches'] if counts['batches'] > 0 else 0.0
+        if len(latencies) > 0:
+            counts['latency_ms'] = dict(('p%d' % q, np.percentile(latencies, q)) for q in (50, 90, 99))
+            counts['latency_ms']['max'] = np.max(latencies)
+        return counts
+
+    #
+    # stop the batching thread; the requests that are still queued fail rather than wait forever
+    def close(self):
+        with self.condition:
+            self.closed = True
+            queued, self.queue = self.queue, []
+            self.condition.notify()
+        self.thread.join()
+        for pending in queued:
+            pending.error = 'RuntimeError: the server is closed'
+            pending.done.set()
+
+
+class EvaluationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections alive, so that clients do not pay for a connection per request
+    protocol_version = 'HTTP/1.1'
+    # buffer each reply (flushed after each request), so that its headers and body are sent at once rather than in
+    # small writes delayed by Nagle's algorithm
+    wbufsize = -1
+
+    def do_POST(self):
+        if self.path != '/evaluate':
+            return self.reply(404, {'error': 'not found: %s' % self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            scores = self.server.batcher.evaluate(body if isinstance(body, list) else [body])
+        except (ValueError, TypeError) as e:
+            return self.reply(400, {'error': str(e)})
+        except RuntimeError as e:
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, [{'scores': s} for s in scores] if isinstance(body, list) else {'scores': scores[0]})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': 'not found: %s' % self.path})
+        self.reply(200, self.server.batcher.stats())
+
+    def reply(self, status, content):
+        data = json.dumps(content)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EvaluationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        BaseHTTPServer.HTTPServer.__init__(self, address, EvaluationHandler)
+        self.batcher = batcher
+
+
+#
+# The evaluation server on a Unix socket, which avoids TCP's overhead for a sidecar on the same host.
+class UnixEvaluationServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, batcher):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, EvaluationHandler)
+        self.batcher = batcher
+
+    def get_request(self):
+        # handlers expect a (host, port) client address
+        request, _ = self.socket.accept()
+        return request, ('localhost', 0)
+
+
+#
+# Create an evaluation server on host:port, or on a Unix socket at unix if it is set; call serve_forever() to run it.
+def make_server(batcher, host='127.0.0.1', port=8000, unix=None):
+    if unix is not None:
+        return UnixEvaluationServer(unix, batcher)
+    return EvaluationServer((host, port), batcher)
+
+
+#
+# Send a POST request of content (JSON) to an evaluation server on a Unix socket and return the decoded reply, e.g.,
+# for a client on the same host without an HTTP library.
+def unix_request(path, content, url='/evaluate'):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        data = json.dumps(content)
+        client.sendall('POST %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' %
+                       (url, len(data), data))
+        reply = ''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        client.close()
+    return json.loads(reply.split('\r\n\r\n', 1)[1])
@@ -11,6 +11,63 @@
 
 import math
 import random
+import numpy as np
+
+from query_metrics import _evec_matrix, _rank_table, _truncate, _total, dcg_discounts, discounted_prefix, ideal_cache
+from query_metrics import BatchContext, Metric, batch_context, ideal_cutoff
+from result_store import stored
+
+
+#
+# The sDCG rank discount log(b, rank + b - 1), indexed by rank - 1.
+def sdcg_discounts(b, n):
+    return _rank_table('sdcg_rank', b, n, lambda i: math.log(b, i + b))
+
+
+#
+# The sDCG query discount log(bq, qix + bq), indexed by qix.
+def sdcg_query_discounts(bq, n):
+    return _rank_table('sdcg_query', bq, n, lambda qix: math.log(bq, qix + bq))
+
+
+#
+# The sum of (2 ** rel - 1) * log(b, rank + b - 1) over the top k results of each row of a padded grade matrix.
+def _discounted_gain(b, grades, lengths, k):
+    grades, mask = _truncate(grades, lengths, k)
+    discount = np.array(sdcg_discounts(b, grades.shape[1])[:grades.shape[1]])
+    return _total(np.where(mask, (np.power(2.0, grades) - 1.0) * discount, 0.0))
+
+
+#
+# Sum up each session's query scores in a dataset.CompiledRun, optionally discounted by log(bq, qix + bq).
+def _sum_queries(run, qscores, bq, discountq):
+    if discountq:
+        qscores = qscores * np.array(sdcg_query_discounts(bq, run.query_position.max() + 1))[run.query_position]
+    return np.bincount(run.query_session, weights=qscores, minlength=run.num_sessions())
+
+
+#
+# The running state of a session that is evaluated incrementally, one query at a time, e.g.,
+#
+#   state = metric.start(qrels, k)
+#   metric.update(state, results)   # for each query of the session as it is issued
+#   metric.value(state)             # the score of the queries issued so far
+#
+# qrels     the session's qrels
+# k         the top k results of each query to be evaluated
+# numq      the number of queries added so far
+# total     the running sum (or another aggregation) of the queries' scores
+#
+# The other slots hold the metrics' own running values, e.g., the ideal sDCG of NSDCG.
+class SessionState(object):
+    __slots__ = ('qrels', 'k', 'numq', 'total', 'ideal', 'ideal_gain', 'scores', 'prob', 'sdcg', 'stop', 'offset',
+                 'lengths', 'dcgs', 'active')
+
+    def __init__(self, qrels, k):
+        self.qrels = qrels
+        self.k = k
+        self.numq = 0
+        self.total = 0.0
 
 
 #
@@ -22,7 +79,9 @@ import random
 # In Proceedings of the IR research, 30th European conference on Advances in information retrieval (ECIR'08),
 # Craig Macdonald, Iadh Ounis, Vassilis Plachouras, Ian Ruthven, and Ryen W. White (Eds.).
 # Springer-Verlag, Berlin, Heidelberg, 4-15.
-class SDCG:
+class SDCG(Metric):
+    __slots__ = ('b', 'bq', 'discountq', 'discounts', 'qdiscounts')
+
     #
     # b             the rank discount parameter
     # bq            the query discount parameter
@@ -31,26 +90,64 @@ class SDCG:
         self.b = b
         self.bq = bq
         self.discountq = discountq
+        self.discounts = sdcg_discounts(b, 0)
+        self.qdiscounts = sdcg_query_discounts(bq, 0)
+
+    #
+    # the metric's configuration, a stable key of the metric's scores (see result_store.py)
+    def config(self):
+        return [self.__class__.__name__, self.b, self.bq, self.discountq]
 
     def evaluate(self, qrels, sresults, k):
+        if len(self.qdiscounts) < len(sresults):
+            self.qdiscounts = sdcg_query_discounts(self.bq, len(sresults))
         sdcg = 0
         for qix in xrange(0, len(sresults)):
-            qdiscount = math.log(self.bq, qix + self.bq)
-            sum_gain, rank = 0.0, 1
-            for doc in sresults[qix]:
-                rel = qrels.get(doc, 0)
-                gain = 2 ** rel - 1.0
-                discount = math.log(self.b, rank + self.b - 1)
-                sum_gain += gain * discount
-                rank += 1
-                if rank > k:
-                    break
+            sum_gain = self.discounted_gain(qrels, sresults[qix], k)
             if self.discountq:
-                sdcg += qdiscount * sum_gain
+                sdcg += self.qdiscounts[qix] * sum_gain
             else:
                 sdcg += sum_gain
         return sdcg
 
+    #
+    # the discounted gain of a query's results (before the query discount)
+    def discounted_gain(self, qrels, results, k):
+        if len(self.discounts) < min(len(results), k):
+            self.discounts = sdcg_discounts(self.b, min(len(results), k))
+        sum_gain, rank = 0.0, 1
+        for doc in results:
+            rel = qrels.get(doc, 0)
+            gain = 2 ** rel - 1.0
+            discount = self.discounts[rank - 1]
+            sum_gain += gain * discount
+            rank += 1
+            if rank > k:
+                break
+        return sum_gain
+
+    #
+    # Evaluate a session incrementally (see SessionState): each query costs only the evaluation of its own results.
+    def start(self, qrels, k):
+        return SessionState(qrels, k)
+
+    def update(self, state, results):
+        if len(self.qdiscounts) <= state.numq:
+            self.qdiscounts = sdcg_query_discounts(self.bq, state.numq + 1)
+        sum_gain = self.discounted_gain(state.qrels, results, state.k)
+        state.total += self.qdiscounts[state.numq] * sum_gain if self.discountq else sum_gain
+        state.numq += 1
+
+    def value(self, state):
+        return state.total
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at once; the scores are in the order of run.sessids
+    def evaluate_run(self, run, k):
+        k = max(k, 1)
+        grades, lengths, _, _ = run.grade_matrix(k)
+        return _sum_queries(run, _discounted_gain(self.b, grades, lengths, k), self.bq, self.discountq)
+
 
 #
 # Normalized sDCG.
@@ -59,7 +156,9 @@ class SDCG:
 # Evangelos Kanoulas, Ben Carterette, Paul D. Clough, and Mark Sanderson. 2011. Evaluating multi-query sessions.
 # In Proceedings of the 34th international ACM SIGIR conference on Research and development in Information Retrieval
 # (SIGIR '11). ACM, New York, NY, USA, 1053-1062. DOI=http://dx.doi.org/10.1145/2009916.2010056
-class NSDCG:
+class NSDCG(Metric):
+    __slots__ = ('b', 'bq', 'discountq', 'sdcg')
+
     #
     # b             the rank discount parameter
     # bq            the query discount parameter
@@ -68,17 +167,67 @@ class NSDCG:
         self.b = b
         self.bq = bq
         self.discountq = discountq
+        self.sdcg = SDCG(b, bq, discountq)
+
+    #
+    # the metric's configuration, a stable key of the metric's scores (see result_store.py)
+    def config(self):
+        return [self.__class__.__name__, self.b, self.bq, self.discountq]
 
     def evaluate(self, qrels, sresults, k):
-        ideal_list = sorted(qrels, key=lambda key: qrels[key], reverse=True)
-        ideal_session = [ideal_list for i in xrange(0, len(sresults))]
-        sdcg = SDCG(self.b, self.bq, self.discountq)
-        return sdcg.evaluate(qrels, sresults, k) / sdcg.evaluate(qrels, ideal_session, k)
+        sdcg = self.sdcg
+        sum_gain, _ = ideal_cache.get(qrels, ('SDCG', self.b), self.ideal_prefix)
+        ideal_gain = sum_gain[ideal_cutoff(k, qrels)]
+        if len(sdcg.qdiscounts) < len(sresults):
+            sdcg.qdiscounts = sdcg_query_discounts(self.bq, len(sresults))
+        sdcg_ideal = 0
+        for qix in xrange(0, len(sresults)):
+            if self.discountq:
+                sdcg_ideal += sdcg.qdiscounts[qix] * ideal_gain
+            else:
+                sdcg_ideal += ideal_gain
+        return sdcg.evaluate(qrels, sresults, k) / sdcg_ideal
+
+    #
+    # Evaluate a session incrementally (see SessionState). The ideal sDCG is accumulated in state.ideal; the score
+    # is NaN until the first query is added.
+    def start(self, qrels, k):
+        state = SessionState(qrels, k)
+        sum_gain, _ = ideal_cache.get(qrels, ('SDCG', self.b), self.ideal_prefix)
+        state.ideal_gain, state.ideal = sum_gain[ideal_cutoff(k, qrels)], 0
+        return state
+
+    def update(self, state, results):
+        self.sdcg.update(state, results)
+        if self.discountq:
+            state.ideal += self.sdcg.qdiscounts[state.numq - 1] * state.ideal_gain
+        else:
+            state.ideal += state.ideal_gain
+
+    def value(self, state):
+        return state.total / state.ideal if state.numq > 0 else float('nan')
+
+    #
+    # the ideal ranking's discounted gain at every cutoff
+    def ideal_prefix(self, grades):
+        return discounted_prefix(grades, lambda rel: 2 ** rel - 1.0, lambda rel: 0.0,
+                                 sdcg_discounts(self.b, len(grades)))
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at once; the scores are in the order of run.sessids
+    def evaluate_run(self, run, k):
+        k = max(k, 1)
+        grades, lengths, qgrades, qlengths = run.grade_matrix(k)
+        sdcg = _sum_queries(run, _discounted_gain(self.b, grades, lengths, k), self.bq, self.discountq)
+        sdcg_ideal = _sum_queries(run, _discounted_gain(self.b, qgrades, qlengths, k), self.bq, self.discountq)
+        return sdcg / sdcg_ideal
 
 
 #
 # sDCG/q: a metric that normalizes sDCG by simply the number of queries in a session.
-class SDCGQ:
+class SDCGQ(Metric):
+    __slots__ = ('b', 'bq', 'discountq', 'sdcg')
+
     #
     # b             the rank discount parameter
     # bq            the query discount parameter
@@ -87,10 +236,31 @@ class SDCGQ:
         self.b = b
         self.bq = bq
         self.discountq = discountq
+        self.sdcg = SDCG(b, bq, discountq)
+
+    #
+    # the metric's configuration, a stable key of the metric's scores (see result_store.py)
+    def config(self):
+        return [self.__class__.__name__, self.b, self.bq, self.discountq]
 
     def evaluate(self, qrels, sresults, k):
-        sdcg = SDCG(self.b, self.bq, self.discountq)
-        return sdcg.evaluate(qrels, sresults, k) / len(sresults)
+        return self.sdcg.evaluate(qrels, sresults, k) / len(sresults)
+
+    #
+    # Evaluate a session incrementally (see SessionState); the score is NaN until the first query is added.
+    def start(self, qrels, k):
+        return SessionState(qrels, k)
+
+    def update(self, state, results):
+        self.sdcg.update(state, results)
+
+    def value(self, state):
+        return state.total / state.numq if state.numq > 0 else float('nan')
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at once; the scores are in the order of run.sessids
+    def evaluate_run(self, run, k):
+        return self.sdcg.evaluate_run(run, k) / np.diff(run.session_offsets)
 
 
 #
@@ -100,26 +270,45 @@ class SDCGQ:
 # Evangelos Kanoulas, Ben Carterette, Paul D. Clough, and Mark Sanderson. 2011. Evaluating multi-query sessions.
 # In Proceedings of the 34th international ACM SIGIR conference on Research and development in Information Retrieval
 # (SIGIR '11). ACM, New York, NY, USA, 1053-1062. DOI=http://dx.doi.org/10.1145/2009916.2010056
-class ESNDCG:
+class ESNDCG(Metric):
+    __slots__ = ('pref', 'pdown', 'normScanPath', 'N', 'method', 'random', 'discounts')
+
     #
     # pref              the probability to reformulate to the next query after examining a query's SERP
     # pdown             the probability to examine the next result in a ranked list
     # path_discount     whether to discount lower ranked results in a scan path
     # N                 the number of sampling iteration
-    def __init__(self, pref, pdown, path_discount, N=1000):
+    # method            how to estimate esnDCG:
+    #                       'sample' draws N scan paths using python's random module;
+    #                       'vectorized' draws N scan paths at once using numpy.random.RandomState(seed);
+    #                       'exact' computes the expected value over all possible scan paths (N is not used)
+    # seed              the seed of the 'vectorized' method
+    def __init__(self, pref, pdown, path_discount, N=1000, method='sample', seed=0):
         self.pref = pref
         self.pdown = pdown
         self.normScanPath = path_discount
         self.N = N
+        self.method = method
+        self.random = np.random.RandomState(seed)
+        self.discounts = dcg_discounts(0)
+
+    #
+    # the metric's configuration (see result_store.py); sampled scores vary with the random state and are not stored
+    def config(self):
+        if self.method != 'exact':
+            return None
+        return ['ESNDCG', self.pref, self.pdown, self.normScanPath, self.method]
 
     #
     # compute dcg of a ranked list until some cutoff k
     def dcg(self, qrels, results, k):
+        if len(self.discounts) < min(len(results), k):
+            self.discounts = dcg_discounts(min(len(results), k))
         dcg, rank = 0.0, 1
         for doc in results:
             rel = qrels.get(doc, 0)
             gain = 2 ** rel - 1.0
-            discount = math.log(2, rank + 1)
+            discount = self.discounts[rank - 1]
             if self.normScanPath:
                 dcg += gain * discount
             else:
@@ -149,19 +338,285 @@ class ESNDCG:
     #
     # estimate esnDCG by sampling
     def evaluate(self, qrels, sresults, k):
-        ideal_list = sorted(qrels, key=lambda key: qrels[key], reverse=True)
+        if self.method == 'exact':
+            return self.evaluate_exact(qrels, sresults, k)
+        if self.method == 'vectorized':
+            return self.evaluate_vectorized(qrels, sresults, k)
+        ideal_dcg, _ = ideal_cache.get(qrels, ('ESNDCG', self.normScanPath), self.ideal_prefix)
         sum_sample = 0
         for i in xrange(0, self.N):
             scanpath = self.sample(sresults, k)
             dcg = self.dcg(qrels, scanpath, len(scanpath))
-            idcg = self.dcg(qrels, ideal_list, len(scanpath))
+            idcg = ideal_dcg[ideal_cutoff(len(scanpath), qrels)]
             sum_sample += dcg / idcg
         return sum_sample / self.N
 
+    #
+    # For each query, the probability that the user examines the top d results (d = 0, 1, ..., L), and the gain
+    # gains[o, d] that the top d results add to the dcg of a scan path when o results have been examined before.
+    # L is the number of results within cutoff k; at least one result is examined unless the SERP is empty.
+    def scan_tables(self, qrels, sresults, k):
+        tables, offset = [], 0
+        for results in sresults:
+            tables.append(self.scan_table(qrels, results, k, offset))
+            offset += len(tables[-1][0]) - 1
+        return tables
+
+    #
+    # the (pdepth, gains) of a query when offset results have been examined before it, see scan_tables
+    def scan_table(self, qrels, results, k, offset):
+        n = min(len(results), max(k, 1))
+        if self.normScanPath:
+            discounts = np.array(dcg_discounts(offset + n)[:offset + n])
+        else:
+            discounts = np.ones(offset + n)
+        ranks = np.arange(0, offset + n + 1)
+        pdepth = np.zeros(n + 1)
+        if n == 0:
+            pdepth[0] = 1.0
+        else:
+            pdepth[1:] = self.pdown ** ranks[:n]
+            pdepth[1:n] *= 1 - self.pdown
+        gains = np.array([2 ** qrels.get(doc, 0) - 1.0 for doc in results[:n]])
+        qgains = np.zeros((offset + 1, n + 1))
+        qgains[:, 1:] = np.cumsum(gains * discounts[ranks[:offset + 1, np.newaxis] + ranks[:n]], axis=1)
+        return pdepth, qgains
+
+    #
+    # the ideal dcg for each possible scan path length 0, 1, ..., n
+    def ideal_dcgs(self, qrels, n):
+        ideal_dcg, _ = ideal_cache.get(qrels, ('ESNDCG', self.normScanPath), self.ideal_prefix)
+        return np.array(ideal_dcg)[np.minimum(np.maximum(np.arange(0, n + 1), 1), len(qrels))]
+
+    #
+    # Compute the expected esnDCG over all scan paths. Examining a query's SERP is a truncated geometric
+    # distribution of depth (by pdown), and reformulating is a geometric distribution of queries (by pref),
+    # so the expectation can be accumulated query by query over the number of results examined so far.
+    def evaluate_exact(self, qrels, sresults, k):
+        tables = self.scan_tables(qrels, sresults, k)
+        maxlen = sum(len(pdepth) - 1 for pdepth, _ in tables)
+        # prob[o]: the probability that o results have been examined before the current query
+        # sdcg[o]: the probability-weighted dcg of those scan paths
+        prob, sdcg, stop = np.zeros(maxlen + 1), np.zeros(maxlen + 1), np.zeros(maxlen + 1)
+        prob[0] = 1.0
+        for qix in xrange(0, len(tables)):
+            pdepth, qgains = tables[qix]
+            prob, sdcg = self.examine(prob, sdcg, pdepth, qgains, maxlen + 1)
+            pref = self.pref if qix + 1 < len(tables) else 0.0
+            stop += (1 - pref) * sdcg
+            prob, sdcg = prob * pref, sdcg * pref
+        examined = np.nonzero(stop)[0]
+        return np.sum(stop[examined] / self.ideal_dcgs(qrels, maxlen)[examined])
+
+    #
+    # Examine a query's SERP (see scan_table) after the scan paths of prob and sdcg (see evaluate_exact). Returns the
+    # new (prob, sdcg) of at least size elements.
+    def examine(self, prob, sdcg, pdepth, qgains, size):
+        noffsets, ndepths = qgains.shape
+        positions = np.arange(0, max(noffsets, ndepths))
+        lengths = (positions[:noffsets, np.newaxis] + positions[:ndepths]).ravel()
+        weights = prob[:noffsets, np.newaxis] * pdepth
+        return (np.bincount(lengths, weights=weights.ravel(), minlength=size),
+                np.bincount(lengths, weights=(sdcg[:noffsets, np.newaxis] * pdepth + weights * qgains).ravel(),
+                            minlength=size))
+
+    #
+    # Evaluate a session incrementally (see SessionState). The exact method keeps evaluate_exact's prob and sdcg of
+    # the queries added so far, and stop without the last query's, since the user stops at the last query for sure.
+    # The sampled methods keep each of the N scan paths' running length and dcg, and whether it has not stopped, so
+    # that the state does not grow with the session; each query extends the scan paths that reformulate to it.
+    def start(self, qrels, k):
+        state = SessionState(qrels, k)
+        if self.method == 'exact':
+            state.prob, state.sdcg, state.stop = np.ones(1), np.zeros(1), np.zeros(1)
+        elif self.method == 'vectorized':
+            state.offset, state.lengths, state.dcgs = 0, np.zeros(self.N, dtype=np.int64), np.zeros(self.N)
+            state.active = np.ones(self.N, dtype=bool)
+        else:
+            state.lengths, state.dcgs, state.active = [0] * self.N, [0.0] * self.N, [True] * self.N
+        return state
+
+    def update(self, state, results):
+        state.numq += 1
+        if self.method == 'vectorized':
+            if state.numq > 1:
+                state.active &= self.random.random_sample(self.N) < self.pref
+            pdepth, qgains = self.scan_table(state.qrels, results, state.k, state.offset)
+            depth = self.sample_depths(len(pdepth) - 1)
+            depth[~state.active] = 0
+            state.dcgs += qgains[state.lengths, depth]
+            state.lengths += depth
+            state.offset += len(pdepth) - 1
+            return
+        if self.method != 'exact':
+            self.sample_query(state, results)
+            return
+        if state.numq > 1:
+            # the user stops after the previous query with probability 1 - pref
+            stop = (1 - self.pref) * state.sdcg
+            stop[:len(state.stop)] += state.stop
+            state.stop, state.prob, state.sdcg = stop, state.prob * self.pref, state.sdcg * self.pref
+        pdepth, qgains = self.scan_table(state.qrels, results, state.k, len(state.prob) - 1)
+        state.prob, state.sdcg = self.examine(state.prob, state.sdcg, pdepth, qgains, len(state.prob) + len(pdepth) - 1)
+
+    def value(self, state):
+        if self.method == 'vectorized':
+            ideal_dcgs = self.ideal_dcgs(state.qrels, state.offset)
+            return np.mean(np.where(state.dcgs == 0, 0.0, state.dcgs / ideal_dcgs[state.lengths]))
+        if self.method != 'exact':
+            ideal_dcg, _ = ideal_cache.get(state.qrels, ('ESNDCG', self.normScanPath), self.ideal_prefix)
+            return sum(state.dcgs[i] / ideal_dcg[ideal_cutoff(state.lengths[i], state.qrels)]
+                       for i in xrange(0, self.N)) / self.N
+        stop = state.sdcg.copy()
+        stop[:len(state.stop)] += state.stop
+        examined = np.nonzero(stop)[0]
+        return np.sum(stop[examined] / self.ideal_dcgs(state.qrels, len(stop) - 1)[examined])
+
+    #
+    # extend the N scan paths of a session's state (see start) by a query's SERP as sample does
+    def sample_query(self, state, results):
+        n = min(len(results), max(state.k, 1))
+        if len(self.discounts) < max(state.lengths) + n:
+            self.discounts = dcg_discounts(max(state.lengths) + n)
+        gains = [2 ** state.qrels.get(doc, 0) - 1.0 for doc in results[:n]]
+        lengths, dcgs, active = state.lengths, state.dcgs, state.active
+        for i in xrange(0, self.N):
+            # the user reformulates after the previous query with probability pref
+            if state.numq > 1 and active[i] and random.random() >= self.pref:
+                active[i] = False
+            if not active[i]:
+                continue
+            for gain in gains:
+                dcgs[i] += gain * self.discounts[lengths[i]] if self.normScanPath else gain
+                lengths[i] += 1
+                if random.random() >= self.pdown:
+                    break
+
+    #
+    # the depths to which N users examine a SERP of n results (see scan_table)
+    def sample_depths(self, n):
+        if n == 0:
+            return np.zeros(self.N, dtype=np.int64)
+        if self.pdown >= 1:
+            return np.repeat(n, self.N)
+        return np.minimum(self.random.geometric(1 - self.pdown, self.N), n)
+
+    #
+    # estimate esnDCG by sampling N scan paths at once
+    def evaluate_vectorized(self, qrels, sresults, k):
+        tables = self.scan_tables(qrels, sresults, k)
+        maxlen = sum(len(pdepth) - 1 for pdepth, _ in tables)
+        lengths, dcg = np.zeros(self.N, dtype=np.int64), np.zeros(self.N)
+        active = np.ones(self.N, dtype=bool)
+        for qix in xrange(0, len(tables)):
+            pdepth, qgains = tables[qix]
+            depth = self.sample_depths(len(pdepth) - 1)
+            depth[~active] = 0
+            dcg += qgains[lengths, depth]
+            lengths += depth
+            active &= self.random.random_sample(self.N) < self.pref
+        return np.mean(np.where(dcg == 0, 0.0, dcg / self.ideal_dcgs(qrels, maxlen)[lengths]))
+
+    #
+    # the ideal ranking's dcg at every cutoff
+    def ideal_prefix(self, grades):
+        if self.normScanPath:
+            discounts = dcg_discounts(len(grades))
+        else:
+            discounts = [1.0] * len(grades)
+        return discounted_prefix(grades, lambda rel: 2 ** rel - 1.0, lambda rel: 0.0, discounts)
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at once; the scores are in the order of run.sessids
+    def evaluate_run(self, run, k):
+        if self.method == 'exact':
+            return self.evaluate_run_exact(run, k)
+        scores = []
+        for sessid in run.sessids:
+            sqrels, sresults = run.session(sessid)
+            scores.append(self.evaluate(sqrels, sresults, k))
+        return np.array(scores)
+
+    #
+    # the same as evaluate_exact, but all sessions of a dataset.CompiledRun are accumulated together query by query
+    def evaluate_run_exact(self, run, k):
+        grades, lengths, _, _ = run.grade_matrix(max(k, 1))
+        judged, numjudged = run.judged_matrix()
+        numq = np.diff(run.session_offsets)
+        # the number of results examined before each query if all the session's previous SERPs are fully examined
+        cumlengths = np.concatenate(([0], np.cumsum(lengths)))
+        offsets = cumlengths[:-1] - cumlengths[run.session_offsets[run.query_session]]
+        width = grades.shape[1]
+        npos = (offsets + lengths).max() + 1 if len(lengths) > 0 else 1
+        positions = np.arange(0, max(npos + width, judged.shape[1]))
+        if self.normScanPath:
+            discounts = np.array(dcg_discounts(len(positions))[:len(positions)])
+        else:
+            discounts = np.ones(len(positions))
+        gains = np.where(positions[:width] < lengths[:, np.newaxis], np.power(2.0, grades) - 1.0, 0.0)
+        # pdepth[j, d]: the probability to examine the top d results of the j-th query
+        depths = positions[:width + 1]
+        powers = np.concatenate(([0.0], self.pdown ** depths[:width]))
+        pdepth = np.where(depths < lengths[:, np.newaxis], (1 - self.pdown) * powers, 0.0)
+        pdepth[depths == lengths[:, np.newaxis]] = powers[lengths]
+        pdepth[lengths == 0, 0] = 1.0
+        # prob[i, o], sdcg[i, o]: the probability that o results have been examined in the i-th session before the
+        # current query, and the probability-weighted dcg of those scan paths
+        prob, sdcg, stop = np.zeros((3, len(numq), npos + width))
+        prob[:, 0] = 1.0
+        for qix in xrange(0, numq.max() if len(numq) > 0 else 0):
+            sessions = np.nonzero(numq > qix)[0]
+            queries = run.session_offsets[sessions] + qix
+            n, noffsets = len(sessions), offsets[queries].max() + 1
+            # qgains[j, o, d]: the gain of the query's top d results after o results have been examined
+            qgains = np.zeros((n, noffsets, width + 1))
+            qgains[:, :, 1:] = np.cumsum(
+                gains[queries, np.newaxis, :] * discounts[positions[:noffsets, np.newaxis] + positions[:width]], axis=2
+            )
+            index = (np.arange(0, n)[:, np.newaxis, np.newaxis] * (noffsets + width) +
+                     positions[:noffsets, np.newaxis] + depths).ravel()
+            weights = prob[sessions, :noffsets, np.newaxis] * pdepth[queries, np.newaxis, :]
+            dweights = sdcg[sessions, :noffsets, np.newaxis] * pdepth[queries, np.newaxis, :] + weights * qgains
+            qprob = np.bincount(index, weights=weights.ravel(), minlength=n * (noffsets + width))
+            qsdcg = np.bincount(index, weights=dweights.ravel(), minlength=n * (noffsets + width))
+            pref = np.where(numq[sessions] > qix + 1, self.pref, 0.0)[:, np.newaxis]
+            stop[sessions, :noffsets + width] += (1 - pref) * qsdcg.reshape(n, noffsets + width)
+            prob[sessions, :noffsets + width] = pref * qprob.reshape(n, noffsets + width)
+            sdcg[sessions, :noffsets + width] = pref * qsdcg.reshape(n, noffsets + width)
+        # the ideal dcg of each session for each scan path length
+        ideal = np.zeros((len(numq), judged.shape[1] + 1))
+        ideal[:, 1:] = np.cumsum(
+            np.where(positions[:judged.shape[1]] < numjudged[:, np.newaxis], np.power(2.0, judged) - 1.0, 0.0) *
+            discounts[:judged.shape[1]], axis=1
+        )
+        cutoffs = np.minimum(np.maximum(positions[:npos + width], 1), numjudged[:, np.newaxis])
+        ideal = ideal[np.arange(0, len(numq))[:, np.newaxis], cutoffs]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sum(np.where(stop != 0, stop / ideal, 0.0), axis=1)
+
+
+#
+# The name of an aggregation function that SQMetric can keep a running value of ('mean', 'sum', 'max', 'min', 'first',
+# or 'last'), or None.
+def _running_aggregation(aggfunc):
+    for aggregation, funcs in (('mean', (np.mean,)), ('sum', (np.sum, sum)), ('max', (np.max, max)),
+                               ('min', (np.min, min))):
+        if any(aggfunc is func for func in funcs):
+            return aggregation
+    # utils.first and utils.last, imported here since utils imports this module (only for functions of their names,
+    # so that other aggregations do not import utils)
+    if getattr(aggfunc, '__name__', None) in ('first', 'last'):
+        import utils
+        if aggfunc is utils.first or aggfunc is utils.last:
+            return aggfunc.__name__
+    return None
+
 
 #
 # SQMetric aggregates individual queries' scores to evaluate a session.
-class SQMetric:
+class SQMetric(Metric):
+    __slots__ = ('qmetric', 'aggfunc')
+
     #
     # qmetric       the metric used to evaluate each individual query
     # aggfunc       the aggregation function used to derive session score from a list of query scores, e.g., np.mean
@@ -169,8 +624,180 @@ class SQMetric:
         self.qmetric = qmetric
         self.aggfunc = aggfunc
 
+    #
+    # the metric's configuration (see result_store.py), or None if the query metric or aggfunc cannot be identified
+    def config(self):
+        qconfig = self.qmetric.config() if hasattr(self.qmetric, 'config') else None
+        # e.g., lambdas and functools.partial objects cannot be identified by their names
+        name, module = getattr(self.aggfunc, '__name__', None), getattr(self.aggfunc, '__module__', None)
+        if qconfig is None or name is None or module is None or name == '<lambda>':
+            return None
+        return ['SQMetric', qconfig, '%s.%s' % (module, name)]
+
+    #
+    # evaluate a session, or get its score from the result store if it is in use (see result_store.py)
     def evaluate(self, qrels, sresults, k):
+        return stored(self, qrels, sresults, k, self.evaluate_queries)
+
+    def evaluate_queries(self, qrels, sresults, k):
         qscores = []
         for results in sresults:
             qscores.append(self.qmetric.evaluate(qrels, results, k))
         return self.aggfunc(qscores)
+
+    #
+    # Evaluate a session incrementally (see SessionState). For mean, sum, max, min, first, and last, the state keeps
+    # a running aggregation of the query scores (state.total); for other aggregation functions, it keeps the scores.
+    # The score is NaN until the first query is added (except for sum, which is 0).
+    def start(self, qrels, k):
+        state = SessionState(qrels, k)
+        state.scores = [] if _running_aggregation(self.aggfunc) is None else None
+        return state
+
+    def update(self, state, results):
+        self.add(state, self.qmetric.evaluate(state.qrels, results, state.k))
+
+    #
+    # add a query's score to a session's state
+    def add(self, state, score):
+        aggregation = _running_aggregation(self.aggfunc)
+        if aggregation is None:
+            state.scores.append(score)
+        elif state.numq == 0 or aggregation == 'last':
+            state.total = score
+        elif aggregation in ('mean', 'sum'):
+            state.total += score
+        elif aggregation == 'max':
+            state.total = max(state.total, score)
+        elif aggregation == 'min':
+            state.total = min(state.total, score)
+        state.numq += 1
+
+    def value(self, state):
+        aggregation = _running_aggregation(self.aggfunc)
+        if aggregation is None:
+            return self.aggfunc(state.scores) if state.numq > 0 else float('nan')
+        if state.numq == 0:
+            return 0.0 if aggregation == 'sum' else float('nan')
+        return state.total / state.numq if aggregation == 'mean' else state.total
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at once; the scores are in the order of run.sessids
+    def evaluate_run(self, run, k):
+        if hasattr(self.qmetric, 'evaluate_batch'):
+            k = max(k, 1)
+            grades, lengths, qgrades, qlengths = run.grade_matrix(k)
+            qscores = self.qmetric.evaluate_batch(grades, lengths, k, qgrades, qlengths)
+        else:
+            qscores = []
+            for sessid in run.sessids:
+                sqrels, sresults = run.session(sessid)
+                qscores.extend(self.qmetric.evaluate(sqrels, results, k) for results in sresults)
+        return self.aggregate_run(run, np.asarray(qscores))
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun by the query metric with each effort vector (a row of evecs) in
+    # place of its own in one pass (see e.g. RBP.evaluate_evecs); scores[i, e] is the i-th session's score (in the
+    # order of run.sessids) by the e-th effort vector
+    def evaluate_run_evecs(self, run, k, evecs):
+        if not hasattr(self.qmetric, 'evaluate_evecs'):
+            raise ValueError('%s does not have an effort vector' % self.qmetric.__class__.__name__)
+        evecs, k = _evec_matrix(evecs), max(k, 1)
+        grades, lengths, qgrades, qlengths = run.grade_matrix(k)
+        context = BatchContext(grades, lengths, k, qgrades, qlengths)
+        # the effort vectors are evaluated in blocks of about 2 ** 24 scores at every cutoff (which some metrics need),
+        # sharing the context's grade counts
+        block = max((1 << 24) // max(len(grades) * k, 1), 1)
+        sevals = []
+        for start in xrange(0, len(evecs), block):
+            qscores = self.qmetric.evaluate_evecs(context, evecs[start:start + block], k)
+            sevals.extend(self.aggregate_run(run, qscores[:, e]) for e in xrange(0, qscores.shape[1]))
+        return np.column_stack(sevals)
+
+    #
+    # evaluate a session at every cutoff k = 1, 2, ..., kmax; the (k-1)-th score is the session's score@k
+    def evaluate_all_cutoffs(self, qrels, sresults, kmax):
+        qscores = self.qmetric.evaluate_context(batch_context([qrels] * len(sresults), sresults, kmax))
+        return np.array([self.aggfunc(list(qscores[:, c])) for c in xrange(0, kmax)])
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun at every cutoff k = 1, 2, ..., kmax (one row per session)
+    def evaluate_run_cutoffs(self, run, kmax):
+        grades, lengths, qgrades, qlengths = run.grade_matrix(kmax)
+        qscores = self.qmetric.evaluate_cutoffs_batch(grades, lengths, kmax, qgrades, qlengths)
+        return np.column_stack([self.aggregate_run(run, qscores[:, c]) for c in xrange(0, kmax)])
+
+    #
+    # aggregate the scores of all queries in a dataset.CompiledRun into each session's score
+    def aggregate_run(self, run, qscores):
+        if self.aggfunc is np.sum or self.aggfunc is np.mean:
+            sums = np.bincount(run.query_session, weights=qscores, minlength=run.num_sessions())
+            return sums if self.aggfunc is np.sum else sums / np.diff(run.session_offsets)
+        offsets = run.session_offsets
+        return np.array([self.aggfunc(qscores[offsets[i]:offsets[i + 1]]) for i in xrange(0, run.num_sessions())])
+
+
+#
+# Evaluate many metrics together in one traversal of each session's results. The relevance grades of the results
+# are looked up once, and the intermediate results shared by the query metrics (e.g., the running number of relevant
+# results, the running effort of each effort vector, and the examination probabilities of each pdown) are computed
+# once for all the metrics (see query_metrics.BatchContext).
+class MetricSuite:
+    #
+    # metrics       a list of session metrics, e.g., SQMetric(RBP(evec, 0.8), np.mean) or SDCG(2, 4, True)
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    #
+    # evaluate a session by every metric; the scores are in the order of metrics (k < 1 evaluates the top result of
+    # each query, as the metrics' evaluate does)
+    def evaluate(self, qrels, sresults, k):
+        k = max(k, 1)
+        context = batch_context([qrels] * len(sresults), sresults, k)
+        scores = []
+        for metric in self.metrics:
+            if self.shares_context(metric):
+                scores.append(metric.aggfunc(list(metric.qmetric.evaluate_context(context)[:, k - 1])))
+            else:
+                scores.append(metric.evaluate(qrels, sresults, k))
+        return scores
+
+    #
+    # evaluate all sessions of a dataset.CompiledRun by every metric; returns one array of session scores (in the
+    # order of run.sessids) for each metric
+    def evaluate_run(self, run, k):
+        k = max(k, 1)
+        grades, lengths, qgrades, qlengths = run.grade_matrix(k)
+        context = BatchContext(grades, lengths, k, qgrades, qlengths)
+        sevals = []
+        for metric in self.metrics:
+            if self.shares_context(metric):
+                sevals.append(metric.aggregate_run(run, metric.qmetric.evaluate_context(context)[:, k - 1]))
+            else:
+                sevals.append(metric.evaluate_run(run, k))
+        return sevals
+
+    #
+    # Evaluate a session incrementally by every metric (see SessionState): start returns the metrics' states, update
+    # adds a query's results to all of them, and value returns the scores in the order of metrics.
+    def start(self, qrels, k):
+        return [metric.start(qrels, k) for metric in self.metrics]
+
+    def update(self, states, results):
+        context = None
+        for metric, state in zip(self.metrics, states):
+            if self.shares_context(metric):
+                k = max(state.k, 1)
+                if context is None:
+                    context = batch_context([state.qrels], [results], k)
+                metric.add(state, metric.qmetric.evaluate_context(context)[0, k - 1])
+            else:
+                metric.update(state, results)
+
+    def value(self, states):
+        return [metric.value(state) for metric, state in zip(self.metrics, states)]
+
+    #
+    # whether a metric is computed from the shared intermediate results
+    def shares_context(self, metric):
+        return isinstance(metric, SQMetric) and hasattr(metric.qmetric, 'evaluate_context')
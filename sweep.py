@@ -0,0 +1,78 @@
+#
+# Tune a metric's parameters by a parallel brute force scan (a parameter sweep) over a compiled dataset.
+#
+# Each configuration is evaluated on all sessions of a dataset.CompiledRun (using evaluate_batch or evaluate_run),
+# so the sessions' relevance grades are resolved once for the whole grid instead of once for every configuration.
+# Worker processes are forked after the dataset is compiled, so they share it without serialization.
+#
+
+import itertools
+import multiprocessing
+import numpy as np
+import scipy.stats as stats
+
+from session_metrics import *
+
+
+#
+# Expand a parameter grid, e.g., {'pdown': [0.5, 0.6], 'evec': [[1.0, 1.0, 1.0]]}, into a list of configurations
+# (keyword arguments of the metric's constructor), in the order of the parameters' sorted names.
+def expand_grid(grid):
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+# the sweep being evaluated, which worker processes inherit when they are forked
+_job = None
+
+
+#
+# Evaluate the ix-th configuration of the current sweep.
+def _evaluate_config(ix):
+    metric_class, configs, aggfunc, run, ratings, k = _job
+    metric = metric_class(**configs[ix])
+    if aggfunc is not None:
+        metric = SQMetric(metric, aggfunc)
+    sevals = metric.evaluate_run(run, k)
+    pearson, p_pearson = stats.pearsonr(ratings, sevals)
+    spearman, p_spearman = stats.spearmanr(ratings, sevals)
+    return ix, pearson, p_pearson, spearman, p_spearman
+
+
+#
+# Evaluate every configuration of a metric in a parameter grid and rank them by correlation with a user metric.
+#
+# metric_class  the metric's class, e.g., TBG
+# grid          the parameter grid, mapping each constructor argument's name to a list of values to scan
+# run           the sessions to be evaluated, a dataset.CompiledRun
+# sratings      sessions' user ratings (ground truth)
+# umetric       the user experience metric, either 'performance' or 'difficulty' in this dataset
+# k             the top k results of each query to be evaluated
+# aggfunc       if the metric evaluates a query, the aggregation function to derive session scores, e.g., np.mean
+# processes     the number of worker processes (by default, the number of CPUs); 1 evaluates in this process
+# by            rank the configurations by 'pearson' or 'spearman' in descending order, NaN last
+#
+# Returns a list of (config, pearson, p_pearson, spearman, p_spearman).
+def sweep(metric_class, grid, run, sratings, umetric, k, aggfunc=None, processes=None, by='pearson'):
+    global _job
+    configs = expand_grid(grid)
+    ratings = np.array([sratings[sessid][umetric] for sessid in run.sessids])
+    # build the grade matrices before forking so that all workers share them
+    run.grade_matrix(k)
+    _job = metric_class, configs, aggfunc, run, ratings, k
+    try:
+        if processes == 1:
+            rows = map(_evaluate_config, xrange(0, len(configs)))
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                rows = pool.map(_evaluate_config, xrange(0, len(configs)), chunksize=max(1, len(configs) // 256))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _job = None
+    column = {'pearson': 1, 'spearman': 3}[by]
+    # configurations of constant scores have NaN correlations, which are ranked last (in the order of the grid)
+    rows.sort(key=lambda row: (True, 0, row[0]) if np.isnan(row[column]) else (False, -row[column], row[0]))
+    return [(configs[row[0]],) + tuple(row[1:]) for row in rows]
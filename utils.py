@@ -12,9 +12,53 @@
 # http://people.cs.umass.edu/~jpjiang/papers/ecir16_metrics.pdf
 
 
+import itertools
+import multiprocessing
 import random
+import numpy as np
 import scipy.stats as stats
 
+from collections import OrderedDict
+
+from dataset import CompiledRun, attach_shared, compile_runs
+from result_store import stored
+from session_metrics import MetricSuite
+
+
+#
+# A bounded LRU cache of the session scores evaluated by correlation and regress, so that each session is evaluated
+# only once for each metric, however many folds and random partitions it is used in. Entries are keyed by the
+# identity of the metric and the dataset, so they must not be modified after they have been evaluated.
+# Sessions missing from the cache are looked up in the result store first if it is in use (see result_store.py).
+class ScoreCache:
+    #
+    # capacity      the maximum number of cached entries; the least recently used entry is evicted first
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    #
+    # get the scores of all sessions in sresults, a dict mapping each sessid to smetric's score
+    def get(self, smetric, sresults, sqrels, k):
+        key = (id(smetric), id(sresults), id(sqrels), k)
+        entry = self.entries.pop(key, None)
+        # the ids of garbage collected objects may be reused by other ones
+        if entry is None or entry[0] is not smetric or entry[1] is not sresults or entry[2] is not sqrels:
+            scores = dict()
+            for sessid in sresults.keys():
+                scores[sessid] = stored(smetric, sqrels[sessid], sresults[sessid], k, smetric.evaluate)
+            entry = (smetric, sresults, sqrels, scores)
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry[3]
+
+    def clear(self):
+        self.entries.clear()
+
+
+score_cache = ScoreCache()
+
 
 #
 # Compute Pearson's r and Spearman's rho of umetric and smetric on a few sessions.
@@ -26,16 +70,84 @@ import scipy.stats as stats
 # smetric       the system-oriented metric
 # k             the top k results of each query to be evaluated by smetric
 def correlation(sratings, sresults, sqrels, umetric, smetric, k):
+    scores = score_cache.get(smetric, sresults, sqrels, k)
     ratings = []
     sevals = []
     for sessid in sresults.keys():
         ratings.append(sratings[sessid][umetric])
-        sevals.append(smetric.evaluate(sqrels[sessid], sresults[sessid], k))
+        sevals.append(scores[sessid])
     pearson, p_pearson = stats.pearsonr(ratings, sevals)
     spearman, p_spearman = stats.spearmanr(ratings, sevals)
     return pearson, p_pearson, spearman, p_spearman
 
 
+#
+# Bootstrap confidence intervals and p values of Pearson's r and Spearman's rho of umetric and smetric. All the
+# resamples are evaluated at once, so thousands of them take about as long as evaluating the metric.
+#
+# sratings      sessions' user ratings (ground truth)
+# sresults      sessions' search results
+# sqrels        sessions' qrels
+# umetric       the user experience metric, either 'performance' or 'difficulty' in this dataset
+# smetric       the system-oriented metric
+# k             the top k results of each query to be evaluated by smetric
+# numsamples    the number of bootstrap resamples of the sessions
+# alpha         the confidence level of the intervals is 1 - alpha
+# seed          the seed used for generating random numbers
+#
+# Returns (pearson, pearson_ci, p_pearson, spearman, spearman_ci, p_spearman), where each ci is a percentile
+# interval (low, high) and each p value is the two-sided bootstrap p value of no correlation.
+def bootstrap_correlation(sratings, sresults, sqrels, umetric, smetric, k, numsamples=10000, alpha=0.05, seed=0):
+    scores = score_cache.get(smetric, sresults, sqrels, k)
+    ratings = np.array([sratings[sessid][umetric] for sessid in sresults.keys()], dtype=np.float64)
+    sevals = np.array([scores[sessid] for sessid in sresults.keys()], dtype=np.float64)
+    samples = np.random.RandomState(seed).randint(0, len(ratings), size=(numsamples, len(ratings)))
+    xs, ys = sevals[samples], ratings[samples]
+    pearson_ci, p_pearson = _bootstrap_interval(_pearson_rows(xs, ys), alpha)
+    # Spearman's rho is Pearson's r of the ranks within each resample
+    spearman_ci, p_spearman = _bootstrap_interval(_pearson_rows(_rank_rows(xs), _rank_rows(ys)), alpha)
+    pearson, spearman = stats.pearsonr(ratings, sevals)[0], stats.spearmanr(ratings, sevals)[0]
+    return pearson, pearson_ci, p_pearson, spearman, spearman_ci, p_spearman
+
+
+#
+# The percentile interval and the two-sided p value of no correlation from the correlations of bootstrap resamples.
+def _bootstrap_interval(rs, alpha):
+    # resamples of constant scores or ratings have no correlation
+    rs = rs[~np.isnan(rs)]
+    ci = (np.percentile(rs, 100 * alpha / 2), np.percentile(rs, 100 * (1 - alpha / 2)))
+    return ci, min(1.0, 2 * min(np.mean(rs <= 0), np.mean(rs >= 0)))
+
+
+#
+# Pearson's r of x and y in each row.
+def _pearson_rows(x, y):
+    dx = x - np.mean(x, axis=1)[:, np.newaxis]
+    dy = y - np.mean(y, axis=1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(dx * dy, axis=1) / np.sqrt(np.sum(dx * dx, axis=1) * np.sum(dy * dy, axis=1))
+
+
+#
+# The ranks (from 1) of the values in each row, where tied values get their average rank as in scipy's rankdata.
+def _rank_rows(values):
+    n, m = values.shape
+    rows = np.arange(0, n)[:, np.newaxis]
+    order = np.argsort(values, axis=1, kind='mergesort')
+    svalues = values[rows, order]
+    # the first and the last position of each run of tied values
+    starts = np.ones((n, m), dtype=bool)
+    starts[:, 1:] = svalues[:, 1:] != svalues[:, :-1]
+    ends = np.ones((n, m), dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    positions = np.arange(0, m)[np.newaxis, :]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, m - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.zeros((n, m))
+    ranks[rows, order] = (first + last) / 2.0 + 1
+    return ranks
+
+
 #
 # Regress umetric using smetric on a few sessions.
 #
@@ -51,20 +163,27 @@ def correlation(sratings, sresults, sqrels, umetric, smetric, k):
 #               x-fold cross validation
 # seed          the seed used for generating random numbers
 def regress(sratings, sresults, sqrels, umetric, smetric, k, norm, numfolds, numsamples, seed=0):
-    nrmse = []
+    scores = score_cache.get(smetric, sresults, sqrels, k)
+    ratings = np.array([sratings[sessid][umetric] for sessid in sresults.keys()], dtype=np.float64)
+    sevals = np.array([scores[sessid] for sessid in sresults.keys()], dtype=np.float64)
+    # in each partition, the session shuffled to position ix is tested in fold ix % numfolds
+    folds = np.argsort(_permutations(len(sresults), numsamples, seed), axis=1) % numfolds
+    # one row for each (partition, fold)
+    test = (folds[:, np.newaxis, :] == np.arange(0, numfolds)[np.newaxis, :, np.newaxis]).reshape(-1, len(sresults))
+    return list(_regress_folds(ratings[np.newaxis, :], sevals[np.newaxis, :], test, norm))
+
+
+#
+# Generate numsamples random permutations of range(n), one in each row. The permutations are the same as shuffling
+# a list of n sessions by random.shuffle after random.seed(seed), so the partitions do not depend on numfolds.
+def _permutations(n, numsamples, seed):
     random.seed(seed)
+    perms = np.zeros((numsamples, n), dtype=np.int64)
     for i in xrange(0, numsamples):
-        sessionlist = [sessid for sessid in sresults.keys()]
-        random.shuffle(sessionlist)
-        for foldid in xrange(0, numfolds):
-            train, test = [], []
-            for ix in xrange(0, len(sessionlist)):
-                if ix % numfolds == foldid:
-                    test.append(sessionlist[ix])
-                else:
-                    train.append(sessionlist[ix])
-            nrmse.append(regress_fold(sratings, sresults, sqrels, umetric, smetric, k, norm, train, test))
-    return nrmse
+        order = range(0, n)
+        random.shuffle(order)
+        perms[i] = order
+    return perms
 
 
 #
@@ -80,19 +199,172 @@ def regress(sratings, sresults, sqrels, umetric, smetric, k, norm, numfolds, num
 # train         a list of training sessions' sessids
 # test          a list of testing sessions' sessids
 def regress_fold(sratings, sresults, sqrels, umetric, smetric, k, norm, train, test):
-    ratings = []
-    sevals = []
-    for sessid in train:
-        ratings.append(sratings[sessid][umetric])
-        sevals.append(smetric.evaluate(sqrels[sessid], sresults[sessid], k))
-    slope, intercept, _, _, _ = stats.linregress(sevals, ratings)
-    sum_se = 0
-    for sessid in test:
-        rating = sratings[sessid][umetric]
-        seval = smetric.evaluate(sqrels[sessid], sresults[sessid], k)
-        rating_pred = slope * seval + intercept
-        sum_se += (rating - rating_pred) ** 2
-    return (sum_se / len(test)) ** 0.5 / norm
+    scores = score_cache.get(smetric, sresults, sqrels, k)
+    sessids = list(train) + list(test)
+    ratings = np.array([[sratings[sessid][umetric] for sessid in sessids]], dtype=np.float64)
+    sevals = np.array([[scores[sessid] for sessid in sessids]], dtype=np.float64)
+    is_test = np.arange(0, len(sessids))[np.newaxis, :] >= len(train)
+    return _regress_folds(ratings, sevals, is_test, norm)[0]
+
+
+#
+# Fit a least squares line of ratings over sevals on the training sessions of each row, and compute the normalized
+# root mean square error of the fitted line on the row's testing sessions.
+#
+# ratings, sevals   user ratings and metric scores, one row for each fold (or a single row shared by all folds)
+# test              whether each session of a row is a testing session (otherwise it is a training session)
+# norm              the maximum possible user rating difference
+def _regress_folds(ratings, sevals, test, norm):
+    ratings, sevals, test = np.broadcast_arrays(ratings, sevals, test)
+    train = ~test
+    ntrain = np.sum(train, axis=1)
+    mean_seval = np.sum(np.where(train, sevals, 0.0), axis=1) / ntrain
+    mean_rating = np.sum(np.where(train, ratings, 0.0), axis=1) / ntrain
+    dseval = np.where(train, sevals - mean_seval[:, np.newaxis], 0.0)
+    drating = np.where(train, ratings - mean_rating[:, np.newaxis], 0.0)
+    slope = np.sum(dseval * drating, axis=1) / np.sum(dseval * dseval, axis=1)
+    intercept = mean_rating - slope * mean_seval
+    rating_pred = slope[:, np.newaxis] * sevals + intercept[:, np.newaxis]
+    sum_se = np.sum(np.where(test, (ratings - rating_pred) ** 2, 0.0), axis=1)
+    return (sum_se / np.sum(test, axis=1)) ** 0.5 / norm
+
+
+#
+# Evaluate a few session metrics on sessions streamed one at a time, e.g., by dataset.iter_sessions, so that memory
+# is bounded by the largest session. Yields (sessid, scores), where scores has one score for each metric.
+#
+# smetrics      the system-oriented metrics
+# sessions      an iterable of (sessid, sresults, sqrels)
+# k             the top k results of each query to be evaluated
+def evaluate_stream(smetrics, sessions, k):
+    suite = MetricSuite(smetrics)
+    for sessid, sresults, sqrels in sessions:
+        yield sessid, suite.evaluate(sqrels, sresults, k)
+
+
+# the compiled run that a worker process of evaluate_parallel has attached to
+_shared_run = None
+
+
+def _attach_worker(path):
+    global _shared_run
+    _shared_run, _ = attach_shared(path)
+
+
+def _evaluate_shared(args):
+    smetric, k = args
+    return smetric.evaluate_run(_shared_run, k)
+
+
+#
+# Evaluate a few session metrics on all sessions of a dataset.SharedRun using a pool of worker processes.
+# Each worker attaches to the shared memory block once, so only the metrics and the scores are serialized.
+#
+# smetrics      the system-oriented metrics (each with an evaluate_run method)
+# shared        a dataset.SharedRun
+# k             the top k results of each query to be evaluated
+# processes     the number of worker processes (by default, the number of CPUs)
+#
+# Returns a list of score arrays (one for each metric, in the order of the shared run's sessids).
+def evaluate_parallel(smetrics, shared, k, processes=None):
+    pool = multiprocessing.Pool(processes, initializer=_attach_worker, initargs=(shared.path,))
+    try:
+        return pool.map(_evaluate_shared, [(smetric, k) for smetric in smetrics], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+#
+# Evaluate several systems on the same sessions, e.g., to compare a few rankers offline. The qrels are compiled once
+# and shared by all systems, and each system's sessions are evaluated by all metrics at once (see MetricSuite).
+#
+# runs          a list of systems' search results of the same sessions (each as returned by load_results)
+# sqrels        the sessions' qrels
+# smetrics      a list of session metrics
+# k             the top k results of each query to be evaluated
+#
+# Returns (sessids, scores), where scores[i, j, m] is the i-th system's score of the j-th session (in the order of
+# sessids) by the m-th metric.
+def evaluate_systems(runs, sqrels, smetrics, k):
+    compiled = compile_runs(runs, sqrels)
+    suite = MetricSuite(smetrics)
+    scores = np.empty((len(runs), len(compiled[0].sessids) if runs else 0, len(smetrics)), dtype=np.float64)
+    for i, run in enumerate(compiled):
+        for m, sevals in enumerate(suite.evaluate_run(run, k)):
+            scores[i, :, m] = sevals
+    return (compiled[0].sessids if runs else []), scores
+
+
+#
+# Evaluate sessions by a query metric with each of many effort vectors at once, e.g., to search a grid of effort
+# vectors (see evec_grid) for the one that agrees the most with users' ratings. The results' grades are counted once
+# for all the effort vectors (see query_metrics.BatchContext.grade_counts).
+#
+# sresults      the sessions' search results (as returned by load_results)
+# sqrels        the sessions' qrels
+# smetric       an SQMetric of a query metric with an effort vector, e.g., SQMetric(RBP(evec, 0.8), np.mean), whose
+#               own effort vector is not used
+# evecs         a matrix of effort vectors, one per row
+# k             the top k results of each query to be evaluated
+#
+# Returns (sessids, scores), where scores[j, e] is the j-th session's score (in the order of sessids) by the e-th
+# effort vector.
+def evaluate_evecs(sresults, sqrels, smetric, evecs, k):
+    run = CompiledRun(sresults, sqrels)
+    return run.sessids, smetric.evaluate_run_evecs(run, k, evecs)
+
+
+#
+# The effort vectors whose r-th element is one of levels[r], e.g., evec_grid([np.linspace(0.1, 1, 10), [1], [1]]),
+# as a matrix with one effort vector per row.
+def evec_grid(levels):
+    return np.array(list(itertools.product(*levels)), dtype=np.float64)
+
+
+#
+# Paired significance tests between each pair of systems on each metric, over the sessions of a score tensor
+# returned by evaluate_systems.
+#
+# scores        the scores of each system (axis 0), session (axis 1), and metric (axis 2)
+# test          'ttest' (scipy.stats.ttest_rel), 'wilcoxon' (scipy.stats.wilcoxon), or 'randomization' (a paired
+#               randomization test, which flips the sign of each session's difference at random)
+# numsamples    the number of random sign flips of the randomization test
+# seed          the seed used for generating random numbers
+#
+# Returns (diffs, pvals), where diffs[a, b, m] is the mean of system a's scores minus system b's by the m-th metric,
+# and pvals[a, b, m] is the two-sided p value of the difference (NaN where a == b).
+def compare_systems(scores, test='ttest', numsamples=10000, seed=0):
+    numsystems, numsessions, nummetrics = scores.shape
+    diffs = np.mean(scores, axis=1)[:, np.newaxis, :] - np.mean(scores, axis=1)[np.newaxis, :, :]
+    pvals = np.empty((numsystems, numsystems, nummetrics), dtype=np.float64)
+    pvals.fill(np.nan)
+    if test == 'randomization':
+        # the same sign flips are used for all pairs of systems
+        signs = np.random.RandomState(seed).randint(0, 2, size=(numsamples, numsessions)) * 2.0 - 1
+    for a in xrange(0, numsystems):
+        for b in xrange(a + 1, numsystems):
+            if test == 'ttest':
+                p = stats.ttest_rel(scores[a], scores[b], axis=0)[1]
+            elif test == 'wilcoxon':
+                p = [_wilcoxon(scores[a, :, m], scores[b, :, m]) for m in xrange(0, nummetrics)]
+            elif test == 'randomization':
+                d = scores[a] - scores[b]
+                observed = np.abs(np.mean(d, axis=0))
+                sampled = np.abs(np.dot(signs, d) / numsessions)
+                p = (np.sum(sampled >= observed - 1e-12, axis=0) + 1.0) / (numsamples + 1)
+            else:
+                raise ValueError('unknown test: %s' % test)
+            pvals[a, b] = pvals[b, a] = p
+    return diffs, pvals
+
+
+#
+# The p value of Wilcoxon's signed-rank test, or 1 if the two systems' scores are identical.
+def _wilcoxon(x, y):
+    if np.all(x == y):
+        return 1.0
+    return stats.wilcoxon(x, y)[1]
 
 
 #